@@ -4,32 +4,29 @@ from __future__ import absolute_import, division, print_function
 
 import os
 import sys
-import subprocess
 import pdb
 
 log_level_index = sys.argv.index('--log_level') + 1 if '--log_level' in sys.argv else 0
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = sys.argv[log_level_index] if log_level_index > 0 and log_level_index < len(sys.argv) else '3'
 
-import evaluate
 import numpy as np
-import progressbar
 import shutil
 import tempfile
 import tensorflow as tf
+import time
 import traceback
 
-from ds_ctcdecoder import ctc_beam_search_decoder, Scorer
+# Modules only needed for training, testing, exporting or decoding get imported by the
+# functions doing that, so runs only doing some of it don't pay for importing the others
 from six.moves import zip, range
-from tensorflow.contrib.lite.python import tflite_convert
-from tensorflow.python.tools import freeze_graph
-from util.audio import audiofile_to_input_vector
 from util.config import Config, initialize_globals
-from util.coordinator import TrainingCoordinator
-from util.feeding import DataSet, ModelFeeder
+from util.extra_flags import create_extra_flags
 from util.flags import create_flags, FLAGS
 from util.logging import log_info, log_error, log_debug, log_warn
-from util.preprocess import preprocess
+from util.mixed_precision import compute_dtype, DynamicLossScale
+from util.profiling import profiler
 from util.text import Alphabet
+from util.throughput import AVERAGE_GRADIENTS_SCOPE, ThroughputMonitor
 
 
 # Graph Creation
@@ -53,7 +50,33 @@ def variable_on_worker_level(name, shape, initializer):
     return var
 
 
-def BiRNN(batch_x, seq_length, dropout, reuse=False, batch_size=None, n_steps=-1, previous_state=None, tflite=False):
+def dense(x, weights, bias, dropout_rate=None, relu=True, compute_dtype=tf.float32, fused=False):
+    r'''
+    A dense layer ``x * weights + bias``, by default followed by a ReLU clipped at ``FLAGS.relu_clip``
+    and by dropout of ``dropout_rate``. With a reduced ``compute_dtype`` the layer gets computed in
+    that precision from casts of the float32 variables. In ``fused`` mode bias and ReLU are added by
+    ``bias_add`` and ``relu`` right after the ``matmul``, the pattern TensorFlow's graph optimizer
+    fuses into a single kernel.
+    '''
+    if compute_dtype != tf.float32:
+        x = tf.cast(x, compute_dtype)
+        weights = tf.cast(weights, compute_dtype)
+        bias = tf.cast(bias, compute_dtype)
+
+    if fused:
+        output = tf.nn.bias_add(tf.matmul(x, weights), bias)
+    else:
+        output = tf.add(tf.matmul(x, weights), bias)
+
+    if relu:
+        output = tf.minimum(tf.nn.relu(output), tf.cast(FLAGS.relu_clip, output.dtype))
+        # The dropout rates are float32 placeholders, dropout wants the keep probability in the output's dtype
+        output = tf.nn.dropout(output, tf.cast(1.0 - dropout_rate, output.dtype))
+    return output
+
+
+def BiRNN(batch_x, seq_length, dropout, reuse=False, batch_size=None, n_steps=-1, previous_state=None, tflite=False,
+          compute_dtype=tf.float32, fused=False, tflite_fused_lstm=False):
     r'''
     That done, we will define the learned variables, the weights and biases,
     within the method ``BiRNN()`` which also constructs the neural network.
@@ -66,6 +89,11 @@ def BiRNN(batch_x, seq_length, dropout, reuse=False, batch_size=None, n_steps=-1
     an input vector of dimension ``n_hidden_1`` to one of dimension ``n_hidden_2``.
     The variables ``h3``, ``h5``, and ``h6`` are similar.
     Likewise, the biases, ``b1``, ``b2``..., hold the biases for the various layers.
+    The hidden dense layers are computed in ``compute_dtype`` (the LSTM and the output layer computing
+    the logits stay in float32). All dense layers use the kernel fusable form of ``dense()`` if ``fused``
+    is set.
+    For TF Lite the LSTM gets unrolled over ``n_steps``, unless ``tflite_fused_lstm`` is set.
+    In that case it is built to be converted to TF Lite's fused LSTM op.
     '''
     layers = {}
 
@@ -76,8 +104,9 @@ def BiRNN(batch_x, seq_length, dropout, reuse=False, batch_size=None, n_steps=-1
     # Reshaping `batch_x` to a tensor with shape `[n_steps*batch_size, n_input + 2*n_input*n_context]`.
     # This is done to prepare the batch for input into the first layer which expects a tensor of rank `2`.
 
-    # Permute n_steps and batch_size
-    batch_x = tf.transpose(batch_x, [1, 0, 2, 3])
+    # Permute n_steps and batch_size, a batch of one sample is time-major already
+    if not (isinstance(batch_size, int) and batch_size == 1):
+        batch_x = tf.transpose(batch_x, [1, 0, 2, 3])
     # Reshape to prepare input for first layer
     batch_x = tf.reshape(batch_x, [-1, Config.n_input + 2*Config.n_input*Config.n_context]) # (n_steps*batch_size, n_input + 2*n_input*n_context)
     layers['input_reshaped'] = batch_x
@@ -88,24 +117,24 @@ def BiRNN(batch_x, seq_length, dropout, reuse=False, batch_size=None, n_steps=-1
     # 1st layer
     b1 = variable_on_worker_level('b1', [Config.n_hidden_1], tf.zeros_initializer())
     h1 = variable_on_worker_level('h1', [Config.n_input + 2*Config.n_input*Config.n_context, Config.n_hidden_1], tf.contrib.layers.xavier_initializer())
-    layer_1 = tf.minimum(tf.nn.relu(tf.add(tf.matmul(batch_x, h1), b1)), FLAGS.relu_clip)
-    layer_1 = tf.nn.dropout(layer_1, (1.0 - dropout[0]))
+    layer_1 = dense(batch_x, h1, b1, dropout[0], compute_dtype=compute_dtype, fused=fused)
     layers['layer_1'] = layer_1
 
     # 2nd layer
     b2 = variable_on_worker_level('b2', [Config.n_hidden_2], tf.zeros_initializer())
     h2 = variable_on_worker_level('h2', [Config.n_hidden_1, Config.n_hidden_2], tf.contrib.layers.xavier_initializer())
-    layer_2 = tf.minimum(tf.nn.relu(tf.add(tf.matmul(layer_1, h2), b2)), FLAGS.relu_clip)
-    layer_2 = tf.nn.dropout(layer_2, (1.0 - dropout[1]))
+    layer_2 = dense(layer_1, h2, b2, dropout[1], compute_dtype=compute_dtype, fused=fused)
     layers['layer_2'] = layer_2
 
     # 3rd layer
     b3 = variable_on_worker_level('b3', [Config.n_hidden_3], tf.zeros_initializer())
     h3 = variable_on_worker_level('h3', [Config.n_hidden_2, Config.n_hidden_3], tf.contrib.layers.xavier_initializer())
-    layer_3 = tf.minimum(tf.nn.relu(tf.add(tf.matmul(layer_2, h3), b3)), FLAGS.relu_clip)
-    layer_3 = tf.nn.dropout(layer_3, (1.0 - dropout[2]))
+    layer_3 = dense(layer_2, h3, b3, dropout[2], compute_dtype=compute_dtype, fused=fused)
     layers['layer_3'] = layer_3
 
+    # The LSTM runs in float32
+    layer_3 = tf.cast(layer_3, tf.float32)
+
     # Now we create the forward and backward LSTM units.
     # Both of which have inputs of length `n_cell_dim` and bias `1.0` for the forget gate of the LSTM.
 
@@ -113,13 +142,15 @@ def BiRNN(batch_x, seq_length, dropout, reuse=False, batch_size=None, n_steps=-1
     if not tflite:
         fw_cell = tf.contrib.rnn.LSTMBlockFusedCell(Config.n_cell_dim, reuse=reuse)
         layers['fw_cell'] = fw_cell
+    elif tflite_fused_lstm:
+        fw_cell = tf.lite.experimental.nn.TFLiteLSTMCell(Config.n_cell_dim, reuse=reuse)
     else:
         fw_cell = tf.nn.rnn_cell.LSTMCell(Config.n_cell_dim, reuse=reuse)
 
     # `layer_3` is now reshaped into `[n_steps, batch_size, 2*n_cell_dim]`,
     # as the LSTM RNN expects its input to be of shape `[max_time, batch_size, input_size]`.
     layer_3 = tf.reshape(layer_3, [n_steps, batch_size, Config.n_hidden_3])
-    if tflite:
+    if tflite and not tflite_fused_lstm:
         # Generated StridedSlice, not supported by NNAPI
         #n_layer_3 = []
         #for l in range(layer_3.shape[0]):
@@ -133,6 +164,9 @@ def BiRNN(batch_x, seq_length, dropout, reuse=False, batch_size=None, n_steps=-1
     # need to do different things here.
     if not tflite:
         output, output_state = fw_cell(inputs=layer_3, dtype=tf.float32, sequence_length=seq_length, initial_state=previous_state)
+    elif tflite_fused_lstm:
+        output, output_state = tf.lite.experimental.nn.dynamic_rnn(fw_cell, layer_3, initial_state=previous_state,
+                                                                   dtype=tf.float32, time_major=True)
     else:
         output, output_state = tf.nn.static_rnn(fw_cell, layer_3, previous_state, tf.float32)
         output = tf.concat(output, 0)
@@ -146,15 +180,15 @@ def BiRNN(batch_x, seq_length, dropout, reuse=False, batch_size=None, n_steps=-1
     # Now we feed `output` to the fifth hidden layer with clipped RELU activation and dropout
     b5 = variable_on_worker_level('b5', [Config.n_hidden_5], tf.zeros_initializer())
     h5 = variable_on_worker_level('h5', [Config.n_cell_dim, Config.n_hidden_5], tf.contrib.layers.xavier_initializer())
-    layer_5 = tf.minimum(tf.nn.relu(tf.add(tf.matmul(output, h5), b5)), FLAGS.relu_clip)
-    layer_5 = tf.nn.dropout(layer_5, (1.0 - dropout[5]))
+    layer_5 = dense(output, h5, b5, dropout[5], compute_dtype=compute_dtype, fused=fused)
     layers['layer_5'] = layer_5
 
     # Now we apply the weight matrix `h6` and bias `b6` to the output of `layer_5`
     # creating `n_classes` dimensional vectors, the logits.
     b6 = variable_on_worker_level('b6', [Config.n_hidden_6], tf.zeros_initializer())
     h6 = variable_on_worker_level('h6', [Config.n_hidden_5, Config.n_hidden_6], tf.contrib.layers.xavier_initializer())
-    layer_6 = tf.add(tf.matmul(layer_5, h6), b6)
+    # Like the LSTM, the output projection runs in float32, so softmax and CTC get full precision logits
+    layer_6 = dense(tf.cast(layer_5, tf.float32), h6, b6, relu=False, fused=fused)
     layers['layer_6'] = layer_6
 
     # Finally we reshape layer_6 from a tensor of shape [n_steps*batch_size, n_hidden_6]
@@ -186,8 +220,14 @@ def calculate_mean_edit_distance_and_loss(model_feeder, tower, dropout, reuse):
     # Obtain the next batch of data
     batch_x, batch_seq_len, batch_y = model_feeder.next_batch(tower)
 
+    # Keep track of the amount of data the tower processes for the throughput statistics
+    tf.add_to_collection('tower_input_steps', tf.reduce_sum(batch_seq_len))
+    tf.add_to_collection('tower_batch_sizes', tf.shape(batch_seq_len)[0])
+    tf.add_to_collection('tower_padded_steps', tf.shape(batch_x)[0] * tf.shape(batch_x)[1])
+
     # Calculate the logits of the batch using BiRNN
-    logits, _ = BiRNN(batch_x, batch_seq_len, dropout, reuse)
+    logits, _ = BiRNN(batch_x, batch_seq_len, dropout, reuse,
+                      compute_dtype=compute_dtype(FLAGS.precision), fused=FLAGS.fused_dense)
 
     # Compute the CTC loss using TensorFlow's `ctc_loss`
     total_loss = tf.nn.ctc_loss(labels=batch_y,
@@ -235,11 +275,13 @@ def create_optimizer():
 # on which all operations within the tower execute.
 # For example, all operations of 'tower 0' could execute on the first GPU `tf.device('/gpu:0')`.
 
-def get_tower_results(model_feeder, optimizer, dropout_rates, drop_source_layers):
+def get_tower_results(model_feeder, optimizer, dropout_rates, drop_source_layers, loss_scale=None):
     r'''
     With this preliminary step out of the way, we can for each GPU introduce a
     tower for which's batch we calculate and return the optimization gradients
     and the average loss across towers.
+    If a ``loss_scale`` is given, gradients are computed from the scaled loss
+    and have to be unscaled by the caller.
     '''
     # To calculate the mean of the losses
     tower_avg_losses = []
@@ -270,7 +312,8 @@ def get_tower_results(model_feeder, optimizer, dropout_rates, drop_source_layers
 
                     # Compute gradients for model parameters using tower's mini-batch
                     # gradients = optimizer.compute_gradients(avg_loss)  # without transfer learning
-                    gradients = optimizer.compute_gradients(avg_loss, var_list= [v for v in tf.trainable_variables() if any(layer in v.op.name for layer in drop_source_layers) ] )
+                    scaled_loss = loss_scale.scale_loss(avg_loss) if loss_scale else avg_loss
+                    gradients = optimizer.compute_gradients(scaled_loss, var_list= [v for v in tf.trainable_variables() if any(layer in v.op.name for layer in drop_source_layers) ] )
 
                     # Retain tower's gradients
                     tower_gradients.append(gradients)
@@ -284,24 +327,30 @@ def get_tower_results(model_feeder, optimizer, dropout_rates, drop_source_layers
     return tower_gradients, avg_loss_across_towers
 
 
-def average_gradients(tower_gradients):
+def average_gradients(tower_gradients, dtype=tf.float32):
     r'''
     A routine for computing each variable's average of the gradients obtained from the GPUs.
     Note also that this code acts as a synchronization point as it requires all
     GPUs to be finished with their mini-batch before it can run to completion.
+    With a reduced ``dtype`` the gradients of several towers are stacked and averaged in that
+    precision, halving the memory and bandwidth of the averaging, and cast back to the variables' dtype.
     '''
     # List of average gradients to return to the caller
     average_grads = []
 
     # Run this on cpu_device to conserve GPU memory
-    with tf.device(Config.cpu_device):
+    with tf.device(Config.cpu_device), tf.name_scope(AVERAGE_GRADIENTS_SCOPE):
         # Loop over gradient/variable pairs from all towers
         for grad_and_vars in zip(*tower_gradients):
             # Introduce grads to store the gradients for the current variable
             grads = []
 
+            # A single tower's gradients are used as they are, casting them would only lose precision
+            reduce_dtype = dtype if len(grad_and_vars) > 1 else grad_and_vars[0][0].dtype
+
             # Loop over the gradients for the current variable
             for g, _ in grad_and_vars:
+                g = tf.cast(g, reduce_dtype)
                 # Add 0 dimension to the gradients to represent the tower.
                 expanded_g = tf.expand_dims(g, 0)
                 # Append on a 'tower' dimension which we will average over below.
@@ -309,7 +358,7 @@ def average_gradients(tower_gradients):
 
             # Average over the 'tower' dimension
             grad = tf.concat(grads, 0)
-            grad = tf.reduce_mean(grad, 0)
+            grad = tf.cast(tf.reduce_mean(grad, 0), grad_and_vars[0][0].dtype)
 
             # Create a gradient/variable tuple for the current variable with its average gradient
             grad_and_var = (grad, grad_and_vars[0][1])
@@ -374,6 +423,18 @@ def train(server=None):
     Trains the network on a given server of a cluster.
     If no server provided, it performs single process training.
     '''
+    import progressbar
+
+    from util.allreduce import allreduce_gradients, broadcast_variables, Ring, ring_hosts
+    from util.checkpoint_stash import CheckpointStash
+    from util.coordinator import TrainingCoordinator
+    from util.dataset_feeder import DatasetFeeder
+    from util.feature_cache import preprocess
+    from util.feeding import DataSet, ModelFeeder
+    from util.gradient_accumulation import GradientAccumulator
+    from util.sampler import epoch_of_step, LengthSampler
+    from util.sidecar import early_stop_requested, start_sidecar_evaluator
+    from util.warmstart import parse_name_map, Warmstart
 
     # The transfer learning approach here need us to supply the layers which we
     # want to exclude from the source model.
@@ -388,6 +449,12 @@ def train(server=None):
     
     drop_source_layers = ['2', '3', 'lstm', '5', '6'][-int(FLAGS.drop_source_layers):]
 
+    sidecar = None
+    if FLAGS.dev_sidecar and Config.is_chief:
+        # Validation moves to the sidecar process, so the training loop never pauses for it
+        FLAGS.validation_step = 0
+        sidecar = start_sidecar_evaluator()
+
     # Initializing and starting the training coordinator
     coord = TrainingCoordinator(Config.is_chief)
     coord.start()
@@ -404,20 +471,47 @@ def train(server=None):
                             Config.n_input,
                             Config.n_context,
                             Config.alphabet,
-                            hdf5_cache_path=FLAGS.train_cached_features_path)
+                            hdf5_cache_path=FLAGS.train_cached_features_path,
+                            cache_dir=FLAGS.feature_cache_dir,
+                            workers=FLAGS.preprocess_workers,
+                            chunk_size=FLAGS.preprocess_chunk_size,
+                            task_size=FLAGS.preprocess_task_size,
+                            batch_mfcc=FLAGS.batch_mfcc)
+
+    # With allreduce every rank trains on its own equally sized shard of the training set
+    if FLAGS.allreduce_size > 1:
+        shard_end = len(train_data) // FLAGS.allreduce_size * FLAGS.allreduce_size
+        train_data = train_data.iloc[FLAGS.allreduce_rank:shard_end:FLAGS.allreduce_size]
 
     train_set = DataSet(train_data,
                         FLAGS.train_batch_size,
                         limit=FLAGS.limit_train,
                         next_index=lambda i: coord.get_next_index('train'))
 
+    # Visiting the training samples in an order that keeps utterances of similar length in a batch
+    sampler = None
+    batches_per_step = len(Config.available_devices) * max(1, FLAGS.replicas_to_agg)
+    if FLAGS.sortagrad_epochs > 0 or FLAGS.bucketed_batches:
+        sampler = LengthSampler(train_set.data['features_len'].values,
+                                FLAGS.train_batch_size,
+                                batches_per_step=batches_per_step,
+                                sorted_epochs=FLAGS.sortagrad_epochs,
+                                bucketed=FLAGS.bucketed_batches,
+                                seed=FLAGS.random_seed)
+        train_set.next_index = lambda i: sampler.index(coord.get_next_index('train'))
+
     # Reading validation set
     dev_data = preprocess(FLAGS.dev_files.split(','),
                           FLAGS.dev_batch_size,
                           Config.n_input,
                           Config.n_context,
                           Config.alphabet,
-                          hdf5_cache_path=FLAGS.dev_cached_features_path)
+                          hdf5_cache_path=FLAGS.dev_cached_features_path,
+                          cache_dir=FLAGS.feature_cache_dir,
+                          workers=FLAGS.preprocess_workers,
+                          chunk_size=FLAGS.preprocess_chunk_size,
+                          task_size=FLAGS.preprocess_task_size,
+                          batch_mfcc=FLAGS.batch_mfcc)
 
     dev_set = DataSet(dev_data,
                       FLAGS.dev_batch_size,
@@ -425,27 +519,62 @@ def train(server=None):
                       next_index=lambda i: coord.get_next_index('dev'))
 
     # Combining all sets to a multi set model feeder
-    model_feeder = ModelFeeder(train_set,
-                               dev_set,
-                               Config.n_input,
-                               Config.n_context,
-                               Config.alphabet,
-                               tower_feeder_count=len(Config.available_devices))
+    if FLAGS.feeder == 'tfdata':
+        model_feeder = DatasetFeeder(train_set,
+                                     dev_set,
+                                     Config.n_input,
+                                     Config.n_context,
+                                     Config.available_devices,
+                                     parallel_calls=FLAGS.feeder_parallel_calls,
+                                     prefetch=FLAGS.feeder_prefetch,
+                                     num_buckets=FLAGS.feeder_buckets,
+                                     batch_tokens=FLAGS.feeder_batch_tokens)
+    else:
+        model_feeder = ModelFeeder(train_set,
+                                   dev_set,
+                                   Config.n_input,
+                                   Config.n_context,
+                                   Config.alphabet,
+                                   tower_feeder_count=len(Config.available_devices))
+
+    # Data parallel training of processes averaging their gradients by ring allreduce
+    ring = None
+    if FLAGS.allreduce_size > 1:
+        ring = Ring(FLAGS.allreduce_rank,
+                    ring_hosts(FLAGS.allreduce_size, FLAGS.allreduce_hosts, FLAGS.allreduce_port),
+                    timeout=FLAGS.allreduce_timeout)
 
     # Create the optimizer
     optimizer = create_optimizer()
 
-    # Synchronous distributed training is facilitated by a special proxy-optimizer
-    if not server is None:
-        optimizer = tf.train.SyncReplicasOptimizer(optimizer,
-                                                   replicas_to_aggregate=FLAGS.replicas_to_agg,
-                                                   total_num_replicas=FLAGS.replicas)
+    # float16 gradients easily underflow, so the loss gets scaled up before differentiation
+    loss_scale = None
+    if FLAGS.precision == 'float16':
+        loss_scale = DynamicLossScale(initial_scale=FLAGS.loss_scale_initial,
+                                      increment_steps=FLAGS.loss_scale_increment_steps)
 
     # Get the data_set specific graph end-points
-    gradients, loss = get_tower_results(model_feeder, optimizer, dropout_rates, drop_source_layers)
+    gradients, loss = get_tower_results(model_feeder, optimizer, dropout_rates, drop_source_layers, loss_scale)
 
     # Average tower gradients across GPUs
-    avg_tower_gradients = average_gradients(gradients)
+    avg_tower_gradients = average_gradients(gradients, compute_dtype(FLAGS.precision))
+    if loss_scale:
+        avg_tower_gradients = loss_scale.unscale_gradients(avg_tower_gradients)
+
+    # Moving averages of the trained weights, saved along with them for --use_ema_weights
+    ema = None
+    if FLAGS.ema_decay > 0:
+        ema = tf.train.ExponentialMovingAverage(FLAGS.ema_decay, num_updates=global_step)
+
+    # Synchronous distributed training is facilitated by a special proxy-optimizer. The towers only
+    # used the wrapped optimizer's compute_gradients(), so the proxy gets created once the variables
+    # exist: with them it lets only the chief update the moving averages, once per aggregated step.
+    if not server is None:
+        optimizer = tf.train.SyncReplicasOptimizer(optimizer,
+                                                   replicas_to_aggregate=FLAGS.replicas_to_agg,
+                                                   total_num_replicas=FLAGS.replicas,
+                                                   variable_averages=ema,
+                                                   variables_to_average=[v for _, v in avg_tower_gradients] if ema else None)
 
     # Add summaries of all variables and gradients to log
     log_grads_and_vars(avg_tower_gradients)
@@ -456,14 +585,56 @@ def train(server=None):
     # These are saved on every step
     step_summaries_op = tf.summary.merge_all('step_summaries')
 
+    summary_dir = FLAGS.summary_dir
+    if ring and ring.rank > 0:
+        summary_dir = os.path.join(summary_dir, 'rank_%d' % ring.rank)
     step_summary_writers = {
-        'train': tf.summary.FileWriter(os.path.join(FLAGS.summary_dir, 'train'), max_queue=120),
-        'dev': tf.summary.FileWriter(os.path.join(FLAGS.summary_dir, 'dev'), max_queue=120)
+        'train': tf.summary.FileWriter(os.path.join(summary_dir, 'train'), max_queue=120),
+        'dev': tf.summary.FileWriter(os.path.join(summary_dir, 'dev'), max_queue=120)
     }
 
     # Apply gradients to modify the model
-    apply_gradient_op = optimizer.apply_gradients(avg_tower_gradients, global_step=global_step)
+    def apply_gradients(grads_and_vars):
+        if ring:
+            grads_and_vars = allreduce_gradients(grads_and_vars, ring, FLAGS.allreduce_fusion_bytes)
+        if loss_scale:
+            # Steps with overflowing gradients get skipped, SyncReplicasOptimizer can't be applied conditionally
+            apply_op = loss_scale.apply_gradients(optimizer, grads_and_vars, global_step, skip_with_cond=server is None)
+        else:
+            apply_op = optimizer.apply_gradients(grads_and_vars, global_step=global_step)
+        # SyncReplicasOptimizer updates the averages itself
+        if ema is None or server is not None:
+            return apply_op
+        # The averages follow the applied updates, not the micro-steps of gradient accumulation
+        with tf.control_dependencies([apply_op]):
+            return ema.apply([v for _, v in grads_and_vars])
+
+    # With gradient accumulation only every n-th training step applies the (accumulated) gradients
+    accumulate_gradient_op = None
+    if FLAGS.gradient_accumulation_steps > 1:
+        gradient_accumulator = GradientAccumulator(avg_tower_gradients, FLAGS.gradient_accumulation_steps,
+                                                   device=Config.worker_device)
+        accumulate_gradient_op = gradient_accumulator.accumulate_op
+        apply_gradient_op = gradient_accumulator.apply_gradients(apply_gradients)
+    else:
+        apply_gradient_op = apply_gradients(avg_tower_gradients)
 
+    # Step level throughput statistics, the input queue depths are taken from the tower feeders
+    # (tf.data pipelines don't expose the fill level of their buffers)
+    queue_sizes = []
+    if isinstance(model_feeder, ModelFeeder):
+        queue_sizes = [tower_feeder._queue.size() for tower_feeder in model_feeder._tower_feeders]
+    throughput = ThroughputMonitor(queue_sizes,
+                                   log_path=FLAGS.throughput_log,
+                                   trace_steps=FLAGS.throughput_trace_steps,
+                                   bottleneck_threshold=FLAGS.input_bottleneck_threshold)
+
+
+    # All ranks start from the (initialized or restored) weights of rank 0
+    broadcast_op = None
+    if ring:
+        broadcast_op = broadcast_variables([v for v in tf.global_variables() if v.dtype.base_dtype == tf.float32],
+                                           ring, FLAGS.allreduce_fusion_bytes)
 
     if FLAGS.early_stop is True and not FLAGS.validation_step > 0:
         log_warn('Parameter --validation_step needs to be >0 for early stopping to work')
@@ -474,6 +645,10 @@ def train(server=None):
         surrounding Python context.
         '''
         def after_create_session(self, session, coord):
+            if broadcast_op is not None:
+                log_debug('Broadcasting weights of rank 0...')
+                session.run(broadcast_op)
+
             log_debug('Starting queue runners...')
             model_feeder.start_queue_threads(session, coord)
             log_debug('Queue runners started.')
@@ -528,24 +703,12 @@ def train(server=None):
             update_progressbar.current_job_index = 0
 
             current_epoch = coord._epoch-1
-            sufix = "graph_noisySVA_CV_2layers_"
-            checkpoint_stash = "/docker_files/ckpt_stash/"
-            checkpoint = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
-            checkpoint_path = checkpoint.model_checkpoint_path
-            ckpt_dest_name = sufix + str(current_epoch-118)+"_eph"
-            str_to_replace = "s/"+checkpoint_path.split('/')[-1]+"/"+ckpt_dest_name+"/"
-
-            subprocess.Popen(["cp",checkpoint_path+ ".meta",checkpoint_stash])
-            #pdb.set_trace()
-            subprocess.Popen(["rename",str_to_replace,checkpoint_stash+checkpoint_path.split('/')[-1]+".meta"])
 
-            subprocess.Popen(["cp",checkpoint_path+ ".data-00000-of-00001",checkpoint_stash])
-            subprocess.Popen(["rename",str_to_replace,checkpoint_stash+checkpoint_path.split('/')[-1]+".data-00000-of-00001"])
-
-            subprocess.Popen(["cp",checkpoint_path+ ".index",checkpoint_stash])
-            subprocess.Popen(["rename",str_to_replace,checkpoint_stash+checkpoint_path.split('/')[-1]+".index"])
-
-	    #HERE
+            # Archive the latest checkpoint of the epoch in the background
+            if checkpoint_stash:
+                checkpoint = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
+                if checkpoint:
+                    checkpoint_stash.submit(checkpoint.model_checkpoint_path, epoch=current_epoch)
 
             if set_name == "train":
                 log_info('Training epoch %i...' % current_epoch)
@@ -568,20 +731,32 @@ def train(server=None):
     # Initialize update_progressbar()'s child fields to safe values
     update_progressbar.pbar = None
 
+    checkpoint_stash = None
+    if FLAGS.checkpoint_stash_dir:
+        checkpoint_stash = CheckpointStash(FLAGS.checkpoint_stash_dir,
+                                           FLAGS.checkpoint_stash_template,
+                                           keep=FLAGS.checkpoint_stash_keep)
+
     ### TRANSFER LEARNING ###
+    # All kept layers of the source model get restored by a single op
+    warmstart = None
+    if FLAGS.source_model_checkpoint_dir:
+        warmstart = Warmstart(FLAGS.source_model_checkpoint_dir,
+                              [v for v in tf.global_variables() if not any(layer in v.op.name for layer in drop_source_layers)],
+                              name_map=parse_name_map(FLAGS.warmstart_name_map),
+                              partial=FLAGS.warmstart_partial)
+
     def init_fn(scaffold, session):
-        if FLAGS.source_model_checkpoint_dir:
-            print('Initializing from', FLAGS.source_model_checkpoint_dir)
-            ckpt = tf.train.load_checkpoint(FLAGS.source_model_checkpoint_dir)
-            variables = list(ckpt.get_variable_to_shape_map().keys())
-            for v in tf.global_variables():
-                if not any(layer in v.op.name for layer in drop_source_layers):
-                    print('Loading', v.op.name)
-                    v.load(ckpt.get_tensor(v.op.name), session=session)
+        if warmstart:
+            log_info('Initializing from {}'.format(FLAGS.source_model_checkpoint_dir))
+            warmstart.run(session)
 
+    # Dropped layers, variables missing in the source model (e.g. moving averages) and partially
+    # warmstarted ones get initialized first, the warmstart then overwrites what it restores
+    restored = set(v.op.name for v in warmstart.restored) if warmstart else set()
     scaffold = tf.train.Scaffold(
         init_op=tf.variables_initializer(
-            [ v for v in tf.global_variables() if any(layer in v.op.name for layer in drop_source_layers) ]
+            [ v for v in tf.global_variables() if v.op.name not in restored ]
         ),
         init_fn=init_fn
     )
@@ -603,11 +778,15 @@ def train(server=None):
             tf.get_default_graph().finalize()
             #do_export = False
             try:
+                # Retrieving global_step from the (potentially restored) model
+                model_feeder.set_data_set(no_dropout_feed_dict, model_feeder.train)
+                step = session.run(global_step, feed_dict=no_dropout_feed_dict)
                 if Config.is_chief:
-                    # Retrieving global_step from the (potentially restored) model
-                    model_feeder.set_data_set(no_dropout_feed_dict, model_feeder.train)
-                    step = session.run(global_step, feed_dict=no_dropout_feed_dict)
                     coord.start_coordination(model_feeder, step)
+
+                # Every worker maps the chief's sample indices from the epoch training resumes in
+                if sampler:
+                    sampler.start(epoch_of_step(step, model_feeder.train.total_batches, batches_per_step))
                     #if do_export:
                     #export(session)
                     #print("########INDISE EXPORT###########")
@@ -616,10 +795,23 @@ def train(server=None):
                 # Get the first job
                 job = coord.get_job()
 
+                # Training steps done by this worker, to know when to apply accumulated gradients
+                micro_step = 0
+                # Epoch of the training batches the measured padding efficiency is collected for
+                padding_epoch = None
+
                 while job and not session.should_stop():
+                    if sidecar and early_stop_requested():
+                        log_info('Early stop requested by the dev set evaluation sidecar')
+                        break
+
                     log_debug('Computing %s...' % job)
 
                     is_train = job.set_name == 'train'
+                    if is_train and job.epoch_id != padding_epoch:
+                        if padding_epoch is not None:
+                            throughput.log_padding_efficiency('train', 'Epoch {}'.format(padding_epoch))
+                        padding_epoch = job.epoch_id
 
                     # The feed_dict (mainly for switching between queues)
                     if is_train:
@@ -654,11 +846,26 @@ def train(server=None):
                             break
 
                         log_debug('Starting batch...')
+                        step_op = train_op
+                        if is_train and accumulate_gradient_op is not None:
+                            micro_step += 1
+                            if micro_step % FLAGS.gradient_accumulation_steps != 0:
+                                step_op = accumulate_gradient_op
+
                         # Compute the batch
-                        _, current_step, batch_loss, step_summary = session.run([train_op, global_step, loss, step_summaries_op], **extra_params)
+                        run_kwargs = dict(extra_params, **throughput.run_kwargs())
+                        step_start = time.time()
+                        _, current_step, batch_loss, step_summary, step_values = \
+                            session.run([step_op, global_step, loss, step_summaries_op, throughput.fetches], **run_kwargs)
+                        step_time = time.time() - step_start
 
                         # Log step summaries
+                        summary_start = time.time()
                         step_summary_writer.add_summary(step_summary, current_step)
+                        summary_time = time.time() - summary_start
+
+                        throughput.step(job.set_name, current_step, step_time, summary_time, step_values,
+                                        step_summary_writer, run_metadata=run_kwargs.get('run_metadata'))
 
                         # Uncomment the next line for debugging race conditions / distributed TF
                         log_debug('Finished batch step %d.' % current_step)
@@ -677,6 +884,9 @@ def train(server=None):
                     log_debug('Sending %s...' % job)
                     job = coord.next_job(job)
 
+                if padding_epoch is not None:
+                    throughput.log_padding_efficiency('train', 'Epoch {}'.format(padding_epoch))
+
                 if update_progressbar.pbar:
                     update_progressbar.pbar.finish()
 		#export()
@@ -720,22 +930,147 @@ def train(server=None):
                   ' or removing the contents of {0}.'.format(FLAGS.checkpoint_dir))
         sys.exit(1)
 
+    throughput.close()
+
+    if checkpoint_stash:
+        checkpoint_stash.close()
+
+    if ring:
+        ring.close()
+
     # Stopping the coordinator
     coord.stop()
 
 
 def test(ckpt_file,test_data):
-    # Reading test set
-    test_data = preprocess(test_data.split(','),
-                           FLAGS.test_batch_size,
-                           Config.n_input,
-                           Config.n_context,
-                           Config.alphabet,
-                           hdf5_cache_path=FLAGS.test_cached_features_path)
+    import evaluate
+
+    from util.feature_cache import preprocess
+
+    with profiler.tags(checkpoint=ckpt_file, csv=test_data):
+        # Reading test set
+        with profiler.stage('preprocess'):
+            test_data = preprocess(test_data.split(','),
+                                   FLAGS.test_batch_size,
+                                   Config.n_input,
+                                   Config.n_context,
+                                   Config.alphabet,
+                                   hdf5_cache_path=FLAGS.test_cached_features_path,
+                                   cache_dir=FLAGS.feature_cache_dir,
+                                   workers=FLAGS.preprocess_workers,
+                                   chunk_size=FLAGS.preprocess_chunk_size,
+                                   task_size=FLAGS.preprocess_task_size,
+                                   batch_mfcc=FLAGS.batch_mfcc,
+                                   with_source=True)
+
+        # Exported models get scored as they are, without building the graph
+        if evaluate.is_exported_model(ckpt_file):
+            samples = evaluate.evaluate(test_data, None, Config.alphabet, None, backend=evaluate.create_backend(ckpt_file))
+        else:
+            if FLAGS.autotune:
+                # Picks the batch size the graph gets built with, cached after the first checkpoint
+                from util.autotune import autotune
+                autotune(test_data, os.path.join(FLAGS.checkpoint_dir, ckpt_file))
+
+            with profiler.stage('graph'):
+                graph = create_inference_graph(batch_size=FLAGS.test_batch_size, n_steps=-1)
+
+            samples = evaluate.evaluate(test_data, graph, Config.alphabet,ckpt_file)
+
+        # Its sessions sized the thread pools, e.g. before a later checkpoint's autotuning
+        from util.autotune import note_sessions_created
+        note_sessions_created()
+
+        # Workers of a sharded evaluation only report once all shards are done
+        if samples is None:
+            return None
+        return evaluate.calculate_totals(samples)
+
+
+def test_sources():
+    r'''
+    Returns the models to test: the exported ones of ``--test_models`` or else the checkpoints
+    of ``--checkpoint_dir``.
+    '''
+    if FLAGS.test_models:
+        return FLAGS.test_models.split(',')
+    ckpt_files = [f for f in sorted(os.listdir(FLAGS.checkpoint_dir)) if os.path.isfile(os.path.join(FLAGS.checkpoint_dir, f)) and '.meta' in f]
+    return [ckpt_file.replace(".meta","") for ckpt_file in ckpt_files]
+
+
+def test_loss_ranking():
+    r'''
+    Ranks the checkpoints of ``--checkpoint_dir`` by their loss on ``--test_files``,
+    see :func:`evaluate.rank_checkpoints_by_loss`.
+    '''
+    import evaluate
+
+    from util.feature_cache import preprocess
+
+    ckpt_files = [f for f in test_sources() if not evaluate.is_exported_model(f)]
+    if len(ckpt_files) < len(test_sources()):
+        log_warn('Exported models have no loss only evaluation, skipping them')
+
+    with profiler.stage('preprocess'):
+        test_data = preprocess(FLAGS.test_files.split(','),
+                               FLAGS.test_batch_size,
+                               Config.n_input,
+                               Config.n_context,
+                               Config.alphabet,
+                               hdf5_cache_path=FLAGS.test_cached_features_path,
+                               cache_dir=FLAGS.feature_cache_dir,
+                               workers=FLAGS.preprocess_workers,
+                               chunk_size=FLAGS.preprocess_chunk_size,
+                               task_size=FLAGS.preprocess_task_size,
+                               batch_mfcc=FLAGS.batch_mfcc)
 
     graph = create_inference_graph(batch_size=FLAGS.test_batch_size, n_steps=-1)
+    return evaluate.rank_checkpoints_by_loss(test_data, graph, [os.path.join(FLAGS.checkpoint_dir, f) for f in ckpt_files])
+
+
+def average_test_checkpoints(ckpt_files):
+    r'''
+    Averages the checkpoints ``ckpt_files`` of ``--checkpoint_dir`` into ``--averaged_checkpoint``
+    next to them, where the test sweep picks it up. Returns its name.
+    '''
+    from util.checkpoint_averaging import average_checkpoints
+
+    log_info('Averaging checkpoints {}'.format(', '.join(ckpt_files)))
+    average_checkpoints([os.path.join(FLAGS.checkpoint_dir, f) for f in ckpt_files],
+                        os.path.join(FLAGS.checkpoint_dir, FLAGS.averaged_checkpoint))
+    return FLAGS.averaged_checkpoint
+
+
+def evaluate_dev_checkpoints():
+    r'''
+    Entry point of the dev set evaluation sidecar started by ``train()``.
+    Scores every new checkpoint on the dev set until training is over.
+    '''
+    import evaluate
+
+    from util.feature_cache import preprocess
+    from util.sidecar import watch_checkpoints
+
+    dev_data = preprocess(FLAGS.dev_files.split(','),
+                          FLAGS.dev_batch_size,
+                          Config.n_input,
+                          Config.n_context,
+                          Config.alphabet,
+                          hdf5_cache_path=FLAGS.dev_cached_features_path,
+                          cache_dir=FLAGS.feature_cache_dir,
+                          workers=FLAGS.preprocess_workers,
+                          chunk_size=FLAGS.preprocess_chunk_size,
+                          task_size=FLAGS.preprocess_task_size,
+                          batch_mfcc=FLAGS.batch_mfcc)
 
-    evaluate.evaluate(test_data, graph, Config.alphabet,ckpt_file)
+    def evaluate_checkpoint(checkpoint_path):
+        graph = create_inference_graph(batch_size=FLAGS.test_batch_size, n_steps=-1)
+        # evaluate() replaces the features by their windows, so it gets its own copy
+        samples = evaluate.evaluate(dev_data.copy(), graph, Config.alphabet, os.path.abspath(checkpoint_path))
+        wer, cer, loss = evaluate.calculate_totals(samples)
+        return {'wer': wer, 'cer': cer, 'loss': loss}
+
+    watch_checkpoints(evaluate_checkpoint)
 
 
 def create_inference_graph(batch_size=1, n_steps=16, tflite=False):
@@ -754,19 +1089,25 @@ def create_inference_graph(batch_size=1, n_steps=16, tflite=False):
 
     no_dropout = [0.0] * 6
 
+    tflite_fused_lstm = tflite and FLAGS.export_tflite_fused_lstm
+    if tflite_fused_lstm and not hasattr(tf, 'lite'):
+        log_warn('TF Lite\'s fused LSTM needs TensorFlow 1.13 or later, unrolling the LSTM instead')
+        tflite_fused_lstm = False
+
     logits, layers = BiRNN(batch_x=input_tensor,
                            seq_length=seq_length if FLAGS.use_seq_length else None,
                            dropout=no_dropout,
                            batch_size=batch_size,
                            n_steps=n_steps,
                            previous_state=previous_state,
-                           tflite=tflite)
+                           tflite=tflite,
+                           tflite_fused_lstm=tflite_fused_lstm)
 
     # TF Lite runtime will check that input dimensions are 1, 2 or 4
-    # by default we get 3, the middle one being batch_size which is forced to
-    # one on inference graph, so remove that dimension
+    # by default we get 3, so time and batch dimension get merged into
+    # a time major [n_steps * batch_size, n_classes] matrix
     if tflite:
-        logits = tf.squeeze(logits, [1])
+        logits = tf.reshape(logits, [-1, Config.n_hidden_6])
 
     # Apply softmax for CTC decoder
     logits = tf.nn.softmax(logits)
@@ -818,18 +1159,25 @@ def export():
     Restores the trained variables into a simpler graph that will be exported for serving.
     '''
     log_info('Exporting the model...')
+    from tensorflow.contrib.lite.python import tflite_convert
+    from tensorflow.python.tools import freeze_graph
+    from util.graph_optimization import convert_to_memmapped, load_graph_def, optimize_graph, write_graph_def
+    from util.tflite_lstm import assign_fused_lstm_weights
+
     with tf.device('/cpu:0'):
         from tensorflow.python.framework.ops import Tensor, Operation
 
         tf.reset_default_graph()
         session = tf.Session(config=Config.session_config)
 
-        inputs, outputs, _ = create_inference_graph(batch_size=1, n_steps=FLAGS.n_steps, tflite=FLAGS.export_tflite)
+        # Only the TF Lite model supports batches, clients of the TensorFlow one feed a single stream
+        batch_size = FLAGS.export_batch_size if FLAGS.export_tflite else 1
+        inputs, outputs, _ = create_inference_graph(batch_size=batch_size, n_steps=FLAGS.n_steps, tflite=FLAGS.export_tflite)
         input_names = ",".join(tensor.op.name for tensor in inputs.values())
         output_names_tensors = [ tensor.op.name for tensor in outputs.values() if isinstance(tensor, Tensor) ]
         output_names_ops = [ tensor.name for tensor in outputs.values() if isinstance(tensor, Operation) ]
         output_names = ",".join(output_names_tensors + output_names_ops)
-	print(output_names)
+        print(output_names)
         input_shapes = ":".join(",".join(map(str, tensor.shape)) for tensor in inputs.values())
 
         if not FLAGS.export_tflite:
@@ -837,18 +1185,36 @@ def export():
         else:
             # Create a saver using variables from the above newly created graph
             def fixup(name):
-                if name.startswith('rnn/lstm_cell/'):
-                    return name.replace('rnn/lstm_cell/', 'lstm_fused_cell/')
+                # The unrolled LSTM cell's kernel and bias are laid out like the ones of training's fused cell
+                if name.startswith('rnn/'):
+                    return 'lstm_fused_cell/' + name.split('/', 2)[2]
                 return name
 
             mapping = {fixup(v.op.name): v for v in tf.global_variables()}
 
-        saver = tf.train.Saver(mapping)
+        # The checkpoint holds the LSTM's weights as the kernel and bias of all gates, TF Lite's fused
+        # cell has per gate variables that get computed from them
+        tflite_fused_lstm = FLAGS.export_tflite and FLAGS.export_tflite_fused_lstm and hasattr(tf, 'lite')
+        if tflite_fused_lstm:
+            export_saver = tf.train.Saver(tf.global_variables())
+            tflite_cell_variables = [v for v in tf.global_variables() if v.op.name.startswith('rnn/')]
+            mapping = {name: v for name, v in mapping.items() if not v.op.name.startswith('rnn/')}
+            with tf.variable_scope('checkpoint_lstm'):
+                mapping['lstm_fused_cell/kernel'] = tf.get_variable('kernel', [Config.n_hidden_3 + Config.n_cell_dim, 4*Config.n_cell_dim])
+                mapping['lstm_fused_cell/bias'] = tf.get_variable('bias', [4*Config.n_cell_dim])
+            assign_tflite_lstm = assign_fused_lstm_weights(mapping['lstm_fused_cell/kernel'],
+                                                           mapping['lstm_fused_cell/bias'],
+                                                           tflite_cell_variables)
 
         # Restore variables from training checkpoint
         checkpoint = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
         checkpoint_path = checkpoint.model_checkpoint_path
 
+        if FLAGS.use_ema_weights:
+            from util.checkpoint_averaging import ema_mapping
+            mapping = ema_mapping(mapping, checkpoint_path)
+        saver = tf.train.Saver(mapping)
+
         output_filename = 'output_graph.pb'
         if FLAGS.remove_export:
             if os.path.isdir(FLAGS.export_dir):
@@ -875,10 +1241,39 @@ def export():
 
             if not FLAGS.export_tflite:
                 do_graph_freeze(output_file=output_graph_path, output_node_names=output_names, variables_blacklist='previous_state_c,previous_state_h')
+
+                if FLAGS.export_optimized:
+                    # Transformed copy of the frozen graph, optionally with memory mapped weights
+                    optimized_graph = optimize_graph(load_graph_def(output_graph_path),
+                                                     input_names.split(','),
+                                                     output_names.split(','),
+                                                     transforms=FLAGS.export_transforms)
+                    optimized_graph_path = os.path.splitext(output_graph_path)[0] + '_optimized.pb'
+                    write_graph_def(optimized_graph, optimized_graph_path)
+                    if FLAGS.export_memmapped:
+                        memmapped_path = os.path.splitext(output_graph_path)[0] + '.pbmm'
+                        if convert_to_memmapped(optimized_graph_path, memmapped_path, tool=FLAGS.export_memmapped_tool):
+                            log_info('Exported model with memory mapped weights as {}'.format(os.path.basename(memmapped_path)))
             else:
                 temp_fd, temp_freeze = tempfile.mkstemp(dir=FLAGS.export_dir)
                 os.close(temp_fd)
+                if tflite_fused_lstm:
+                    # Freezes a checkpoint of the export graph's own variables with the per gate LSTM weights
+                    saver.restore(session, checkpoint_path)
+                    session.run(assign_tflite_lstm)
+                    temp_checkpoint_dir = tempfile.mkdtemp(dir=FLAGS.export_dir)
+                    saver = export_saver
+                    checkpoint_path = saver.save(session, os.path.join(temp_checkpoint_dir, 'export'))
                 do_graph_freeze(output_file=temp_freeze, output_node_names=output_names, variables_blacklist='')
+                if tflite_fused_lstm:
+                    shutil.rmtree(temp_checkpoint_dir)
+                    # Replaces the LSTM's op hints by the stub of the fused op for the converter
+                    frozen_graph = tf.GraphDef()
+                    with tf.gfile.GFile(temp_freeze, 'rb') as fin:
+                        frozen_graph.ParseFromString(fin.read())
+                    frozen_graph = tf.lite.experimental.convert_op_hints_to_stubs(graph_def=frozen_graph)
+                    with tf.gfile.GFile(temp_freeze, 'wb') as fout:
+                        fout.write(frozen_graph.SerializeToString())
                 output_tflite_path = os.path.join(FLAGS.export_dir, output_filename.replace('.pb', '.tflite'))
                 class TFLiteFlags():
                     def __init__(self):
@@ -916,7 +1311,13 @@ def export():
             log_error(str(e))
 
 def do_single_file_inference(input_file_path):
-    with tf.Session(config=Config.session_config) as session:
+    from ds_ctcdecoder import ctc_beam_search_decoder, Scorer
+    from util.audio import audiofile_to_input_vector
+    from util.batch_mfcc import batch_audiofiles_to_input_vectors
+    from util.shared_weights import cpu_session_config, SharedWeights
+
+    session_config = cpu_session_config(Config.session_config) if FLAGS.shared_weights else Config.session_config
+    with tf.Session(config=session_config) as session:
         inputs, outputs, _ = create_inference_graph(batch_size=1, n_steps=-1)
 
         # Create a saver using variables from the above newly created graph
@@ -932,11 +1333,19 @@ def do_single_file_inference(input_file_path):
             exit(1)
 
         checkpoint_path = checkpoint.model_checkpoint_path
-        saver.restore(session, checkpoint_path)
+        weights_feed_dict = {}
+        if FLAGS.shared_weights:
+            weights_feed_dict = SharedWeights(checkpoint_path, mapping, FLAGS.shared_weights_dir,
+                                              keep=FLAGS.shared_weights_keep).feed_dict
+        else:
+            saver.restore(session, checkpoint_path)
 
         session.run(outputs['initialize_state'])
 
-        features = audiofile_to_input_vector(input_file_path, Config.n_input, Config.n_context)
+        if FLAGS.batch_mfcc:
+            features = batch_audiofiles_to_input_vectors([input_file_path], Config.n_input, Config.n_context)[0]
+        else:
+            features = audiofile_to_input_vector(input_file_path, Config.n_input, Config.n_context)
         num_strides = len(features) - (Config.n_context * 2)
 
         # Create a view into the array with overlapping strides of size
@@ -948,10 +1357,12 @@ def do_single_file_inference(input_file_path):
             (features.strides[0], features.strides[0], features.strides[1]),
             writeable=False)
 
-        logits = session.run(outputs['outputs'], feed_dict = {
+        feed_dict = {
             inputs['input']: [features],
             inputs['input_lengths']: [num_strides],
-        })
+        }
+        feed_dict.update(weights_feed_dict)
+        logits = session.run(outputs['outputs'], feed_dict=feed_dict)
 
         logits = np.squeeze(logits)
 
@@ -962,12 +1373,43 @@ def do_single_file_inference(input_file_path):
         # Print highest probability result
         print(decoded[0][1])
 
+        if FLAGS.nbest > 1 or FLAGS.nbest_output_file:
+            from util.nbest import NBestResults
+            nbest = NBestResults(Config.alphabet, scorer)
+            nbest.add(0, decoded[:FLAGS.nbest], logits)
+            for index in range(len(nbest)):
+                print('%d. "%s" score: %f, acoustic: %f, language model: %f' %
+                      (index + 1, nbest.transcript[index], nbest.score[index], nbest.acoustic_score[index], nbest.lm_score[index]))
+                print('   ' + ' '.join('%s@%.2f-%.2f' % word for word in nbest.words(index)))
+            if FLAGS.nbest_output_file:
+                nbest.write(FLAGS.nbest_output_file)
+
 
 def main(_):
     initialize_globals()
 
+    if FLAGS.profile_dir:
+        profiler.enable()
+
+    if FLAGS.autotune_trial:
+        from util.autotune import run_trial
+        run_trial(FLAGS.autotune_trial, create_inference_graph)
+        return
+
+    if FLAGS.sidecar_eval:
+        evaluate_dev_checkpoints()
+        return
+
     if FLAGS.train or FLAGS.test:
         if len(FLAGS.worker_hosts) == 0:
+            if FLAGS.train and FLAGS.allreduce_size > 1:
+                # One of several local tasks exchanging gradients by allreduce, see bin/launch_allreduce.py
+                with tf.Graph().as_default():
+                    train()
+                # Autotuned thread counts can't resize the thread pools training's sessions created
+                from util.autotune import note_sessions_created
+                note_sessions_created()
+
             # Only one local task: this process (default case - no cluster)
             #with tf.Graph().as_default():
                 #train()
@@ -975,22 +1417,46 @@ def main(_):
 	    #    export()
             # Now do a final test epoch
             if FLAGS.test:
-                print("$$$$$$$$$ Testing on entire test dataset $$$$$$$$$$")
-                ckpt_files = [f for f in sorted(os.listdir(FLAGS.checkpoint_dir)) if os.path.isfile(os.path.join(FLAGS.checkpoint_dir, f)) and '.meta' in f]
-                for ckpt_file in ckpt_files:
-                    print("************* Testing on ckpt file: "+ckpt_file+"   ***************")
+                averaging = not FLAGS.test_models
+                if averaging and FLAGS.average_checkpoints:
+                    from util.checkpoint_averaging import checkpoints_matching
+                    # The average gets tested along with the checkpoints it is made of
+                    ckpt_files = [os.path.basename(path) for path in checkpoints_matching(FLAGS.checkpoint_dir, FLAGS.average_checkpoints)]
+                    ckpt_files = [f for f in ckpt_files if f != FLAGS.averaged_checkpoint]
+                    if ckpt_files:
+                        with tf.Graph().as_default():
+                            average_test_checkpoints(ckpt_files)
+                        from util.autotune import note_sessions_created
+                        note_sessions_created()
+                    else:
+                        log_warn('No checkpoints match --average_checkpoints {}'.format(FLAGS.average_checkpoints))
+
+                results = {}
+                if FLAGS.test_loss_only:
+                    # Ranks the checkpoints by loss, decoding none of them
                     with tf.Graph().as_default():
-                        test(ckpt_file.replace(".meta",""),FLAGS.test_files)
-                    log_debug('Done.')
-                for test_file in FLAGS.test_files.split(","):
-                    print("$$$$$$$$$ Testing on "+test_file+" dataset $$$$$$$$$$")
-                    ckpt_files = [f for f in sorted(os.listdir(FLAGS.checkpoint_dir)) if os.path.isfile(os.path.join(FLAGS.checkpoint_dir, f)) and '.meta' in f]
-                    for ckpt_file in ckpt_files:
+                        test_loss_ranking()
+                    # Averaging the best checkpoints needs their WERs
+                    averaging = False
+                else:
+                    # Results of each test CSV file are reported from the same pass
+                    print("$$$$$$$$$ Testing on entire test dataset $$$$$$$$$$")
+                    for ckpt_file in test_sources():
                         print("************* Testing on ckpt file: "+ckpt_file+"   ***************")
                         with tf.Graph().as_default():
-                            test(ckpt_file.replace(".meta",""),test_file)
+                            results[ckpt_file] = test(ckpt_file,FLAGS.test_files)
                         log_debug('Done.')
 
+                # Averages the checkpoints of the lowest WERs
+                ranked = sorted((f for f in results if f != FLAGS.averaged_checkpoint and results[f] is not None),
+                                key=lambda f: results[f][0])
+                if averaging and FLAGS.average_best_k > 1 and len(ranked) > 1:
+                    averaged = average_test_checkpoints(sorted(ranked[:FLAGS.average_best_k]))
+                    print("************* Testing on ckpt file: "+averaged+"   ***************")
+                    with tf.Graph().as_default():
+                        test(averaged,FLAGS.test_files)
+                    log_debug('Done.')
+
         else:
             # Create and start a server for the local task.
             server = tf.train.Server(Config.cluster, job_name=FLAGS.job_name, task_index=FLAGS.task_index)
@@ -1031,6 +1497,9 @@ def main(_):
     if len(FLAGS.one_shot_infer):
         do_single_file_inference(FLAGS.one_shot_infer)
 
+    profiler.write(FLAGS.profile_dir, chrome_trace=FLAGS.profile_chrome_trace)
+
 if __name__ == '__main__' :
     create_flags()
+    create_extra_flags()
     tf.app.run(main)
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function
+
+# Make sure we can import stuff from util/
+# This script needs to be run from the root of the DeepSpeech repository
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import argparse
+
+from util.checkpoint_averaging import average_checkpoints, checkpoints_matching
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Writes the average of the variables of several checkpoints as a new '
+                                                 'checkpoint, e.g. to test with DeepSpeech.py --test')
+    parser.add_argument('checkpoint_dir', help='directory of the checkpoints to average')
+    parser.add_argument('--pattern', type=str, default='model.ckpt-*', help='shell pattern of the checkpoint names to average')
+    parser.add_argument('--last', type=int, default=0, help='only average the last N matching checkpoints by global step - 0 means all')
+    parser.add_argument('--checkpoints', type=str, default='', help='comma separated checkpoint names to average instead of --pattern')
+    parser.add_argument('--output', type=str, default='averaged.ckpt', help='name of the averaged checkpoint in checkpoint_dir')
+    args = parser.parse_args()
+
+    if args.checkpoints:
+        paths = [os.path.join(args.checkpoint_dir, name) for name in args.checkpoints.split(',')]
+    else:
+        paths = checkpoints_matching(args.checkpoint_dir, args.pattern)
+        paths = [path for path in paths if os.path.basename(path) != args.output]
+        if args.last > 0:
+            paths = paths[-args.last:]
+    if not paths:
+        print('No checkpoints to average in "%s"' % args.checkpoint_dir)
+        sys.exit(1)
+
+    for path in paths:
+        print('Averaging %s' % path)
+    average_checkpoints(paths, os.path.join(args.checkpoint_dir, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function
+
+# Make sure we can import stuff from util/
+# This script needs to be run from the root of the DeepSpeech repository
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import argparse
+import json
+import multiprocessing
+import numpy as np
+import socket
+import time
+
+from collections import OrderedDict
+from util.allreduce import Ring, parse_address, ring_hosts, receive_into
+
+
+def gradient_sizes(n_hidden, n_input=26, n_context=9, n_classes=29):
+    r'''
+    Element counts of the gradients of the acoustic model's variables, in the order of BiRNN().
+    '''
+    n_features = n_input + 2*n_input*n_context
+    sizes = [n_features * n_hidden, n_hidden,          # h1, b1
+             n_hidden * n_hidden, n_hidden,            # h2, b2
+             n_hidden * n_hidden, n_hidden,            # h3, b3
+             2 * n_hidden * 4 * n_hidden, 4 * n_hidden, # LSTM kernel and bias
+             n_hidden * n_hidden, n_hidden,            # h5, b5
+             n_hidden * n_classes, n_classes]          # h6, b6
+    return sizes
+
+
+def fuse(sizes, fusion_bytes):
+    buckets = [0]
+    for size in sizes:
+        if buckets[-1] and 4 * (buckets[-1] + size) > fusion_bytes:
+            buckets.append(0)
+        buckets[-1] += size
+    return buckets
+
+
+def compute(ms, work):
+    # Stands in for the forward and backward pass, keeping a core busy for ``ms`` milliseconds
+    end = time.time() + ms / 1000.
+    while time.time() < end:
+        np.dot(work, work)
+
+
+class ParameterServerClient(object):
+    r'''
+    Worker side of a parameter server style exchange: every server owns one shard of each buffer,
+    sums the shards of all workers and returns their mean. This is a NumPy model of the traffic
+    pattern of parameter servers, not TensorFlow's distributed training (``--ps_hosts``), which
+    additionally pulls the variables every step and aggregates in ``SyncReplicasOptimizer``.
+    '''
+    def __init__(self, addresses):
+        self._servers = []
+        for address in addresses:
+            while True:
+                try:
+                    self._servers.append(socket.create_connection(parse_address(address)))
+                    break
+                except (IOError, OSError):
+                    time.sleep(0.1)
+
+    def allreduce_mean(self, array):
+        shards = np.array_split(np.ascontiguousarray(array, dtype=np.float32), len(self._servers))
+        for server, shard in zip(self._servers, shards):
+            server.sendall(shard.view(np.uint8))
+        result = []
+        for server, shard in zip(self._servers, shards):
+            mean = np.empty_like(shard)
+            receive_into(server, memoryview(mean.view(np.uint8)))
+            result.append(mean)
+        return np.concatenate(result)
+
+    def close(self):
+        for server in self._servers:
+            server.close()
+
+
+def parameter_server(index, address, num_workers, num_servers, buffer_sizes, steps):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(parse_address(address))
+    listener.listen(num_workers)
+    workers = [listener.accept()[0] for _ in range(num_workers)]
+    shard_sizes = [len(np.array_split(np.empty(size), num_servers)[index]) for size in buffer_sizes]
+    for _ in range(steps):
+        for shard_size in shard_sizes:
+            total = np.zeros(shard_size, dtype=np.float32)
+            received = np.empty(shard_size, dtype=np.float32)
+            for worker in workers:
+                receive_into(worker, memoryview(received.view(np.uint8)))
+                total += received
+            total /= num_workers
+            for worker in workers:
+                worker.sendall(total.view(np.uint8))
+    for worker in workers:
+        worker.close()
+    listener.close()
+
+
+def worker(rank, num_workers, mode, addresses, buffer_sizes, args, results):
+    exchange = None
+    if num_workers > 1:
+        exchange = ParameterServerClient(addresses) if mode == 'ps' else Ring(rank, addresses)
+
+    rng = np.random.RandomState(rank)
+    buffers = [rng.randn(size).astype(np.float32) for size in buffer_sizes]
+    work = rng.randn(256, 256)
+    step_times = []
+    exchange_times = []
+    for step in range(args.warmup + args.steps):
+        start = time.time()
+        compute(args.compute_ms, work)
+        exchange_start = time.time()
+        if exchange:
+            for buffer in buffers:
+                exchange.allreduce_mean(buffer)
+        if step >= args.warmup:
+            step_times.append(time.time() - start)
+            exchange_times.append(time.time() - exchange_start)
+    if exchange:
+        exchange.close()
+    results.put((rank, float(np.mean(step_times)), float(np.mean(exchange_times))))
+
+
+def run(mode, num_workers, buffer_sizes, args):
+    r'''
+    Runs ``num_workers`` local worker processes exchanging ``buffer_sizes`` buffers per step,
+    returns their mean step and exchange times in seconds.
+    '''
+    port = args.port
+    servers = []
+    if mode == 'ps' and num_workers > 1:
+        addresses = ['127.0.0.1:%d' % (port + i) for i in range(args.ps)]
+        servers = [multiprocessing.Process(target=parameter_server,
+                                           args=(i, address, num_workers, args.ps, buffer_sizes, args.warmup + args.steps))
+                   for i, address in enumerate(addresses)]
+    else:
+        addresses = ring_hosts(num_workers, port=port)
+    # Each run gets fresh ports, so sockets of the previous one lingering in TIME_WAIT don't matter
+    args.port += max(num_workers, args.ps)
+
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=worker, args=(rank, num_workers, mode, addresses, buffer_sizes, args, results))
+               for rank in range(num_workers)]
+    for process in servers + workers:
+        process.start()
+    measurements = [results.get() for _ in workers]
+    for process in servers + workers:
+        process.join()
+    return max(m[1] for m in measurements), float(np.mean([m[2] for m in measurements]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic comparison of ring allreduce with a parameter server style '
+                                                 'gradient exchange between local processes, reporting their scaling '
+                                                 'efficiency. Compute is simulated by busy CPU work and the "ps" mode '
+                                                 'models the parameter servers\' traffic in NumPy, so the numbers '
+                                                 'compare exchange patterns, not TensorFlow\'s distributed training.')
+    parser.add_argument('--workers', type=str, default='1,2,4', help='comma separated numbers of worker processes')
+    parser.add_argument('--modes', type=str, default='ps,ring,ring_unfused', help='comma separated exchange modes - '
+                        '"ps" (simulated parameter servers), "ring" (fused ring allreduce) and "ring_unfused" (one ring allreduce per tensor)')
+    parser.add_argument('--ps', type=int, default=1, help='number of parameter server processes of the "ps" mode')
+    parser.add_argument('--n_hidden', type=int, default=2048, help='layer width of the model whose gradients get exchanged')
+    parser.add_argument('--fusion_bytes', type=int, default=64 * 2**20, help='size of the fused buffers of the "ring" mode')
+    parser.add_argument('--compute_ms', type=float, default=500., help='milliseconds of busy CPU work standing in for the '
+                        'forward and backward pass of each step')
+    parser.add_argument('--steps', type=int, default=10, help='number of timed steps')
+    parser.add_argument('--warmup', type=int, default=2, help='number of untimed steps')
+    parser.add_argument('--port', type=int, default=29500, help='first local port to use')
+    parser.add_argument('--output', type=str, default='', help='path of the JSON file to write the results to')
+    args = parser.parse_args()
+
+    sizes = gradient_sizes(args.n_hidden)
+    print('Exchanging %.1f MB of gradients per step' % (4 * sum(sizes) / 2.**20))
+
+    # Single process steps need no exchange, their time is the baseline of all modes
+    baseline, _ = run('ring', 1, sizes, args)
+
+    results = []
+    for mode in args.modes.split(','):
+        buffer_sizes = fuse(sizes, args.fusion_bytes) if mode == 'ring' else sizes
+        for num_workers in [int(n) for n in args.workers.split(',')]:
+            step_time, exchange_time = run(mode, num_workers, buffer_sizes, args)
+            results.append(OrderedDict([
+                ('mode', mode),
+                ('workers', num_workers),
+                ('step_ms', step_time * 1000.),
+                ('exchange_ms', exchange_time * 1000.),
+                ('steps_per_sec', num_workers / step_time),
+                ('scaling_efficiency', baseline / step_time),
+            ]))
+
+    print('Synthetic comparison: %.0f ms of simulated compute per step, "ps" is a NumPy model of parameter servers'
+          % args.compute_ms)
+    print('%14s %8s %10s %12s %10s %11s' % ('mode', 'workers', 'step ms', 'exchange ms', 'steps/s', 'efficiency'))
+    for r in results:
+        print('%14s %8d %10.1f %12.1f %10.2f %10.1f%%' % (r['mode'], r['workers'], r['step_ms'], r['exchange_ms'],
+                                                          r['steps_per_sec'], 100. * r['scaling_efficiency']))
+
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(OrderedDict([('synthetic', True),
+                                   ('n_hidden', args.n_hidden),
+                                   ('compute_ms', args.compute_ms),
+                                   ('single_process_step_ms', baseline * 1000.),
+                                   ('results', results)]), fout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function
+
+# Make sure we can import stuff from util/
+# This script needs to be run from the root of the DeepSpeech repository
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import argparse
+import json
+import numpy as np
+import subprocess
+import time
+
+from collections import OrderedDict
+
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+
+def benchmark_graph(path, iterations, seed=0):
+    r'''
+    Measures the cold load of the frozen graph ``path`` (parsing, importing and creating a session)
+    and the latency of its first and following runs on random features.
+    '''
+    start = time.time()
+    import tensorflow as tf
+    from util.graph_optimization import load_graph_def
+    import_seconds = time.time() - start
+
+    start = time.time()
+    graph_def = load_graph_def(path)
+    parse_seconds = time.time() - start
+
+    start = time.time()
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    session = tf.Session(graph=graph)
+    load_seconds = time.time() - start
+
+    input_node = graph.get_tensor_by_name('input_node:0')
+    input_lengths = graph.get_tensor_by_name('input_lengths:0')
+    logits = graph.get_tensor_by_name('logits:0')
+    initialize_state = graph.get_operation_by_name('initialize_state')
+
+    shape = [d if d is not None else 16 for d in input_node.get_shape().as_list()]
+    features = np.random.RandomState(seed).randn(*shape).astype(np.float32)
+    feed_dict = {input_node: features, input_lengths: [shape[1]] * shape[0]}
+
+    start = time.time()
+    session.run(initialize_state)
+    session.run(logits, feed_dict=feed_dict)
+    first_run_seconds = time.time() - start
+
+    latencies = []
+    for _ in range(iterations):
+        start = time.time()
+        session.run(logits, feed_dict=feed_dict)
+        latencies.append(time.time() - start)
+
+    return OrderedDict([
+        ('graph', os.path.basename(path)),
+        ('file_mb', os.path.getsize(path) / 2.**20),
+        ('nodes', len(graph_def.node)),
+        ('tensorflow_import_s', import_seconds),
+        ('parse_s', parse_seconds),
+        ('load_s', load_seconds),
+        ('first_run_s', first_run_seconds),
+        ('cold_start_s', parse_seconds + load_seconds + first_run_seconds),
+        ('latency_ms', 1000. * float(np.mean(latencies))),
+        ('latency_p90_ms', 1000. * float(np.percentile(latencies, 90))),
+    ])
+
+
+def run_child(path, iterations):
+    # Every graph gets a fresh process, so nothing is cached from loading another one
+    output = subprocess.check_output([sys.executable, sys.argv[0], '--child', path, '--iterations', str(iterations)])
+    for line in output.decode('utf-8').splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):], object_pairs_hook=OrderedDict)
+    raise RuntimeError('Benchmark of {} reported no result'.format(path))
+
+
+def time_native_client(client, model, alphabet, audio, repeat):
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call([client, '--model', model, '--alphabet', alphabet, '--audio', audio], stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+    return float(np.median(times))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares cold load time and latency of the plain and optimized exported models')
+    parser.add_argument('export_dir', nargs='?', default='', help='directory with the output_graph*.pb files written by --export_dir')
+    parser.add_argument('--iterations', type=int, default=20, help='number of timed runs per graph')
+    parser.add_argument('--native_client', type=str, default='', help='path of the deepspeech client binary to also time whole '
+                        'transcriptions with, the only way to load the memory mapped .pbmm model')
+    parser.add_argument('--alphabet', type=str, default='data/alphabet.txt', help='alphabet file for --native_client')
+    parser.add_argument('--audio', type=str, default='', help='WAV file for --native_client')
+    parser.add_argument('--repeat', type=int, default=5, help='number of --native_client runs per model, the median is reported')
+    parser.add_argument('--output', type=str, default='', help='path of the JSON file to write the results to')
+    parser.add_argument('--child', type=str, default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(RESULT_PREFIX + json.dumps(benchmark_graph(args.child, args.iterations)))
+        return
+
+    graphs = [os.path.join(args.export_dir, name) for name in ('output_graph.pb', 'output_graph_optimized.pb')]
+    graphs = [path for path in graphs if os.path.isfile(path)]
+    if not graphs:
+        print('No exported graphs found in "%s"' % args.export_dir)
+        sys.exit(1)
+
+    results = [run_child(path, args.iterations) for path in graphs]
+
+    print('%-28s %8s %7s %9s %9s %11s %12s %11s' % ('graph', 'MB', 'nodes', 'parse s', 'load s', 'first run s',
+                                                   'cold start s', 'latency ms'))
+    for r in results:
+        print('%-28s %8.1f %7d %9.3f %9.3f %11.3f %12.3f %11.2f' % (r['graph'], r['file_mb'], r['nodes'], r['parse_s'],
+                                                                   r['load_s'], r['first_run_s'], r['cold_start_s'],
+                                                                   r['latency_ms']))
+
+    native = OrderedDict()
+    if args.native_client and args.audio:
+        for name in ('output_graph.pb', 'output_graph_optimized.pb', 'output_graph.pbmm'):
+            model = os.path.join(args.export_dir, name)
+            if os.path.isfile(model):
+                native[name] = time_native_client(args.native_client, model, args.alphabet, args.audio, args.repeat)
+                print('%s transcription with %s: %.3fs' % (os.path.basename(args.native_client), name, native[name]))
+
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(OrderedDict([('results', results), ('native_client_s', native)]), fout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function
+
+# Make sure we can import stuff from util/
+# This script needs to be run from the root of the DeepSpeech repository
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import itertools
+import json
+import numpy as np
+import platform
+import tensorflow as tf
+import time
+
+from collections import OrderedDict
+from DeepSpeech import create_inference_graph
+from ds_ctcdecoder import ctc_beam_search_decoder_batch, Scorer
+from evaluate import pad_to_dense
+from multiprocessing import cpu_count
+from util.audio import audioToInputVector
+from util.config import Config, initialize_globals
+from util.extra_flags import create_extra_flags
+from util.flags import create_flags, FLAGS
+from util.logging import log_info, log_warn
+
+SAMPLE_RATE = 16000
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def synthetic_features(rng, seconds):
+    r'''
+    Computes the windowed features of ``seconds`` of synthetic audio,
+    in the layout fed to the inference graph.
+    '''
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    signal = sum(np.sin(2 * np.pi * f * t) for f in rng.uniform(100, 3000, 4)) / 4. + 0.1 * rng.randn(len(t))
+    features = audioToInputVector((signal * 10000).astype(np.int16), SAMPLE_RATE, Config.n_input, Config.n_context)
+    num_strides = len(features) - (Config.n_context * 2)
+    window_size = 2*Config.n_context+1
+    return np.lib.stride_tricks.as_strided(
+        features,
+        (num_strides, window_size, Config.n_input),
+        (features.strides[0], features.strides[0], features.strides[1]),
+        writeable=False)
+
+
+def latency_stats(latencies):
+    return OrderedDict([
+        ('mean', float(np.mean(latencies))),
+        ('p50', float(np.percentile(latencies, 50))),
+        ('p90', float(np.percentile(latencies, 90))),
+        ('max', float(np.max(latencies))),
+    ])
+
+
+def run_acoustic_model(session, inputs, outputs, features, features_len, n_steps):
+    r'''
+    Computes the batch major softmax outputs of a batch. Graphs with a fixed
+    number of time steps are fed chunk by chunk, carrying over the LSTM state.
+    '''
+    session.run(outputs['initialize_state'])
+    if n_steps <= 0:
+        logits = session.run(outputs['outputs'], feed_dict={
+            inputs['input']: features,
+            inputs['input_lengths']: features_len,
+        })
+    else:
+        chunks = []
+        for start in range(0, features.shape[1], n_steps):
+            chunk = features[:, start:start + n_steps]
+            if chunk.shape[1] < n_steps:
+                chunk = np.pad(chunk, [(0, 0), (0, n_steps - chunk.shape[1]), (0, 0), (0, 0)], 'constant')
+            chunks.append(session.run(outputs['outputs'], feed_dict={
+                inputs['input']: chunk,
+                inputs['input_lengths']: np.clip(features_len - start, 0, n_steps),
+            }))
+        logits = np.concatenate(chunks)
+    return np.transpose(logits, [1, 0, 2])
+
+
+def benchmark_acoustic_model(batch_size, n_steps, seconds):
+    rng = np.random.RandomState(FLAGS.random_seed)
+    batch = [synthetic_features(rng, seconds) for _ in range(batch_size)]
+    features = pad_to_dense(batch)
+    features_len = np.array([len(f) for f in batch], dtype=np.int32)
+
+    with tf.Graph().as_default():
+        # Randomly initialized model, seeded for reproducible runs
+        tf.set_random_seed(FLAGS.random_seed)
+        inputs, outputs, _ = create_inference_graph(batch_size=batch_size, n_steps=n_steps)
+        with tf.Session(config=Config.session_config) as session:
+            session.run(tf.global_variables_initializer())
+
+            for _ in range(FLAGS.bench_warmup):
+                logits = run_acoustic_model(session, inputs, outputs, features, features_len, n_steps)
+
+            latencies = []
+            for _ in range(FLAGS.bench_iterations):
+                start = time.time()
+                logits = run_acoustic_model(session, inputs, outputs, features, features_len, n_steps)
+                latencies.append(time.time() - start)
+
+    audio_seconds = batch_size * seconds
+    return logits, features_len, OrderedDict([
+        ('latency', latency_stats(latencies)),
+        ('utterances_per_sec', batch_size / np.mean(latencies)),
+        ('real_time_factor', np.mean(latencies) / audio_seconds),
+    ])
+
+
+def benchmark_decoder(logits, features_len, beam_width, scorer, num_processes):
+    latencies = []
+    for _ in range(FLAGS.bench_iterations):
+        start = time.time()
+        ctc_beam_search_decoder_batch(logits, features_len, Config.alphabet, beam_width,
+                                      num_processes=num_processes, scorer=scorer)
+        latencies.append(time.time() - start)
+    return OrderedDict([
+        ('latency', latency_stats(latencies)),
+        ('utterances_per_sec', len(logits) / np.mean(latencies)),
+    ])
+
+
+def config_key(result):
+    return tuple(result[key] for key in ('batch_size', 'n_steps', 'seconds', 'beam_width', 'scorer'))
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    r'''
+    Returns descriptions of all results whose throughput dropped by more than ``tolerance``
+    (a fraction) compared to the matching configuration in ``baseline``.
+    '''
+    baseline = {config_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        previous = baseline.get(config_key(result))
+        if previous is None:
+            continue
+        for part in ('acoustic', 'decoder'):
+            current_rate = result[part]['utterances_per_sec']
+            previous_rate = previous[part]['utterances_per_sec']
+            if current_rate < previous_rate * (1. - tolerance):
+                regressions.append('{} {}: {:.2f} utt/s, baseline {:.2f} utt/s'.format(
+                    part, dict(zip(('batch_size', 'n_steps', 'seconds', 'beam_width', 'scorer'), config_key(result))),
+                    current_rate, previous_rate))
+    return regressions
+
+
+def main(_):
+    initialize_globals()
+
+    try:
+        num_processes = cpu_count()
+    except NotImplementedError:
+        num_processes = 1
+
+    scorers = [None]
+    if FLAGS.bench_scorer:
+        if os.path.isfile(FLAGS.lm_binary_path) and os.path.isfile(FLAGS.lm_trie_path):
+            scorers.append(Scorer(FLAGS.lm_alpha, FLAGS.lm_beta,
+                                  FLAGS.lm_binary_path, FLAGS.lm_trie_path,
+                                  Config.alphabet))
+        else:
+            log_warn('Language model files not found, benchmarking without scorer only')
+
+    results = []
+    for batch_size, n_steps, seconds in itertools.product(int_list(FLAGS.bench_batch_sizes),
+                                                          int_list(FLAGS.bench_n_steps),
+                                                          [float(s) for s in FLAGS.bench_seconds.split(',')]):
+        log_info('Acoustic model: batch_size={} n_steps={} seconds={}'.format(batch_size, n_steps, seconds))
+        logits, features_len, acoustic = benchmark_acoustic_model(batch_size, n_steps, seconds)
+
+        for beam_width, scorer in itertools.product(int_list(FLAGS.bench_beam_widths), scorers):
+            log_info('Decoder: beam_width={} scorer={}'.format(beam_width, scorer is not None))
+            decoder = benchmark_decoder(logits, features_len, beam_width, scorer, num_processes)
+            end_to_end = acoustic['latency']['mean'] + decoder['latency']['mean']
+            results.append(OrderedDict([
+                ('batch_size', batch_size),
+                ('n_steps', n_steps),
+                ('seconds', seconds),
+                ('beam_width', beam_width),
+                ('scorer', scorer is not None),
+                ('acoustic', acoustic),
+                ('decoder', decoder),
+                ('real_time_factor', end_to_end / (batch_size * seconds)),
+                ('utterances_per_sec', batch_size / end_to_end),
+            ]))
+
+    print('%10s %8s %8s %6s %7s %10s %10s %10s %8s' % ('batch_size', 'n_steps', 'seconds', 'beam', 'scorer',
+                                                     'am utt/s', 'dec utt/s', 'latency', 'RTF'))
+    for r in results:
+        print('%10d %8d %8.1f %6d %7s %10.2f %10.2f %10.4f %8.4f' % (r['batch_size'], r['n_steps'], r['seconds'],
+                                                                  r['beam_width'], r['scorer'],
+                                                                  r['acoustic']['utterances_per_sec'],
+                                                                  r['decoder']['utterances_per_sec'],
+                                                                  r['acoustic']['latency']['mean'] + r['decoder']['latency']['mean'],
+                                                                  r['real_time_factor']))
+
+    report = OrderedDict([
+        ('host', platform.node()),
+        ('cpu_count', num_processes),
+        ('tensorflow', tf.__version__),
+        ('n_hidden', FLAGS.n_hidden),
+        ('results', results),
+    ])
+    if FLAGS.bench_output:
+        with open(FLAGS.bench_output, 'w') as fout:
+            json.dump(report, fout, indent=2)
+
+    if FLAGS.bench_baseline:
+        with open(FLAGS.bench_baseline) as fin:
+            regressions = compare_to_baseline(results, json.load(fin), FLAGS.bench_tolerance)
+        for regression in regressions:
+            log_warn('Regression - {}'.format(regression))
+        if regressions:
+            sys.exit(1)
+        log_info('No regressions against {}'.format(FLAGS.bench_baseline))
+
+
+if __name__ == '__main__':
+    create_flags()
+    create_extra_flags()
+    f = tf.app.flags
+    f.DEFINE_string('bench_batch_sizes', '1,8,32', 'comma separated batch sizes to benchmark')
+    f.DEFINE_string('bench_n_steps', '-1,16', 'comma separated numbers of time steps of the inference graph, -1 for dynamic length')
+    f.DEFINE_string('bench_seconds', '2,10', 'comma separated durations of the synthetic utterances in seconds')
+    f.DEFINE_string('bench_beam_widths', '16,500', 'comma separated decoder beam widths to benchmark')
+    f.DEFINE_boolean('bench_scorer', True, 'also benchmark decoding with the language model given by --lm_binary_path and --lm_trie_path')
+    f.DEFINE_integer('bench_warmup', 1, 'number of untimed runs per configuration')
+    f.DEFINE_integer('bench_iterations', 5, 'number of timed runs per configuration')
+    f.DEFINE_string('bench_output', '', 'path of the JSON file to write the results to')
+    f.DEFINE_string('bench_baseline', '', 'path of a JSON file written by --bench_output to compare the results against')
+    f.DEFINE_float('bench_tolerance', 0.1, 'fraction of throughput a configuration may lose against --bench_baseline before it counts as regression')
+    tf.app.run(main)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function
+
+# Make sure we can import stuff from util/
+# This script needs to be run from the root of the DeepSpeech repository
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import argparse
+import numpy as np
+import timeit
+
+from util.audio import audioToInputVector
+from util.batch_mfcc import BatchMFCC
+
+
+def synthetic_audio(rng, seconds, samplerate):
+    # A few sweeping tones over noise, scaled to the int16 range of 16 bit WAV files
+    t = np.arange(int(seconds * samplerate)) / samplerate
+    signal = sum(np.sin(2 * np.pi * f * t * (1 + 0.1 * t)) for f in rng.uniform(100, 3000, 4))
+    signal = signal / 4. + 0.1 * rng.randn(len(t))
+    return (signal * 10000).astype(np.int16)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the per-file MFCC front-end with the batched one')
+    parser.add_argument('--utterances', type=int, default=64, help='number of synthetic utterances')
+    parser.add_argument('--min_seconds', type=float, default=1.0, help='minimum utterance duration')
+    parser.add_argument('--max_seconds', type=float, default=10.0, help='maximum utterance duration')
+    parser.add_argument('--samplerate', type=int, default=16000, help='sample rate of the synthetic audio')
+    parser.add_argument('--numcep', type=int, default=26, help='number of cepstral coefficients')
+    parser.add_argument('--numcontext', type=int, default=9, help='number of context frames')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs, the best one is reported')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    audios = [synthetic_audio(rng, seconds, args.samplerate)
+              for seconds in rng.uniform(args.min_seconds, args.max_seconds, args.utterances)]
+
+    def per_file():
+        return [audioToInputVector(audio, args.samplerate, args.numcep, args.numcontext) for audio in audios]
+
+    batched_mfcc = BatchMFCC(args.samplerate, args.numcep, args.numcontext)
+    def batched():
+        return batched_mfcc(audios)
+
+    reference = per_file()
+    result = batched()
+    max_error = max(np.max(np.abs(a - b)) for a, b in zip(reference, result))
+    if any(a.shape != b.shape for a, b in zip(reference, result)) or not all(np.allclose(a, b) for a, b in zip(reference, result)):
+        print('Batched features do not match the per-file ones (max abs error {})'.format(max_error))
+        sys.exit(1)
+
+    frames = sum(len(features) - 2*args.numcontext for features in reference)
+    print('{} utterances, {} frames, max abs error {:.3g}'.format(len(audios), frames, max_error))
+    for name, fn in [('per-file', per_file), ('batched', batched)]:
+        seconds = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        print('{:>10}: {:8.3f}s {:12.0f} frames/s'.format(name, seconds, frames / seconds))
+
+
+if __name__ == '__main__':
+    main()
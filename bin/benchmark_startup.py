@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function
+
+# Make sure we can import stuff from util/
+# This script needs to be run from the root of the DeepSpeech repository
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import argparse
+import numpy as np
+import shlex
+import subprocess
+import time
+
+# Modules imported by DeepSpeech.py at load time and the ones only its modes import
+MODULES = [
+    'tensorflow',
+    'DeepSpeech',
+    'evaluate',
+    'ds_ctcdecoder',
+    'progressbar',
+    'tensorflow.contrib.lite.python.tflite_convert',
+    'tensorflow.python.tools.freeze_graph',
+    'util.audio',
+    'util.coordinator',
+    'util.feature_cache',
+    'util.feeding',
+]
+
+
+def time_command(argv, repeat, cwd):
+    r'''
+    Returns the wall times in seconds of ``repeat`` runs of ``argv``.
+    '''
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call(argv, cwd=cwd, stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the startup time of DeepSpeech.py and the import time of '
+                                                 'the modules it needs for its different modes')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs per measurement, the median is reported')
+    parser.add_argument('--modules', type=str, default=','.join(MODULES), help='comma separated modules to time the import of')
+    parser.add_argument('--command', action='append', default=[],
+                        help='DeepSpeech.py arguments of a run to time, e.g. "--one_shot_infer test.wav --checkpoint_dir ckpt", '
+                             'may be given multiple times')
+    args = parser.parse_args()
+
+    root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    env_python = [sys.executable]
+
+    baseline = np.median(time_command(env_python + ['-c', 'pass'], args.repeat, root))
+    print('Python interpreter startup: %.3fs' % baseline)
+
+    print('%-50s %10s' % ('module', 'import s'))
+    for module in args.modules.split(','):
+        try:
+            seconds = np.median(time_command(env_python + ['-c', 'import %s' % module], args.repeat, root)) - baseline
+        except subprocess.CalledProcessError:
+            print('%-50s %10s' % (module, 'failed'))
+            continue
+        print('%-50s %10.3f' % (module, seconds))
+
+    for command in args.command:
+        seconds = np.median(time_command(env_python + [os.path.join(root, 'DeepSpeech.py')] + shlex.split(command),
+                                         args.repeat, root))
+        print('DeepSpeech.py %s: %.3fs' % (command, seconds))
+
+
+if __name__ == '__main__':
+    main()
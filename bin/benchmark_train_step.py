@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function
+
+# Make sure we can import stuff from util/
+# This script needs to be run from the root of the DeepSpeech repository
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import json
+import numpy as np
+import platform
+import resource
+import subprocess
+import tensorflow as tf
+import time
+
+from collections import OrderedDict
+from DeepSpeech import average_gradients, create_optimizer, get_tower_results
+from util.config import Config, initialize_globals
+from util.extra_flags import create_extra_flags
+from util.flags import create_flags, FLAGS
+from util.logging import log_info, log_error
+from util.mixed_precision import compute_dtype, DynamicLossScale
+from util.text import ctc_label_dense_to_sparse
+
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+
+class SyntheticFeeder(object):
+    r'''
+    Stands in for the model feeder of the training graph, every tower gets the same
+    constant random batch, so the measured step time excludes any input pipeline.
+    '''
+    def __init__(self, batch_size, n_steps, seed=0):
+        rng = np.random.RandomState(seed)
+        window_size = 2*Config.n_context+1
+        self.features = rng.randn(batch_size, n_steps, window_size, Config.n_input).astype(np.float32)
+        self.features_len = np.full([batch_size], n_steps, dtype=np.int32)
+        self.transcripts = rng.randint(0, Config.n_hidden_6 - 1, [batch_size, n_steps // 4]).astype(np.int32)
+        self.transcripts_len = np.full([batch_size], n_steps // 4, dtype=np.int32)
+
+    def next_batch(self, tower_feeder_index):
+        batch_x = tf.constant(self.features)
+        batch_seq_len = tf.constant(self.features_len)
+        batch_y = ctc_label_dense_to_sparse(tf.constant(self.transcripts), tf.constant(self.transcripts_len),
+                                            len(self.features_len))
+        return batch_x, batch_seq_len, batch_y
+
+
+def benchmark_mode():
+    r'''
+    Builds the training step of the current --precision and --fused_dense flags on synthetic data
+    and measures its time and peak memory.
+    '''
+    feeder = SyntheticFeeder(FLAGS.train_batch_size, FLAGS.bench_n_steps)
+    global_step = tf.train.get_or_create_global_step()
+    optimizer = create_optimizer()
+    # Fed like in train(), so the graph gets the same dropout ops and dtypes
+    dropout_rates = [tf.placeholder(tf.float32, name='dropout_{}'.format(i)) for i in range(6)]
+    feed_dict = dict(zip(dropout_rates, [FLAGS.dropout_rate, FLAGS.dropout_rate2, FLAGS.dropout_rate3,
+                                         FLAGS.dropout_rate4, FLAGS.dropout_rate5, FLAGS.dropout_rate6]))
+
+    loss_scale = None
+    if FLAGS.precision == 'float16':
+        loss_scale = DynamicLossScale(initial_scale=FLAGS.loss_scale_initial,
+                                      increment_steps=FLAGS.loss_scale_increment_steps)
+
+    gradients, loss = get_tower_results(feeder, optimizer, dropout_rates, ['1', '2', '3', 'lstm', '5', '6'], loss_scale)
+    avg_tower_gradients = average_gradients(gradients, compute_dtype(FLAGS.precision))
+    if loss_scale:
+        avg_tower_gradients = loss_scale.unscale_gradients(avg_tower_gradients)
+        apply_gradient_op = loss_scale.apply_gradients(optimizer, avg_tower_gradients, global_step)
+    else:
+        apply_gradient_op = optimizer.apply_gradients(avg_tower_gradients, global_step=global_step)
+
+    max_bytes_in_use = None
+    if Config.available_devices[0] != Config.cpu_device:
+        with tf.device(Config.available_devices[0]):
+            max_bytes_in_use = tf.contrib.memory_stats.MaxBytesInUse()
+
+    step_times = []
+    with tf.Session(config=Config.session_config) as session:
+        session.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+        for i in range(FLAGS.bench_warmup + FLAGS.bench_iterations):
+            start = time.time()
+            step_loss, _ = session.run([loss, apply_gradient_op], feed_dict=feed_dict)
+            if i >= FLAGS.bench_warmup:
+                step_times.append(time.time() - start)
+            if not np.isfinite(step_loss):
+                log_error('Loss of step {} is not finite'.format(i))
+        device_peak_bytes = session.run(max_bytes_in_use) if max_bytes_in_use is not None else None
+
+    samples = FLAGS.train_batch_size * len(Config.available_devices)
+    return OrderedDict([
+        ('precision', FLAGS.precision),
+        ('fused_dense', FLAGS.fused_dense),
+        ('step_ms', float(np.mean(step_times)) * 1000.),
+        ('step_ms_p90', float(np.percentile(step_times, 90)) * 1000.),
+        ('samples_per_sec', samples / float(np.mean(step_times))),
+        # ru_maxrss is in KiB on Linux
+        ('peak_rss_mb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.),
+        ('peak_device_mb', device_peak_bytes / 2.**20 if device_peak_bytes is not None else None),
+    ])
+
+
+def run_mode(mode):
+    r'''
+    Benchmarks ``mode`` ("<precision>" or "<precision>:fused") in a child process,
+    so peak memory and graph optimizations of the modes don't affect each other.
+    '''
+    precision, _, fused = mode.partition(':')
+    argv = [sys.executable, sys.argv[0]] + sys.argv[1:] + [
+        '--bench_child',
+        '--precision=%s' % precision,
+        '--fused_dense=%s' % (fused == 'fused'),
+    ]
+    output = subprocess.check_output(argv).decode('utf-8')
+    for line in output.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):], object_pairs_hook=OrderedDict)
+    raise RuntimeError('Benchmark of mode {} reported no result'.format(mode))
+
+
+def main(_):
+    initialize_globals()
+
+    if FLAGS.bench_child:
+        print(RESULT_PREFIX + json.dumps(benchmark_mode()))
+        sys.stdout.flush()
+        return
+
+    results = []
+    for mode in FLAGS.bench_modes.split(','):
+        log_info('Training step: mode={} batch_size={} n_steps={}'.format(mode, FLAGS.train_batch_size, FLAGS.bench_n_steps))
+        results.append(run_mode(mode))
+
+    baseline = results[0]['step_ms']
+    print('%10s %6s %10s %10s %9s %12s %14s' % ('precision', 'fused', 'step ms', 'samples/s', 'speedup',
+                                                 'peak RSS MB', 'peak device MB'))
+    for r in results:
+        print('%10s %6s %10.1f %10.2f %9.2f %12.1f %14s' % (r['precision'], r['fused_dense'], r['step_ms'],
+                                                            r['samples_per_sec'], baseline / r['step_ms'],
+                                                            r['peak_rss_mb'],
+                                                            '%.1f' % r['peak_device_mb'] if r['peak_device_mb'] is not None else '-'))
+
+    if FLAGS.bench_output:
+        report = OrderedDict([
+            ('host', platform.node()),
+            ('tensorflow', tf.__version__),
+            ('devices', Config.available_devices),
+            ('n_hidden', FLAGS.n_hidden),
+            ('train_batch_size', FLAGS.train_batch_size),
+            ('n_steps', FLAGS.bench_n_steps),
+            ('results', results),
+        ])
+        with open(FLAGS.bench_output, 'w') as fout:
+            json.dump(report, fout, indent=2)
+
+
+if __name__ == '__main__':
+    create_flags()
+    create_extra_flags()
+    f = tf.app.flags
+    f.DEFINE_string('bench_modes', 'float32,float32:fused,float16:fused,bfloat16:fused', 'comma separated training modes to benchmark, each a --precision value optionally followed by ":fused" for --fused_dense')
+    f.DEFINE_integer('bench_n_steps', 300, 'number of time steps of the synthetic utterances')
+    f.DEFINE_integer('bench_warmup', 3, 'number of untimed training steps per mode')
+    f.DEFINE_integer('bench_iterations', 20, 'number of timed training steps per mode')
+    f.DEFINE_string('bench_output', '', 'path of the JSON file to write the results to')
+    f.DEFINE_boolean('bench_child', False, 'internal - benchmark the mode given by --precision and --fused_dense and report it on stdout')
+    tf.app.run(main)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function
+
+# Make sure we can import stuff from util/
+# This script needs to be run from the root of the DeepSpeech repository
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import argparse
+import multiprocessing
+import subprocess
+import time
+
+
+def rank_arguments(rank, args):
+    r'''
+    Flags of rank ``rank``. Only rank 0 writes checkpoints, exports and tests, every rank
+    gets its own training coordinator port.
+    '''
+    arguments = [
+        '--allreduce_size=%d' % args.processes,
+        '--allreduce_rank=%d' % rank,
+        '--allreduce_port=%d' % args.port,
+        '--coord_port=%d' % (args.coord_port + rank),
+    ]
+    if rank > 0:
+        arguments += [
+            '--max_to_keep=0',
+            '--summary_secs=0',
+            '--notest',
+            '--export_dir=',
+            '--nodev_sidecar',
+            '--checkpoint_stash_dir=',
+            '--profile_dir=',
+            '--throughput_log=',
+        ]
+    return arguments
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs DeepSpeech.py as several local processes training data parallel '
+                                                 'with ring allreduce. Arguments after "--" are passed to every process.')
+    parser.add_argument('--processes', type=int, default=2, help='number of training processes')
+    parser.add_argument('--port', type=int, default=29500, help='allreduce port of rank 0, the other ranks use the following ports')
+    parser.add_argument('--coord_port', type=int, default=2500, help='training coordinator port of rank 0, the other ranks use the following ports')
+    parser.add_argument('--threads', type=int, default=0, help='intra and inter op threads of each process, 0 divides the cores among them')
+    parser.add_argument('deepspeech_args', nargs=argparse.REMAINDER, help='arguments of DeepSpeech.py')
+    args = parser.parse_args()
+
+    deepspeech_args = args.deepspeech_args
+    if deepspeech_args and deepspeech_args[0] == '--':
+        deepspeech_args = deepspeech_args[1:]
+
+    threads = args.threads or max(1, multiprocessing.cpu_count() // args.processes)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DeepSpeech.py')
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+
+    processes = []
+    for rank in range(args.processes):
+        argv = [sys.executable, script] + deepspeech_args + rank_arguments(rank, args) + [
+            '--inter_op_parallelism_threads=%d' % threads,
+            '--intra_op_parallelism_threads=%d' % threads,
+        ]
+        processes.append(subprocess.Popen(argv, env=env))
+
+    # A failing rank makes the others time out, so all get stopped as soon as one fails
+    exit_code = 0
+    while processes:
+        for process in list(processes):
+            code = process.poll()
+            if code is None:
+                continue
+            processes.remove(process)
+            if code != 0 and exit_code == 0:
+                exit_code = code
+                for other in processes:
+                    other.terminate()
+        time.sleep(1)
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
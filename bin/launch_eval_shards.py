@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function
+
+# Make sure we can import stuff from util/
+# This script needs to be run from the root of the DeepSpeech repository
+import os
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+import argparse
+import multiprocessing
+import subprocess
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a sharded evaluation as several local processes sharing the shards '
+                                                 'of --eval_state_dir, then merges their results in a final run. '
+                                                 'Arguments after "--" are passed to every process.')
+    parser.add_argument('--processes', type=int, default=2, help='number of evaluation processes')
+    parser.add_argument('--script', type=str, default='evaluate.py', help='script to run, evaluate.py or DeepSpeech.py')
+    parser.add_argument('--threads', type=int, default=0, help='intra and inter op threads of each process, 0 divides the cores among them')
+    parser.add_argument('--gpus', type=str, default='', help='comma separated GPUs assigned round robin to the processes, none means CPU only')
+    parser.add_argument('evaluate_args', nargs=argparse.REMAINDER, help='arguments of the script')
+    args = parser.parse_args()
+
+    evaluate_args = args.evaluate_args
+    if evaluate_args and evaluate_args[0] == '--':
+        evaluate_args = evaluate_args[1:]
+    if not any(arg.startswith('--eval_state_dir=') and len(arg) > len('--eval_state_dir=') for arg in evaluate_args):
+        print('The processes exchange their results through --eval_state_dir=<directory>, it has to be given')
+        sys.exit(1)
+
+    threads = args.threads or max(1, multiprocessing.cpu_count() // args.processes)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', args.script)
+    gpus = [gpu for gpu in args.gpus.split(',') if gpu]
+
+    processes = []
+    for index in range(args.processes):
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES=gpus[index % len(gpus)] if gpus else '')
+        argv = [sys.executable, script] + evaluate_args + [
+            '--eval_workers=%d' % args.processes,
+            '--eval_worker_index=%d' % index,
+            '--inter_op_parallelism_threads=%d' % threads,
+            '--intra_op_parallelism_threads=%d' % threads,
+        ]
+        processes.append(subprocess.Popen(argv, env=env))
+
+    # A failed worker's shards get scored by the final run, so the others keep going
+    failed = 0
+    while processes:
+        for process in list(processes):
+            code = process.poll()
+            if code is None:
+                continue
+            processes.remove(process)
+            if code != 0:
+                failed += 1
+        time.sleep(1)
+    if failed:
+        print('%d of %d workers failed, the final run scores their remaining shards' % (failed, args.processes))
+
+    # Loads the states of all shards and reports the merged results. Workers keep the report flags,
+    # as --nbest_output_file decides whether shards keep N-best results and is part of their fingerprint.
+    # A worker finishing the last shard reports too, this run rewrites the same files.
+    sys.exit(subprocess.call([sys.executable, script] + evaluate_args + ['--eval_workers=1', '--eval_worker_index=0']))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,18 +11,31 @@ import progressbar
 import sys
 import tables
 import tensorflow as tf
+import time
 
 from attrdict import AttrDict
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from ds_ctcdecoder import ctc_beam_search_decoder_batch, Scorer
 from multiprocessing import Pool, cpu_count
 from six.moves import zip, range
 from util.audio import audiofile_to_input_vector
+from util.batch_mfcc import WIN_STEP
+from util.autotune import autotune, run_trial
+from util.checkpoint_averaging import ema_mapping
 from util.config import Config, initialize_globals
+from util.extra_flags import create_extra_flags
+from util.feature_cache import preprocess, SOURCE_COLUMN
 from util.flags import create_flags, FLAGS
+from util.frozen_graph_runner import FrozenGraphRunner
+from util.eval_shards import ShardStore, empty_shard_state, merge_shard_states, model_version, test_set_fingerprint
+from util.labels import LabelLookup, PackedLabels
 from util.logging import log_error
-from util.preprocess import pmap, preprocess
+from util.nbest import NBestResults
+from util.preprocess import pmap
+from util.profiling import profiler, write_tf_timeline
+from util.shared_weights import cpu_session_config, SharedWeights
 from util.text import Alphabet, ctc_label_dense_to_sparse, wer, levenshtein
+from util.tflite_runner import TFLiteRunner
 
 
 def split_data(dataset, batch_size):
@@ -34,6 +47,18 @@ def split_data(dataset, batch_size):
         yield dataset[i:i + batch_size]
 
 
+def pad_to_batches(dataset, batch_size):
+    r'''
+    Returns ``dataset`` with its last sample repeated up to a multiple of ``batch_size`` samples,
+    so :func:`split_data` keeps every sample whatever the batch size. Results of the repeated
+    samples have to be dropped.
+    '''
+    remainder = len(dataset) % batch_size
+    if remainder == 0:
+        return dataset
+    return pandas.concat([dataset, dataset.iloc[[-1] * (batch_size - remainder)]])
+
+
 def pad_to_dense(jagged):
     maxlen = max(len(r) for r in jagged)
     subshape = jagged[0].shape
@@ -46,9 +71,9 @@ def pad_to_dense(jagged):
 
 
 def process_decode_result(item):
-    label, decoding, distance, loss = item
+    label, decoding, distance, loss, metadata = item
     sample_wer = wer(label, decoding)
-    return AttrDict({
+    sample = AttrDict({
         'src': label,
         'res': decoding,
         'loss': loss,
@@ -57,15 +82,20 @@ def process_decode_result(item):
         'levenshtein': levenshtein(label.split(), decoding.split()),
         'label_length': float(len(label.split())),
     })
+    sample.update(metadata)
+    return sample
 
 
-def calculate_report(labels, decodings, distances, losses):
+def calculate_report(labels, decodings, distances, losses, metadata=None):
     r'''
     This routine will calculate a WER report.
     It'll compute the `mean` WER and create ``Sample`` objects of the ``report_count`` top lowest
     loss items from the provided WER results tuple (only items with WER!=0 and ordered by their WER).
+    Samples get the fields of their ``metadata`` dict, if given, to group them by.
     '''
-    samples = pmap(process_decode_result, zip(labels, decodings, distances, losses))
+    if metadata is None:
+        metadata = [{}] * len(labels)
+    samples = pmap(process_decode_result, zip(labels, decodings, distances, losses, metadata))
 
     total_levenshtein = sum(s.levenshtein for s in samples)
     total_label_length = sum(s.label_length for s in samples)
@@ -82,117 +112,522 @@ def calculate_report(labels, decodings, distances, losses):
     return samples_wer, samples
 
 
-def evaluate(test_data, inference_graph, alphabet,ckpt_name):
-    scorer = Scorer(FLAGS.lm_alpha, FLAGS.lm_beta,
-                    FLAGS.lm_binary_path, FLAGS.lm_trie_path,
-                    Config.alphabet)
+def calculate_totals(samples):
+    r'''
+    Returns the WER, mean edit distance and mean loss over all ``samples`` of a report.
+    '''
+    wer = sum(s.levenshtein for s in samples) / sum(s.label_length for s in samples)
+    return wer, np.mean([s.distance for s in samples]), np.mean([s.loss for s in samples])
+
+
+def calculate_group_totals(samples, field):
+    r'''
+    Returns the totals (see :func:`calculate_totals`) and sample count of each group of ``samples``
+    with the same value of ``field`` (e.g. ``source``), ordered by that value.
+    '''
+    groups = {}
+    for sample in samples:
+        groups.setdefault(sample[field], []).append(sample)
+    return OrderedDict((value, calculate_totals(group) + (len(group),)) for value, group in sorted(groups.items()))
+
+
+def duration_bucket(duration, boundaries):
+    r'''
+    Returns the name of the bucket of ``boundaries`` (ascending seconds) that ``duration`` falls into,
+    e.g. ``"05-10s"``, zero padded so names sort by duration.
+    '''
+    width = len(str(int(boundaries[-1]))) if boundaries else 1
+    lower = None
+    for boundary in boundaries:
+        if duration < boundary:
+            break
+        lower = boundary
+    else:
+        return '>=%0*gs' % (width, boundaries[-1])
+    if lower is None:
+        return '<%0*gs' % (width, boundaries[0])
+    return '%0*g-%0*gs' % (width, lower, width, boundary)
+
+
+def sample_metadata(test_data, count):
+    r'''
+    Returns the fields the first ``count`` samples of ``test_data`` are grouped by: their CSV file
+    (``source``) and, with ``--test_duration_buckets``, their ``duration`` bucket.
+    '''
+    boundaries = sorted(float(b) for b in FLAGS.test_duration_buckets.split(',') if b.strip())
+    sources = test_data[SOURCE_COLUMN].values[:count] if SOURCE_COLUMN in test_data else [None] * count
+    metadata = []
+    for source, features_len in zip(sources, test_data['features_len'].values[:count]):
+        fields = {}
+        if source is not None:
+            fields['source'] = source
+        if boundaries:
+            fields['duration'] = duration_bucket(features_len * WIN_STEP, boundaries)
+        metadata.append(fields)
+    return metadata
+
+
+class CheckpointBackend(object):
+    r'''
+    Computes the acoustic model's outputs and CTC losses of batches with ``inference_graph``,
+    its variables restored from ``checkpoint_path``.
+    '''
+    def __init__(self, inference_graph, checkpoint_path):
+        self.name = os.path.basename(checkpoint_path)
+        self.path = checkpoint_path
+        self.session = tf.Session(config=cpu_session_config(Config.session_config) if FLAGS.shared_weights
+                                  else Config.session_config)
+        self.inputs, self.outputs, layers = inference_graph
+
+        with profiler.stage('graph'):
+            # Transpose to batch major for decoder
+            self.transposed = tf.transpose(self.outputs['outputs'], [1, 0, 2])
+
+            self.labels_ph = tf.placeholder(tf.int32, [FLAGS.test_batch_size, None], name="labels")
+            self.label_lengths_ph = tf.placeholder(tf.int32, [FLAGS.test_batch_size], name="label_lengths")
+
+            sparse_labels = tf.cast(ctc_label_dense_to_sparse(self.labels_ph, self.label_lengths_ph, FLAGS.test_batch_size), tf.int32)
+            self.loss = tf.nn.ctc_loss(labels=sparse_labels,
+                                       inputs=layers['raw_logits'],
+                                       sequence_length=self.inputs['input_lengths'])
+
+            # Create a saver using variables from the above newly created graph
+            mapping = {v.op.name: v for v in tf.global_variables() if not v.op.name.startswith('previous_state_')}
+            if FLAGS.use_ema_weights:
+                mapping = ema_mapping(mapping, checkpoint_path)
+            saver = tf.train.Saver(mapping)
+
+        # Restore variables from training checkpoint, or bind them to the weights shared by the host's processes
+        self.weights_feed_dict = {}
+        with profiler.stage('restore'):
+            if FLAGS.shared_weights:
+                self.weights_feed_dict = SharedWeights(checkpoint_path, mapping, FLAGS.shared_weights_dir,
+                                                       keep=FLAGS.shared_weights_keep).feed_dict
+            else:
+                saver.restore(self.session, checkpoint_path)
+
+        # Batches whose session run gets traced by TensorFlow
+        self.trace_batches = set()
+        if FLAGS.profile_dir and FLAGS.profile_tf_batches:
+            self.trace_batches = set(int(index) for index in FLAGS.profile_tf_batches.split(','))
+
+    def run(self, batch_index, features, features_len, labels, label_lengths):
+        self.session.run(self.outputs['initialize_state'])
+
+        run_kwargs = {}
+        if batch_index in self.trace_batches:
+            run_kwargs['options'] = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+            run_kwargs['run_metadata'] = tf.RunMetadata()
+
+        feed_dict = {
+            self.inputs['input']: features,
+            self.inputs['input_lengths']: features_len,
+            self.labels_ph: labels,
+            self.label_lengths_ph: label_lengths
+        }
+        feed_dict.update(self.weights_feed_dict)
+        logits, loss = self.session.run([self.transposed, self.loss], feed_dict=feed_dict, **run_kwargs)
+
+        if batch_index in self.trace_batches:
+            write_tf_timeline(run_kwargs['run_metadata'], FLAGS.profile_dir,
+                              '%s_batch%d' % (self.name, batch_index))
+        return logits, loss
+
+    def close(self):
+        self.session.close()
+
+
+class ProbabilityLoss(object):
+    r'''
+    CTC loss of batch major softmax outputs, for models that don't expose their logits.
+    The logarithms of the probabilities differ from the logits by a constant per time step,
+    which the softmax in the CTC loss cancels out.
+    '''
+    def __init__(self):
+        graph = tf.Graph()
+        with graph.as_default(), tf.device('/cpu:0'):
+            self.probabilities = tf.placeholder(tf.float32, [None, None, Config.n_hidden_6])
+            self.lengths = tf.placeholder(tf.int32, [None])
+            self.labels = tf.placeholder(tf.int32, [None, None])
+            self.label_lengths = tf.placeholder(tf.int32, [None])
+            sparse_labels = ctc_label_dense_to_sparse(self.labels, self.label_lengths, tf.shape(self.lengths)[0])
+            log_probabilities = tf.log(tf.maximum(tf.transpose(self.probabilities, [1, 0, 2]), 1e-30))
+            self.loss = tf.nn.ctc_loss(labels=sparse_labels,
+                                       inputs=log_probabilities,
+                                       sequence_length=self.lengths,
+                                       ignore_longer_outputs_than_inputs=True)
+        self.session = tf.Session(graph=graph, config=Config.session_config)
+
+    def __call__(self, probabilities, lengths, labels, label_lengths):
+        return self.session.run(self.loss, feed_dict={
+            self.probabilities: probabilities,
+            self.lengths: lengths,
+            self.labels: labels,
+            self.label_lengths: label_lengths,
+        })
+
+    def close(self):
+        self.session.close()
+
+
+class TFLiteBackend(object):
+    r'''
+    Computes the acoustic model's outputs with the TF Lite model ``model_path``, see :class:`TFLiteRunner`.
+    '''
+    def __init__(self, model_path, num_threads=1, num_interpreters=1):
+        self.name = os.path.basename(model_path)
+        self.path = model_path
+        self.runner = TFLiteRunner(model_path, num_threads=num_threads, num_interpreters=num_interpreters)
+        self.loss = ProbabilityLoss()
+
+    def run(self, batch_index, features, features_len, labels, label_lengths):
+        probabilities = self.runner.run(features)
+        return probabilities, self.loss(probabilities, features_len, labels, label_lengths)
+
+    def close(self):
+        self.runner.close()
+        self.loss.close()
+
+
+class FrozenGraphBackend(object):
+    r'''
+    Computes the acoustic model's outputs with the frozen graph ``graph_path``, see :class:`FrozenGraphRunner`.
+    '''
+    def __init__(self, graph_path):
+        self.name = os.path.basename(graph_path)
+        self.path = graph_path
+        with profiler.stage('restore'):
+            self.runner = FrozenGraphRunner(graph_path, session_config=Config.session_config)
+        self.loss = ProbabilityLoss()
 
+    def run(self, batch_index, features, features_len, labels, label_lengths):
+        probabilities = self.runner.run(features, features_len)
+        return probabilities, self.loss(probabilities, features_len, labels, label_lengths)
 
-    def create_windows(features):
-        num_strides = len(features) - (Config.n_context * 2)
+    def close(self):
+        self.runner.close()
+        self.loss.close()
 
-        # Create a view into the array with overlapping strides of size
-        # numcontext (past) + 1 (present) + numcontext (future)
-        window_size = 2*Config.n_context+1
-        features = np.lib.stride_tricks.as_strided(
-            features,
-            (num_strides, window_size, Config.n_input),
-            (features.strides[0], features.strides[0], features.strides[1]),
-            writeable=False)
 
-        return features
+# Extensions of the models written by --export_dir that can be tested instead of checkpoints
+EXPORTED_MODEL_EXTENSIONS = ('.pb', '.tflite')
 
-    # Create overlapping windows over the features
-    test_data['features'] = test_data['features'].apply(create_windows)
 
-    with tf.Session(config=Config.session_config) as session:
-        inputs, outputs, layers = inference_graph
+def is_exported_model(path):
+    return os.path.splitext(path)[1] in EXPORTED_MODEL_EXTENSIONS
+
+
+def create_backend(model_path):
+    r'''
+    Returns the backend computing the outputs of the exported model ``model_path``,
+    a frozen ``.pb`` graph or a ``.tflite`` model.
+    '''
+    if model_path.endswith('.tflite'):
+        return TFLiteBackend(model_path,
+                             num_threads=FLAGS.tflite_threads,
+                             num_interpreters=FLAGS.tflite_interpreters)
+    if model_path.endswith('.pb'):
+        return FrozenGraphBackend(model_path)
+    # Memory mapped .pbmm models can only be loaded by the native client
+    raise ValueError('Cannot test {}: exported models have to be {} files'.format(
+        model_path, ' or '.join(EXPORTED_MODEL_EXTENSIONS)))
+
 
-        # Transpose to batch major for decoder
-        transposed = tf.transpose(outputs['outputs'], [1, 0, 2])
+def create_windows(features):
+    num_strides = len(features) - (Config.n_context * 2)
 
-        labels_ph = tf.placeholder(tf.int32, [FLAGS.test_batch_size, None], name="labels")
-        label_lengths_ph = tf.placeholder(tf.int32, [FLAGS.test_batch_size], name="label_lengths")
+    # Create a view into the array with overlapping strides of size
+    # numcontext (past) + 1 (present) + numcontext (future)
+    window_size = 2*Config.n_context+1
+    features = np.lib.stride_tricks.as_strided(
+        features,
+        (num_strides, window_size, Config.n_input),
+        (features.strides[0], features.strides[0], features.strides[1]),
+        writeable=False)
 
-        sparse_labels = tf.cast(ctc_label_dense_to_sparse(labels_ph, label_lengths_ph, FLAGS.test_batch_size), tf.int32)
+    return features
+
+
+class LossEvaluator(object):
+    r'''
+    Computes the mean CTC loss of a test set with ``inference_graph``, without fetching its outputs.
+    Per batch a single run computes the losses and adds them to in-graph accumulators, the mean is
+    fetched once per test set. Instead of running ``initialize_state`` first, every run feeds a zero
+    LSTM state for the reads of the state variables. The graph is built once, so several checkpoints
+    can be scored by restoring them into the same session, see :func:`rank_checkpoints_by_loss`.
+    '''
+    def __init__(self, inference_graph):
+        self.inputs, self.outputs, layers = inference_graph
+
+        self.labels_ph = tf.placeholder(tf.int32, [FLAGS.test_batch_size, None], name="labels")
+        self.label_lengths_ph = tf.placeholder(tf.int32, [FLAGS.test_batch_size], name="label_lengths")
+        # 0 for the repeated samples padding the last batch, see pad_to_batches()
+        self.weights_ph = tf.placeholder(tf.float64, [FLAGS.test_batch_size], name="loss_weights")
+
+        sparse_labels = tf.cast(ctc_label_dense_to_sparse(self.labels_ph, self.label_lengths_ph, FLAGS.test_batch_size), tf.int32)
         loss = tf.nn.ctc_loss(labels=sparse_labels,
                               inputs=layers['raw_logits'],
-                              sequence_length=inputs['input_lengths'])
+                              sequence_length=self.inputs['input_lengths'])
+
+        with tf.variable_scope('loss_evaluation'), tf.device('/cpu:0'):
+            loss_sum = tf.get_variable('loss_sum', [], tf.float64, tf.zeros_initializer(), trainable=False,
+                                       collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            loss_count = tf.get_variable('loss_count', [], tf.float64, tf.zeros_initializer(), trainable=False,
+                                         collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            self.reset_op = tf.variables_initializer([loss_sum, loss_count])
+            self.accumulate_op = tf.group(tf.assign_add(loss_sum, tf.reduce_sum(tf.cast(loss, tf.float64) * self.weights_ph)),
+                                          tf.assign_add(loss_count, tf.reduce_sum(self.weights_ph)))
+            self.mean_loss = loss_sum / tf.maximum(loss_count, 1.)
 
         # Create a saver using variables from the above newly created graph
-        mapping = {v.op.name: v for v in tf.global_variables() if not v.op.name.startswith('previous_state_')}
-        saver = tf.train.Saver(mapping)
+        self.mapping = {v.op.name: v for v in tf.global_variables() if not v.op.name.startswith('previous_state_')}
+        self.saver = tf.train.Saver(self.mapping)
 
-        # Restore variables from training checkpoint
-        #checkpoint = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
-        #if not checkpoint:
-        #    log_error('Checkpoint directory ({}) does not contain a valid checkpoint state.'.format(FLAGS.checkpoint_dir))
-        #    exit(1)
+        self.zero_state_feed_dict = {v.value(): np.zeros(v.get_shape().as_list(), dtype=np.float32)
+                                     for v in tf.global_variables() if v.op.name.startswith('previous_state_')}
 
-        #checkpoint_path = checkpoint.model_checkpoint_path
-        checkpoint_path = os.path.join(FLAGS.checkpoint_dir,ckpt_name)
+    def restore(self, session, checkpoint_path):
+        saver = self.saver
+        if FLAGS.use_ema_weights:
+            saver = tf.train.Saver(ema_mapping(self.mapping, checkpoint_path))
         saver.restore(session, checkpoint_path)
 
-        logitses = []
-        losses = []
+    def evaluate(self, session, batches):
+        r'''
+        Returns the mean loss of the padded ``(features, features_len, labels, label_lengths, weights)`` ``batches``.
+        '''
+        session.run(self.reset_op)
+        feed_dict = dict(self.zero_state_feed_dict)
+        for features, features_len, labels, label_lengths, weights in batches:
+            feed_dict.update({
+                self.inputs['input']: features,
+                self.inputs['input_lengths']: features_len,
+                self.labels_ph: labels,
+                self.label_lengths_ph: label_lengths,
+                self.weights_ph: weights
+            })
+            session.run(self.accumulate_op, feed_dict=feed_dict)
+        return session.run(self.mean_loss)
 
-        print('Computing acoustic model predictions...')
-        batch_count = len(test_data) // FLAGS.test_batch_size
-        bar = progressbar.ProgressBar(max_value=batch_count,
-                                      widget=progressbar.AdaptiveETA)
 
-        # First pass, compute losses and transposed logits for decoding
-        for batch in bar(split_data(test_data, FLAGS.test_batch_size)):
-            session.run(outputs['initialize_state'])
-
-            features = pad_to_dense(batch['features'].values)
-            features_len = batch['features_len'].values
-            labels = pad_to_dense(batch['transcript'].values)
-            label_lengths = batch['transcript_len'].values
-
-            logits, loss_ = session.run([transposed, loss], feed_dict={
-                inputs['input']: features,
-                inputs['input_lengths']: features_len,
-                labels_ph: labels,
-                label_lengths_ph: label_lengths
-            })
+def rank_checkpoints_by_loss(test_data, inference_graph, checkpoint_paths):
+    r'''
+    Scores the checkpoints ``checkpoint_paths`` by their mean loss on ``test_data`` (see :class:`LossEvaluator`).
+    Every checkpoint is restored into the same graph. The batches get windowed and padded while they
+    are fed, as the windows of a whole test set take many times the memory of its features.
+    Returns the ``(checkpoint_path, loss)`` tuples ordered by loss.
+    '''
+    weights = np.zeros(len(test_data) + FLAGS.test_batch_size)
+    weights[:len(test_data)] = 1.
+    test_data = pad_to_batches(test_data, FLAGS.test_batch_size)
+    packed = PackedLabels.from_arrays(test_data['transcript'].values)
 
-            logitses.append(logits)
-            losses.extend(loss_)
+    def batches():
+        for index, batch in enumerate(split_data(test_data, FLAGS.test_batch_size)):
+            start, end = index * FLAGS.test_batch_size, (index + 1) * FLAGS.test_batch_size
+            yield ((pad_to_dense(batch['features'].apply(create_windows).values), batch['features_len'].values) +
+                   packed.dense(start, end) + (weights[start:end],))
 
-    ground_truths = []
-    predictions = []
+    with profiler.stage('graph'):
+        evaluator = LossEvaluator(inference_graph)
 
-    print('Decoding predictions...')
-    bar = progressbar.ProgressBar(max_value=batch_count,
-                                  widget=progressbar.AdaptiveETA)
+    results = []
+    with tf.Session(config=Config.session_config) as session:
+        for checkpoint_path in checkpoint_paths:
+            start = time.time()
+            with profiler.tags(checkpoint=os.path.basename(checkpoint_path)):
+                with profiler.stage('restore'):
+                    evaluator.restore(session, checkpoint_path)
+                with profiler.stage('loss'):
+                    loss = evaluator.evaluate(session, batches())
+            print('%s - loss: %f (%.2fs)' % (os.path.basename(checkpoint_path), loss, time.time() - start))
+            results.append((checkpoint_path, loss))
+
+    results.sort(key=lambda result: result[1])
+    print('Checkpoints ranked by loss:')
+    for rank, (checkpoint_path, loss) in enumerate(results):
+        print('%3d. %s - loss: %f' % (rank + 1, os.path.basename(checkpoint_path), loss))
+    return results
+
+
+def evaluate(test_data, inference_graph, alphabet, ckpt_name, backend=None):
+    r'''
+    Scores ``test_data`` with the acoustic model of ``inference_graph`` restored from the
+    checkpoint ``ckpt_name`` or, if given, with ``backend`` (see :func:`create_backend`).
+    '''
+    with profiler.stage('scorer'):
+        scorer = Scorer(FLAGS.lm_alpha, FLAGS.lm_beta,
+                        FLAGS.lm_binary_path, FLAGS.lm_trie_path,
+                        Config.alphabet)
 
-    # Get number of accessible CPU cores for this process
-    try:
-        num_processes = cpu_count()
-    except:
-        num_processes = 1
+    # Every sample gets scored whatever the (possibly autotuned) batch size
+    sample_count = len(test_data)
+    test_data = pad_to_batches(test_data, FLAGS.test_batch_size)
 
-    # Second pass, decode logits and compute WER and edit distance metrics
-    for logits, batch in bar(zip(logitses, split_data(test_data, FLAGS.test_batch_size))):
-        seq_lengths = batch['features_len'].values.astype(np.int32)
-        decoded = ctc_beam_search_decoder_batch(logits, seq_lengths, alphabet, FLAGS.beam_width,
-                                                num_processes=num_processes, scorer=scorer)
+    # Create overlapping windows over the features
+    with profiler.stage('windows'):
+        test_data['features'] = test_data['features'].apply(create_windows)
+
+    # Transcripts are packed and decoded to text once for the whole set rather than per batch
+    with profiler.stage('labels'):
+        packed = PackedLabels.from_arrays(test_data['transcript'].values)
+        label_texts = LabelLookup(alphabet).decode(packed)
+
+    batches = list(split_data(test_data, FLAGS.test_batch_size))
+    batch_count = len(batches)
+    shard_size = FLAGS.eval_shard_size if FLAGS.eval_shard_size > 0 else max(batch_count, 1)
+    shard_count = (batch_count + shard_size - 1) // shard_size
+    model_name = backend.name if backend is not None else os.path.basename(ckpt_name)
+
+    # Shards already scored by an earlier (or another worker's) run are loaded instead of computed
+    store = None
+    if FLAGS.eval_state_dir:
+        model_path = backend.path if backend is not None else os.path.join(FLAGS.checkpoint_dir, ckpt_name)
+        settings = model_version(model_path) + (FLAGS.test_batch_size, shard_size, FLAGS.beam_width, FLAGS.lm_alpha,
+                                                FLAGS.lm_beta, FLAGS.lm_binary_path,
+                                                FLAGS.nbest if FLAGS.nbest_output_file else 0)
+        store = ShardStore(FLAGS.eval_state_dir, model_name, test_set_fingerprint(test_data, packed, *settings))
 
-        ground_truths.extend(alphabet.decode(l) for l in batch['transcript'])
-        predictions.extend(d[0][1] for d in decoded)
+    # Get number of accessible CPU cores for this process
+    num_processes = FLAGS.decoder_processes
+    if num_processes <= 0:
+        try:
+            num_processes = cpu_count()
+        except:
+            num_processes = 1
+
+    # Acoustic model throughput over the shards computed by this run
+    throughput = {'seconds': 0., 'utterances': 0, 'audio_seconds': 0.}
+
+    def score_shard(shard, backend):
+        r'''
+        Computes the outputs and losses of the batches of ``shard`` (first pass),
+        decodes them and computes the edit distances (second pass).
+        '''
+        state = empty_shard_state()
+        first_batch = shard * shard_size
+        shard_batches = batches[first_batch:first_batch + shard_size]
 
-    distances = [levenshtein(a, b) for a, b in zip(ground_truths, predictions)]
+        logitses = []
+        print('Computing acoustic model predictions...')
+        bar = progressbar.ProgressBar(max_value=len(shard_batches),
+                                      widget=progressbar.AdaptiveETA)
 
-    wer, samples = calculate_report(ground_truths, predictions, distances, losses)
-    mean_edit_distance = np.mean(distances)
-    mean_loss = np.mean(losses)
+        # First pass, compute losses and transposed logits for decoding
+        inference_start = time.time()
+        with profiler.stage('inference'):
+            for batch_index, batch in enumerate(bar(shard_batches), first_batch):
+                features = pad_to_dense(batch['features'].values)
+                features_len = batch['features_len'].values
+                row = batch_index * FLAGS.test_batch_size
+                labels, label_lengths = packed.dense(row, row + len(batch))
+
+                logits, loss_ = backend.run(batch_index, features, features_len, labels, label_lengths)
+
+                # Results of the samples padding the last batch are dropped
+                count = min(len(batch), sample_count - row)
+                logitses.append(logits[:count])
+                state['losses'].extend(loss_[:count])
+                throughput['utterances'] += count
+                throughput['audio_seconds'] += features_len[:count].sum() * WIN_STEP
+        throughput['seconds'] += time.time() - inference_start
+
+        # Hypotheses with their scores and word timings, kept for --nbest_output_file
+        nbest = NBestResults(alphabet, scorer) if FLAGS.nbest_output_file else None
+        utterance = first_batch * FLAGS.test_batch_size
+
+        print('Decoding predictions...')
+        bar = progressbar.ProgressBar(max_value=len(shard_batches),
+                                      widget=progressbar.AdaptiveETA)
+
+        # Second pass, decode logits and compute WER and edit distance metrics
+        with profiler.stage('decoding'):
+            for logits, batch in bar(zip(logitses, shard_batches)):
+                seq_lengths = batch['features_len'].values[:len(logits)].astype(np.int32)
+                decoded = ctc_beam_search_decoder_batch(logits, seq_lengths, alphabet, FLAGS.beam_width,
+                                                        num_processes=num_processes, scorer=scorer)
+
+                row = utterance + len(state['labels'])
+                state['labels'].extend(label_texts[row:row + len(logits)])
+                if nbest is not None:
+                    for probabilities, length, hypotheses in zip(logits, seq_lengths, decoded):
+                        nbest.add(utterance + len(state['predictions']), hypotheses[:FLAGS.nbest], probabilities[:length])
+                        state['predictions'].append(hypotheses[0][1])
+                else:
+                    state['predictions'].extend(d[0][1] for d in decoded)
+
+        state['distances'] = [levenshtein(a, b) for a, b in zip(state['labels'], state['predictions'])]
+        state['count'] = len(state['labels'])
+        state['levenshtein'] = sum(levenshtein(a.split(), b.split()) for a, b in zip(state['labels'], state['predictions']))
+        state['label_length'] = sum(len(a.split()) for a in state['labels'])
+        state['distance'] = float(np.sum(state['distances']))
+        state['loss'] = float(np.sum(state['losses']))
+        state['nbest'] = nbest.to_dict() if nbest is not None else None
+        return state
+
+    states = []
+    for shard in range(shard_count):
+        state = store.load(shard) if store else None
+        if state is None and shard % FLAGS.eval_workers == FLAGS.eval_worker_index:
+            # The model only gets restored once a shard needs it
+            if backend is None:
+                #checkpoint = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
+                #checkpoint_path = checkpoint.model_checkpoint_path
+                backend = CheckpointBackend(inference_graph, os.path.join(FLAGS.checkpoint_dir, ckpt_name))
+            print('Scoring shard %d of %d' % (shard + 1, shard_count))
+            state = score_shard(shard, backend)
+            if store:
+                store.save(shard, state)
+        states.append(state)
+    if backend is not None:
+        backend.close()
+
+    if throughput['utterances']:
+        seconds = max(throughput['seconds'], 1e-9)
+        print('Acoustic model (%s): %.2f utterances/s, %.2f audio seconds/s' %
+              (model_name, throughput['utterances'] / seconds, throughput['audio_seconds'] / seconds))
+
+    # Shards of other workers that are not done yet, the last worker to finish reports
+    if any(state is None for state in states):
+        print('Scored the shards of worker %d of %d, %d of %d shards are done' %
+              (FLAGS.eval_worker_index, FLAGS.eval_workers, sum(state is not None for state in states), shard_count))
+        return None
+
+    merged = merge_shard_states(states)
+    ground_truths = merged['labels']
+    predictions = merged['predictions']
+    losses = merged['losses']
+
+    nbest = None
+    if FLAGS.nbest_output_file:
+        nbest = NBestResults(alphabet)
+        for state in states:
+            nbest.extend(state['nbest'])
+
+    with profiler.stage('metrics'):
+        distances = merged['distances']
+
+        metadata = sample_metadata(test_data, merged['count'])
+        _, samples = calculate_report(ground_truths, predictions, distances, losses, metadata)
+        # Totals of the shards' accumulators
+        wer = merged['levenshtein'] / merged['label_length']
+        mean_edit_distance = merged['distance'] / merged['count']
+        mean_loss = merged['loss'] / merged['count']
 
     # Take only the first report_count items
     report_samples = itertools.islice(samples, FLAGS.report_count)
 
     print('Test - WER: %f, CER: %f, loss: %f' %
           (wer, mean_edit_distance, mean_loss))
+
+    # Results of subsets of the same pass, e.g. of each test CSV file
+    for field in ('source', 'duration'):
+        groups = calculate_group_totals(samples, field) if metadata and field in metadata[0] else {}
+        if field == 'source' and len(groups) < 2:
+            continue
+        for value, (group_wer, group_cer, group_loss, count) in groups.items():
+            print('Test %s %s - WER: %f, CER: %f, loss: %f, samples: %d' %
+                  (field, value, group_wer, group_cer, group_loss, count))
     print('-' * 80)
     for sample in report_samples:
         print('WER: %f, CER: %f, loss: %f' %
@@ -206,43 +641,96 @@ def evaluate(test_data, inference_graph, alphabet,ckpt_name):
         # Save decoded tuples as JSON, converting NumPy floats to Python floats
         json.dump(samples, open(FLAGS.test_output_file, 'w'), default=lambda x: float(x))
 
+    if nbest is not None:
+        nbest.write(FLAGS.nbest_output_file)
+
     return samples
 
 
 def main(_):
     initialize_globals()
 
+    if FLAGS.autotune_trial:
+        from DeepSpeech import create_inference_graph
+        run_trial(FLAGS.autotune_trial, create_inference_graph)
+        return
+
     if not FLAGS.test_files:
         log_error('You need to specify what files to use for evaluation via '
                   'the --test_files flag.')
         exit(1)
 
+    if FLAGS.profile_dir:
+        profiler.enable()
+
     global alphabet
     alphabet = Alphabet(FLAGS.alphabet_config_path)
 
     # sort examples by length, improves packing of batches and timesteps
-    test_data = preprocess(
-        FLAGS.test_files.split(','),
-        FLAGS.test_batch_size,
-        alphabet=alphabet,
-        numcep=Config.n_input,
-        numcontext=Config.n_context,
-        hdf5_cache_path=FLAGS.hdf5_test_set).sort_values(
-        by="features_len",
-        ascending=False)
-
-    from DeepSpeech import create_inference_graph
-    graph = create_inference_graph(batch_size=FLAGS.test_batch_size, n_steps=-1)
-
-    samples = evaluate(test_data, graph, alphabet)
-
-    if FLAGS.test_output_file:
+    with profiler.stage('preprocess'):
+        test_data = preprocess(
+            FLAGS.test_files.split(','),
+            FLAGS.test_batch_size,
+            alphabet=alphabet,
+            numcep=Config.n_input,
+            numcontext=Config.n_context,
+            hdf5_cache_path=FLAGS.hdf5_test_set,
+            cache_dir=FLAGS.feature_cache_dir,
+            workers=FLAGS.preprocess_workers,
+            chunk_size=FLAGS.preprocess_chunk_size,
+            task_size=FLAGS.preprocess_task_size,
+            batch_mfcc=FLAGS.batch_mfcc,
+            with_source=True).sort_values(
+            by="features_len",
+            ascending=False)
+
+    if FLAGS.autotune:
+        checkpoint = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
+        autotune(test_data, os.path.abspath(checkpoint.model_checkpoint_path) if checkpoint else None)
+
+    if FLAGS.test_models:
+        model_paths = FLAGS.test_models.split(',')
+        samples = {}
+        for model_path in model_paths:
+            print('Testing exported model %s' % model_path)
+            with profiler.tags(model=os.path.basename(model_path)):
+                # evaluate() replaces the features by their windows, so each model gets its own copy
+                samples[model_path] = evaluate(test_data.copy(), None, alphabet, None, backend=create_backend(model_path))
+        # A single model's report keeps the format of a checkpoint's
+        if len(model_paths) == 1:
+            samples = samples[model_paths[0]]
+    else:
+        from DeepSpeech import create_inference_graph
+        with profiler.stage('graph'):
+            graph = create_inference_graph(batch_size=FLAGS.test_batch_size, n_steps=-1)
+
+        checkpoint = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
+        if not checkpoint:
+            log_error('Checkpoint directory ({}) does not contain a valid checkpoint state.'.format(FLAGS.checkpoint_dir))
+            exit(1)
+
+        if FLAGS.test_loss_only:
+            # Ranks all checkpoints kept in the directory instead of decoding the latest one
+            results = rank_checkpoints_by_loss(test_data, graph, checkpoint.all_model_checkpoint_paths)
+            if FLAGS.test_output_file:
+                json.dump([{'checkpoint': path, 'loss': loss} for path, loss in results],
+                          open(FLAGS.test_output_file, 'w'), default=lambda x: float(x))
+            profiler.write(FLAGS.profile_dir, chrome_trace=FLAGS.profile_chrome_trace)
+            return
+
+        with profiler.tags(checkpoint=os.path.basename(checkpoint.model_checkpoint_path)):
+            samples = evaluate(test_data, graph, alphabet, os.path.abspath(checkpoint.model_checkpoint_path))
+
+    if FLAGS.test_output_file and samples is not None:
         # Save decoded tuples as JSON, converting NumPy floats to Python floats
         json.dump(samples, open(FLAGS.test_output_file, 'w'), default=lambda x: float(x))
 
+    profiler.write(FLAGS.profile_dir, chrome_trace=FLAGS.profile_chrome_trace)
+
 
 if __name__ == '__main__':
     create_flags()
+    create_extra_flags()
     tf.app.flags.DEFINE_string('hdf5_test_set', '', 'path to hdf5 file to cache test set features')
     #tf.app.flags.DEFINE_string('test_output_file', '', 'path to a file to save all src/decoded/distance/loss tuples')
     tf.app.run(main)
@@ -0,0 +1,38 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+import unittest
+
+from python_speech_features import mfcc
+from util.batch_mfcc import BatchMFCC, WIN_LEN, WIN_STEP
+
+
+def per_file_mfcc(audio, samplerate, numcep):
+    # The features of util.audio.audioToInputVector before the context is added
+    return mfcc(audio, samplerate=samplerate, numcep=numcep, winlen=WIN_LEN, winstep=WIN_STEP, winfunc=np.hamming)
+
+
+class TestBatchMFCC(unittest.TestCase):
+    def check_samplerate(self, samplerate):
+        rng = np.random.RandomState(0)
+        audios = [(rng.randn(int(seconds * samplerate)) * 3000).astype(np.int16) for seconds in (0.02, 0.5, 1.37, 2.)]
+        batched = BatchMFCC(samplerate, 26, 9)(audios)
+        for audio, features in zip(audios, batched):
+            reference = per_file_mfcc(audio, samplerate, 26)
+            self.assertEqual(features.shape, (len(reference) + 18, 26))
+            np.testing.assert_allclose(features[9:-9], reference, rtol=1e-9, atol=1e-9)
+            self.assertFalse(features[:9].any() or features[-9:].any())
+
+    def test_8khz(self):
+        self.check_samplerate(8000)
+
+    def test_16khz(self):
+        self.check_samplerate(16000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+import pytest
+import socket
+import unittest
+
+tf = pytest.importorskip('tensorflow')
+
+from util.gradient_accumulation import GradientAccumulator
+
+
+def free_address():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    address = 'localhost:%d' % sock.getsockname()[1]
+    sock.close()
+    return address
+
+
+class TestGradientAccumulatorPlacement(unittest.TestCase):
+    def test_workers_accumulate_separately(self):
+        cluster = tf.train.ClusterSpec({'ps': [free_address()], 'worker': [free_address(), free_address()]})
+        servers = [tf.train.Server(cluster, job_name=job, task_index=task)
+                   for job, task in [('ps', 0), ('worker', 0), ('worker', 1)]]
+        graphs = []
+        for task, server in enumerate(servers[1:]):
+            worker_device = '/job:worker/task:%d' % task
+            graph = tf.Graph()
+            with graph.as_default():
+                with tf.device(tf.train.replica_device_setter(worker_device=worker_device, cluster=cluster)):
+                    weights = tf.get_variable('weights', initializer=tf.zeros([3]))
+                    gradient = tf.placeholder(tf.float32, [3])
+                    accumulator = GradientAccumulator([(gradient, weights)], 2, device=worker_device)
+                (accumulator_variable,) = tf.local_variables()
+                self.assertEqual(weights.device, '/job:ps/task:0')
+                self.assertEqual(accumulator_variable.device, worker_device)
+                session = tf.Session(server.target)
+                if task == 0:
+                    session.run(tf.global_variables_initializer())
+                session.run(tf.local_variables_initializer())
+            graphs.append((session, gradient, accumulator, accumulator_variable))
+
+        for task, (session, gradient, accumulator, _) in enumerate(graphs):
+            session.run(accumulator.accumulate_op, feed_dict={gradient: np.full([3], 10. ** task)})
+
+        # Each worker only sees its own micro-batch
+        for task, (session, _, _, accumulator_variable) in enumerate(graphs):
+            np.testing.assert_allclose(session.run(accumulator_variable), np.full([3], 10. ** task))
+            session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+import pytest
+import shutil
+import tempfile
+import unittest
+
+tf = pytest.importorskip('tensorflow')
+
+from util.tflite_lstm import assign_fused_lstm_weights
+
+UNITS = 4
+STEPS = 5
+BATCH = 2
+DEPTH = 3
+
+
+def has_cells():
+    # LSTMBlockFusedCell lives in contrib, TF Lite's cell came with TensorFlow 1.13
+    try:
+        return hasattr(tf.contrib.rnn, 'LSTMBlockFusedCell') and hasattr(tf.lite.experimental.nn, 'TFLiteLSTMCell')
+    except AttributeError:
+        return False
+
+
+@unittest.skipUnless(has_cells(), 'needs TensorFlow 1.13 or later with contrib')
+class TestFusedLSTMExport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint_path = os.path.join(self.directory, 'train.ckpt')
+        self.inputs = np.random.RandomState(0).randn(STEPS, BATCH, DEPTH).astype(np.float32)
+        # Training's cell with random weights, including the bias of the forget gate
+        with tf.Graph().as_default():
+            cell = tf.contrib.rnn.LSTMBlockFusedCell(UNITS)
+            output, _ = cell(tf.constant(self.inputs), dtype=tf.float32)
+            with tf.Session() as session:
+                for v in tf.global_variables():
+                    session.run(tf.assign(v, tf.random_normal(v.get_shape(), seed=1)))
+                self.expected = session.run(output)
+                tf.train.Saver().save(session, self.checkpoint_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def restore(self, output, mapping, init_op=None):
+        with tf.Session() as session:
+            tf.train.Saver(mapping).restore(session, self.checkpoint_path)
+            if init_op is not None:
+                session.run(init_op)
+            return session.run(output)
+
+    def test_unrolled_export(self):
+        with tf.Graph().as_default():
+            cell = tf.nn.rnn_cell.LSTMCell(UNITS)
+            outputs, _ = tf.nn.static_rnn(cell, tf.unstack(tf.constant(self.inputs), STEPS), dtype=tf.float32)
+            mapping = {'lstm_fused_cell/' + v.op.name.split('/', 2)[2]: v for v in tf.global_variables()}
+            np.testing.assert_allclose(self.restore(tf.stack(outputs), mapping), self.expected, rtol=1e-5, atol=1e-5)
+
+    def test_fused_export(self):
+        with tf.Graph().as_default():
+            cell = tf.lite.experimental.nn.TFLiteLSTMCell(UNITS)
+            output, _ = tf.lite.experimental.nn.dynamic_rnn(cell, tf.constant(self.inputs),
+                                                            dtype=tf.float32, time_major=True)
+            cell_variables = tf.global_variables()
+            with tf.variable_scope('checkpoint_lstm'):
+                mapping = {'lstm_fused_cell/kernel': tf.get_variable('kernel', [DEPTH + UNITS, 4*UNITS]),
+                           'lstm_fused_cell/bias': tf.get_variable('bias', [4*UNITS])}
+            init_op = assign_fused_lstm_weights(mapping['lstm_fused_cell/kernel'], mapping['lstm_fused_cell/bias'],
+                                                cell_variables)
+            np.testing.assert_allclose(self.restore(output, mapping, init_op), self.expected, rtol=1e-5, atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+import pytest
+import shutil
+import tempfile
+import unittest
+
+tf = pytest.importorskip('tensorflow')
+
+from util.warmstart import Warmstart
+
+
+class TestWarmstart(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint_path = os.path.join(self.directory, 'source.ckpt')
+        # The source model has no "missing" variable and a smaller "partial" one
+        with tf.Graph().as_default():
+            tf.get_variable('full', initializer=np.arange(6, dtype=np.float32).reshape(2, 3))
+            tf.get_variable('partial', initializer=np.array([10., 11., 12.], dtype=np.float32))
+            with tf.Session() as session:
+                session.run(tf.global_variables_initializer())
+                tf.train.Saver().save(session, self.checkpoint_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_missing_and_partial_variables_get_initialized(self):
+        with tf.Graph().as_default():
+            full = tf.get_variable('full', initializer=tf.zeros([2, 3]))
+            partial = tf.get_variable('partial', initializer=tf.constant([-1., -2., -3., -4., -5.]))
+            missing = tf.get_variable('missing', initializer=tf.constant([7., 8.]))
+            dropped = tf.get_variable('dropped', initializer=tf.constant([9.]))
+
+            warmstart = Warmstart(self.checkpoint_path, [full, partial, missing], partial=True)
+            self.assertEqual(warmstart.missing, ['missing'])
+            self.assertEqual([v.op.name for v in warmstart.restored], ['full'])
+
+            # Initialized like in train()
+            restored = set(v.op.name for v in warmstart.restored)
+            scaffold = tf.train.Scaffold(
+                init_op=tf.variables_initializer([v for v in tf.global_variables() if v.op.name not in restored]),
+                init_fn=lambda scaffold, session: warmstart.run(session))
+            with tf.train.MonitoredSession(tf.train.ChiefSessionCreator(scaffold=scaffold)) as session:
+                values = session.run([full, partial, missing, dropped])
+
+        np.testing.assert_array_equal(values[0], np.arange(6).reshape(2, 3))
+        np.testing.assert_array_equal(values[1], [10., 11., 12., -4., -5.])
+        np.testing.assert_array_equal(values[2], [7., 8.])
+        np.testing.assert_array_equal(values[3], [9.])
+
+
+if __name__ == '__main__':
+    unittest.main()
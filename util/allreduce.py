@@ -0,0 +1,209 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import socket
+import tensorflow as tf
+import threading
+import time
+
+from six.moves import queue
+from util.logging import log_debug, log_info
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def ring_hosts(size, hosts='', port=29500):
+    r'''
+    Addresses of the ``size`` ranks of a ring, ``hosts`` is a comma separated list of host:port
+    pairs, ranks on the local host listening on consecutive ports from ``port`` otherwise.
+    '''
+    if hosts:
+        addresses = [h.strip() for h in hosts.split(',') if h.strip()]
+        if len(addresses) != size:
+            raise ValueError('Got {} allreduce hosts for {} ranks'.format(len(addresses), size))
+        return addresses
+    return ['127.0.0.1:%d' % (port + rank) for rank in range(size)]
+
+
+def receive_into(connection, view):
+    while len(view):
+        received = connection.recv_into(view)
+        if not received:
+            raise IOError('Allreduce peer closed the connection')
+        view = view[received:]
+
+
+class Ring(object):
+    r'''
+    Ring of ``size`` processes, each connected to its left and right neighbour by TCP,
+    that sum (or average) equally shaped float32 arrays by ring allreduce: a reduce-scatter
+    followed by an allgather, each taking ``size - 1`` steps in which every rank passes one
+    ``1/size`` chunk of the array to its right neighbour. Every rank sends and receives
+    ``2 * (size - 1) / size`` times the array's size, independent of the number of ranks.
+    All ranks have to call the collective operations in the same order with arrays of the same size.
+    Socket operations time out after ``timeout`` seconds, so a rank that stopped participating
+    makes the others fail rather than hang.
+    '''
+    def __init__(self, rank, addresses, timeout=600.):
+        self.rank = rank
+        self.size = len(addresses)
+        self._left = self._right = None
+        if self.size == 1:
+            return
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(parse_address(addresses[rank]))
+        listener.listen(1)
+        listener.settimeout(timeout)
+
+        # Peers might not listen yet, so connecting to the right neighbour gets retried
+        right_address = parse_address(addresses[(rank + 1) % self.size])
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self._right = socket.create_connection(right_address, timeout=timeout)
+                break
+            except (IOError, OSError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+        self._left, _ = listener.accept()
+        listener.close()
+
+        for connection in (self._left, self._right):
+            connection.settimeout(timeout)
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # Sending happens on a separate thread, so a rank can receive while its own send is pending
+        self._sends = queue.Queue()
+        self._sent = queue.Queue()
+        self._sender = threading.Thread(target=self._send_loop, name='RingSender')
+        self._sender.daemon = True
+        self._sender.start()
+        log_info('Allreduce rank {} of {} connected'.format(rank, self.size))
+
+    def _send_loop(self):
+        while True:
+            data = self._sends.get()
+            if data is None:
+                return
+            try:
+                self._right.sendall(data)
+                self._sent.put(None)
+            except Exception as e:
+                self._sent.put(e)
+
+    def _exchange(self, send, receive):
+        self._sends.put(send.view(np.uint8))
+        receive_into(self._left, memoryview(receive.view(np.uint8)))
+        error = self._sent.get()
+        if error is not None:
+            raise error
+
+    def allreduce(self, array, average=False):
+        r'''
+        Returns the element-wise sum (or mean) of ``array`` over all ranks as flat float32 array.
+        '''
+        result = np.array(array, dtype=np.float32).ravel()
+        if self.size > 1 and len(result):
+            bounds = np.linspace(0, len(result), self.size + 1).astype(np.int64)
+            chunks = [result[bounds[i]:bounds[i + 1]] for i in range(self.size)]
+            receive = np.empty(bounds[1] - bounds[0] + 1, dtype=np.float32)
+
+            # Reduce-scatter: afterwards chunk (rank + 1) % size holds the complete sum
+            for step in range(self.size - 1):
+                send_chunk = chunks[(self.rank - step) % self.size]
+                receive_chunk = chunks[(self.rank - step - 1) % self.size]
+                self._exchange(np.ascontiguousarray(send_chunk), receive[:len(receive_chunk)])
+                receive_chunk += receive[:len(receive_chunk)]
+
+            # Allgather: passing the complete sums around the ring
+            for step in range(self.size - 1):
+                send_chunk = chunks[(self.rank - step + 1) % self.size]
+                receive_chunk = chunks[(self.rank - step) % self.size]
+                self._exchange(np.ascontiguousarray(send_chunk), receive[:len(receive_chunk)])
+                receive_chunk[:] = receive[:len(receive_chunk)]
+
+        if average:
+            result /= self.size
+        return result
+
+    def allreduce_mean(self, array):
+        return self.allreduce(array, average=True)
+
+    def broadcast(self, array, root=0):
+        r'''
+        Returns ``array`` of rank ``root`` as flat float32 array on all ranks.
+        '''
+        array = np.asarray(array, dtype=np.float32)
+        return self.allreduce(array if self.rank == root else np.zeros_like(array))
+
+    def close(self):
+        if self._right is not None:
+            self._sends.put(None)
+            self._sender.join()
+            self._right.close()
+            self._left.close()
+            self._left = self._right = None
+
+
+def fusion_buckets(tensors, fusion_bytes):
+    r'''
+    Splits ``tensors`` into consecutive groups of up to ``fusion_bytes`` bytes (of float32 elements),
+    each group gets exchanged as one fused buffer.
+    '''
+    buckets = [[]]
+    bucket_bytes = 0
+    for tensor in tensors:
+        tensor_bytes = 4 * int(np.prod(tensor.get_shape().as_list()))
+        if buckets[-1] and bucket_bytes + tensor_bytes > fusion_bytes:
+            buckets.append([])
+            bucket_bytes = 0
+        buckets[-1].append(tensor)
+        bucket_bytes += tensor_bytes
+    return [bucket for bucket in buckets if bucket]
+
+
+def _fused_collective(tensors, fn, name, fusion_bytes):
+    buckets = fusion_buckets(tensors, fusion_bytes)
+    log_debug('Fusing {} tensors into {} {} buffers'.format(len(tensors), len(buckets), name))
+
+    results = []
+    previous = []
+    with tf.device('/cpu:0'):
+        for bucket in buckets:
+            flat = tf.concat([tf.reshape(tf.cast(t, tf.float32), [-1]) for t in bucket], 0)
+            # Chaining the buckets makes all ranks exchange them in the same order
+            with tf.control_dependencies(previous):
+                reduced = tf.py_func(fn, [flat], tf.float32, stateful=True, name=name)
+            reduced.set_shape(flat.get_shape())
+            previous = [reduced]
+            sizes = [int(np.prod(t.get_shape().as_list())) for t in bucket]
+            for t, part in zip(bucket, tf.split(reduced, sizes)):
+                results.append(tf.cast(tf.reshape(part, tf.shape(t)), t.dtype))
+    return results
+
+
+def allreduce_gradients(grads_and_vars, ring, fusion_bytes=64 * 2**20):
+    r'''
+    Averages the gradients of ``grads_and_vars`` over all ranks of ``ring``,
+    exchanging them in fused buffers of up to ``fusion_bytes`` bytes.
+    '''
+    if ring.size == 1:
+        return grads_and_vars
+    grads = _fused_collective([g for g, _ in grads_and_vars], ring.allreduce_mean, 'ring_allreduce', fusion_bytes)
+    return list(zip(grads, [v for _, v in grads_and_vars]))
+
+
+def broadcast_variables(variables, ring, fusion_bytes=64 * 2**20):
+    r'''
+    Returns an op that sets ``variables`` on all ranks of ``ring`` to their values on rank 0.
+    '''
+    if ring.size == 1:
+        return tf.no_op()
+    values = _fused_collective([v.read_value() for v in variables], ring.broadcast, 'ring_broadcast', fusion_bytes)
+    return tf.group(*[tf.assign(v, value) for v, value in zip(variables, values)])
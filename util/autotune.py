@@ -0,0 +1,260 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import numpy as np
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from multiprocessing import cpu_count
+from util.batch_mfcc import WIN_STEP
+from util.config import Config
+from util.flags import FLAGS
+from util.logging import log_info, log_warn
+
+DEFAULT_CACHE_PATH = os.path.join('~', '.deepspeech_autotune.json')
+
+BATCH_SIZES = (1, 2, 4, 8, 16, 32, 64)
+
+# Whether this process created a TensorFlow session already, see note_sessions_created()
+_sessions_created = False
+
+
+def _powers_of_two(limit):
+    values = [1]
+    while values[-1] * 2 <= limit:
+        values.append(values[-1] * 2)
+    if values[-1] != limit:
+        values.append(limit)
+    return values
+
+
+def _cores():
+    try:
+        return cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def cache_key(sample):
+    r'''
+    Settings are cached per host, model size and utterance length (rounded to a power of two steps),
+    as the best ones depend on all of them.
+    '''
+    mean_steps = max(int(np.mean(sample['features_len'])), 1)
+    return '%s|cores=%d|n_hidden=%d|steps=%d|lm=%s' % (socket.gethostname(), _cores(), FLAGS.n_hidden,
+                                                      2 ** int(np.round(np.log2(mean_steps))),
+                                                      os.path.basename(FLAGS.lm_binary_path))
+
+
+def _load_cache(path):
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as fin:
+            return json.load(fin)
+    except ValueError:
+        log_warn('Ignoring unreadable autotune cache {}'.format(path))
+        return {}
+
+
+def _save_cache(path, cache):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fout:
+        json.dump(cache, fout, indent=2, sort_keys=True)
+    os.rename(temp_path, path)
+
+
+def note_sessions_created():
+    r'''
+    Records that this process created a TensorFlow session (e.g. for training), which sized the
+    process' thread pools for good.
+    '''
+    global _sessions_created
+    _sessions_created = True
+
+
+def apply_settings(settings):
+    r'''
+    Makes the evaluation use the tuned ``settings``. TensorFlow sizes its thread pools at the first
+    session of a process, so the thread counts only get applied if no session got created yet (see
+    :func:`note_sessions_created`). Otherwise they stay cached for runs of fresh processes.
+    '''
+    FLAGS.test_batch_size = settings['batch_size']
+    FLAGS.decoder_processes = settings['decoder_processes']
+    threads = (settings['intra_op_threads'], settings['inter_op_threads'])
+    pools = (Config.session_config.intra_op_parallelism_threads, Config.session_config.inter_op_parallelism_threads)
+    if _sessions_created and threads != pools:
+        log_warn('TensorFlow\'s thread pools of this process got sized by an earlier session, evaluating with '
+                 'batch size {batch_size} and {decoder_processes} decoder processes but not the autotuned '
+                 '{intra_op_threads} intra op and {inter_op_threads} inter op threads - they are cached for '
+                 'runs that only test'.format(**settings))
+        return
+    Config.session_config.intra_op_parallelism_threads = settings['intra_op_threads']
+    Config.session_config.inter_op_parallelism_threads = settings['inter_op_threads']
+    log_info('Evaluating with batch size {batch_size}, {intra_op_threads} intra op and {inter_op_threads} inter op '
+             'threads and {decoder_processes} decoder processes'.format(**settings))
+
+
+class _Trials(object):
+    r'''
+    Runs calibration trials, each in a child process, as thread pool sizes can't change within a process.
+    Children are copies of this process with the trial's flags, see :func:`run_trial`.
+    '''
+    def __init__(self, sample_path, checkpoint_path):
+        self.sample_path = sample_path
+        self.checkpoint_path = checkpoint_path
+        self.results = {}
+
+    def run(self, batch_size, intra, inter, decoder_processes=()):
+        key = (batch_size, intra, inter)
+        if key in self.results and not decoder_processes:
+            return self.results[key]['audio_seconds_per_second']
+
+        fd, spec_path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as fout:
+            json.dump({'sample_path': self.sample_path,
+                       'checkpoint_path': self.checkpoint_path,
+                       'decoder_processes': list(decoder_processes)}, fout)
+        argv = [sys.executable, sys.argv[0]] + sys.argv[1:] + [
+            '--autotune_trial=%s' % spec_path,
+            '--noautotune',
+            '--test_batch_size=%d' % batch_size,
+            '--intra_op_parallelism_threads=%d' % intra,
+            '--inter_op_parallelism_threads=%d' % inter,
+        ]
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(argv, stdout=devnull, stderr=devnull)
+            with open(spec_path + '.result') as fin:
+                result = json.load(fin)
+        except (subprocess.CalledProcessError, IOError, ValueError) as e:
+            log_warn('Autotune trial with batch size {}, {} intra and {} inter op threads failed: {}'.format(
+                batch_size, intra, inter, e))
+            result = {'audio_seconds_per_second': 0., 'decoder_seconds': {}}
+        finally:
+            for path in (spec_path, spec_path + '.result'):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+        self.results[key] = result
+        log_info('Autotune trial with batch size {}, {} intra and {} inter op threads: {:.2f} audio seconds/s'.format(
+            batch_size, intra, inter, result['audio_seconds_per_second']))
+        return result['audio_seconds_per_second']
+
+
+def autotune(test_data, checkpoint_path=None):
+    r'''
+    Picks the batch size, thread pool sizes and decoder processes of the highest throughput on a sample
+    of ``test_data`` and applies them (see :func:`apply_settings`). Settings are looked up in and added
+    to the per host cache ``--autotune_cache``. The search tries batch sizes first, then intra op and
+    inter op threads, each with the best values found so far, and finally the decoder processes.
+    Returns the settings.
+    '''
+    cache_path = os.path.expanduser(FLAGS.autotune_cache or DEFAULT_CACHE_PATH)
+    count = min(FLAGS.autotune_samples, len(test_data))
+    # Evenly spread over the test set, so the sample's lengths are distributed like the set's
+    indices = np.linspace(0, len(test_data) - 1, count).astype(int)
+    sample = test_data.iloc[np.unique(indices)].sort_values(by='features_len', ascending=False)
+
+    key = cache_key(sample)
+    cache = _load_cache(cache_path)
+    if key in cache:
+        log_info('Using autotuned settings of {} cached in {}'.format(key, cache_path))
+        apply_settings(cache[key])
+        return cache[key]
+
+    log_info('Autotuning evaluation settings on {} samples...'.format(len(sample)))
+    start = time.time()
+    fd, sample_path = tempfile.mkstemp(suffix='.pkl')
+    os.close(fd)
+    sample.to_pickle(sample_path)
+    try:
+        trials = _Trials(sample_path, checkpoint_path)
+        cores = _cores()
+        batch_size, intra, inter = FLAGS.test_batch_size, cores, 1
+
+        batch_sizes = [b for b in BATCH_SIZES if b <= len(sample)] or [len(sample)]
+        batch_size = max(batch_sizes, key=lambda b: trials.run(b, intra, inter))
+        intra = max(_powers_of_two(cores), key=lambda i: trials.run(batch_size, i, inter))
+        inter = max([i for i in (1, 2, 4) if i <= cores], key=lambda i: trials.run(batch_size, intra, i))
+
+        # One more trial with the best inference settings times the decoder with each number of processes
+        decoder_candidates = _powers_of_two(cores)
+        trials.run(batch_size, intra, inter, decoder_processes=decoder_candidates)
+        decoder_seconds = trials.results[(batch_size, intra, inter)]['decoder_seconds']
+        decoder_processes = min(decoder_candidates, key=lambda p: decoder_seconds.get(str(p), float('inf')))
+    finally:
+        os.unlink(sample_path)
+
+    settings = {
+        'batch_size': batch_size,
+        'intra_op_threads': intra,
+        'inter_op_threads': inter,
+        'decoder_processes': decoder_processes,
+        'audio_seconds_per_second': trials.results[(batch_size, intra, inter)]['audio_seconds_per_second'],
+    }
+    log_info('Autotuned in {:.0f}s with {} trials'.format(time.time() - start, len(trials.results) + 1))
+    cache[key] = settings
+    _save_cache(cache_path, cache)
+    apply_settings(settings)
+    return settings
+
+
+def run_trial(spec_path, create_inference_graph):
+    r'''
+    Entry point of an autotune trial's child process: times the inference of the sample at the
+    process' batch size and thread pool sizes, and the decoding of its outputs with each of the
+    spec's numbers of decoder processes.
+    '''
+    import pandas
+    import tensorflow as tf
+
+    from ds_ctcdecoder import ctc_beam_search_decoder_batch, Scorer
+    from evaluate import create_windows, pad_to_dense, split_data
+
+    with open(spec_path) as fin:
+        spec = json.load(fin)
+    sample = pandas.read_pickle(spec['sample_path'])
+    sample['features'] = sample['features'].apply(create_windows)
+    batches = [(pad_to_dense(batch['features'].values), batch['features_len'].values)
+               for batch in split_data(sample, FLAGS.test_batch_size)]
+
+    inputs, outputs, _ = create_inference_graph(batch_size=FLAGS.test_batch_size, n_steps=-1)
+    transposed = tf.transpose(outputs['outputs'], [1, 0, 2])
+    with tf.Session(config=Config.session_config) as session:
+        if spec['checkpoint_path']:
+            mapping = {v.op.name: v for v in tf.global_variables() if not v.op.name.startswith('previous_state_')}
+            tf.train.Saver(mapping).restore(session, spec['checkpoint_path'])
+        else:
+            # Weights don't change the inference time, only the decoding time
+            session.run(tf.global_variables_initializer())
+
+        def infer(features, features_len):
+            session.run(outputs['initialize_state'])
+            return session.run(transposed, feed_dict={inputs['input']: features, inputs['input_lengths']: features_len})
+
+        # Warm up run, it includes allocations and graph optimizations
+        infer(*batches[0])
+        start = time.time()
+        logitses = [infer(features, features_len) for features, features_len in batches]
+        seconds = time.time() - start
+
+    audio_seconds = sum(features_len.sum() for _, features_len in batches) * WIN_STEP
+    result = {'audio_seconds_per_second': audio_seconds / max(seconds, 1e-9), 'decoder_seconds': {}}
+
+    if spec['decoder_processes']:
+        scorer = Scorer(FLAGS.lm_alpha, FLAGS.lm_beta, FLAGS.lm_binary_path, FLAGS.lm_trie_path, Config.alphabet)
+        for processes in spec['decoder_processes']:
+            start = time.time()
+            for logits, (_, features_len) in zip(logitses, batches):
+                ctc_beam_search_decoder_batch(logits, features_len.astype(np.int32), Config.alphabet, FLAGS.beam_width,
+                                              num_processes=processes, scorer=scorer)
+            result['decoder_seconds'][str(processes)] = time.time() - start
+
+    with open(spec_path + '.result', 'w') as fout:
+        json.dump(result, fout)
@@ -0,0 +1,128 @@
+from __future__ import absolute_import, division, print_function
+
+import decimal
+import numpy as np
+import scipy.io.wavfile as wav
+
+# Parameters of the per-file front-end in util/audio.py (python_speech_features.mfcc)
+WIN_LEN = 0.032
+WIN_STEP = 0.02
+N_FILT = 26
+PREEMPH = 0.97
+CEP_LIFTER = 22
+# python_speech_features.mfcc's default FFT size, it does not depend on the sample rate
+NFFT = 512
+
+
+def _round_half_up(number):
+    return int(decimal.Decimal(number).quantize(decimal.Decimal('1'), rounding=decimal.ROUND_HALF_UP))
+
+
+def _hz2mel(hz):
+    return 2595 * np.log10(1 + hz / 700.)
+
+
+def _mel2hz(mel):
+    return 700 * (10**(mel / 2595.0) - 1)
+
+
+def _filterbanks(nfilt, nfft, samplerate):
+    # Triangular filters between 0Hz and samplerate/2, equally spaced on the mel scale
+    melpoints = np.linspace(_hz2mel(0), _hz2mel(samplerate / 2), nfilt + 2)
+    bins = np.floor((nfft + 1) * _mel2hz(melpoints) / samplerate)
+    positions = np.arange(nfft // 2 + 1)[np.newaxis, :]
+    left, center, right = bins[:-2, np.newaxis], bins[1:-1, np.newaxis], bins[2:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rising = np.where((positions >= left) & (positions < center), (positions - left) / (center - left), 0.)
+        falling = np.where((positions >= center) & (positions < right), (right - positions) / (right - center), 0.)
+    return rising + falling
+
+
+def _dct_matrix(numcep, nfilt):
+    # Rows of an orthonormal DCT-II, only the first numcep coefficients are kept
+    k = np.arange(numcep)[:, np.newaxis]
+    n = np.arange(nfilt)[np.newaxis, :]
+    matrix = np.cos(np.pi * k * (2 * n + 1) / (2. * nfilt)) * np.sqrt(2. / nfilt)
+    matrix[0] *= np.sqrt(0.5)
+    return matrix
+
+
+class BatchMFCC(object):
+    r'''
+    Computes the MFCC features of many utterances at once.
+    Frames of all utterances are gathered into a single matrix, so windowing, FFT,
+    mel filterbank and DCT each run as one NumPy operation over the whole batch.
+    Results match ``util.audio.audioToInputVector`` at any sample rate, including its
+    truncation of frames longer than the FFT size.
+    '''
+    def __init__(self, samplerate, numcep, numcontext):
+        self.samplerate = samplerate
+        self.numcep = numcep
+        self.numcontext = numcontext
+        self.frame_len = _round_half_up(WIN_LEN * samplerate)
+        self.frame_step = _round_half_up(WIN_STEP * samplerate)
+        self.nfft = NFFT
+        self.window = np.hamming(self.frame_len)
+        self.filterbanks = _filterbanks(N_FILT, self.nfft, samplerate).T
+        self.dct = _dct_matrix(numcep, N_FILT).T
+        self.lifter = 1 + (CEP_LIFTER / 2.) * np.sin(np.pi * np.arange(numcep) / CEP_LIFTER)
+
+    def num_frames(self, num_samples):
+        if num_samples <= self.frame_len:
+            return 1
+        return 1 + int(np.ceil((num_samples - self.frame_len) / self.frame_step))
+
+    def __call__(self, signals):
+        r'''
+        Returns the list of ``[n_frames + 2*numcontext, numcep]`` feature matrices of ``signals``.
+        '''
+        frames_per_signal = np.array([self.num_frames(len(signal)) for signal in signals])
+
+        # Every signal gets its own zero padded segment in one buffer. Segment lengths are
+        # multiples of the frame step, so the frames of all signals are rows of a single
+        # strided view of that buffer.
+        padded_lengths = (frames_per_signal - 1) * self.frame_step + self.frame_len
+        segment_steps = -(-padded_lengths // self.frame_step)
+        segment_starts = np.concatenate(([0], np.cumsum(segment_steps)[:-1])) * self.frame_step
+        buffer = np.zeros(np.sum(segment_steps) * self.frame_step + self.frame_len)
+        for start, signal in zip(segment_starts, signals):
+            signal = np.asarray(signal, dtype=np.float64)
+            # Pre-emphasis, the first sample of the signal is kept as is
+            buffer[start] = signal[0]
+            buffer[start + 1:start + len(signal)] = signal[1:] - PREEMPH * signal[:-1]
+
+        all_frames = np.lib.stride_tricks.as_strided(
+            buffer,
+            (len(buffer) // self.frame_step - self.frame_len // self.frame_step, self.frame_len),
+            (buffer.strides[0] * self.frame_step, buffer.strides[0]),
+            writeable=False)
+        rows = np.repeat(segment_starts // self.frame_step - np.concatenate(([0], np.cumsum(frames_per_signal)[:-1])), frames_per_signal)
+        frames = all_frames[rows + np.arange(len(rows))] * self.window
+
+        spectrum = np.fft.rfft(frames, self.nfft)
+        pspec = 1.0 / self.nfft * (np.square(spectrum.real) + np.square(spectrum.imag))
+        energy = np.sum(pspec, 1)
+        energy = np.where(energy == 0, np.finfo(float).eps, energy)
+        feat = np.dot(pspec, self.filterbanks)
+        feat = np.where(feat == 0, np.finfo(float).eps, feat)
+        feat = np.dot(np.log(feat), self.dct) * self.lifter
+        feat[:, 0] = np.log(energy)
+
+        empty_context = np.zeros((self.numcontext, self.numcep), dtype=feat.dtype)
+        return [np.concatenate((empty_context, features, empty_context))
+                for features in np.split(feat, np.cumsum(frames_per_signal)[:-1])]
+
+
+def batch_audiofiles_to_input_vectors(audio_filenames, numcep, numcontext):
+    r'''
+    Batched counterpart of ``util.audio.audiofile_to_input_vector``.
+    Files are grouped by sample rate, each group being computed in one go.
+    '''
+    audios = [wav.read(audio_filename) for audio_filename in audio_filenames]
+    results = [None] * len(audios)
+    for samplerate in set(fs for fs, _ in audios):
+        positions = [i for i, (fs, _) in enumerate(audios) if fs == samplerate]
+        mfcc = BatchMFCC(samplerate, numcep, numcontext)
+        for i, features in zip(positions, mfcc([audios[i][1] for i in positions])):
+            results[i] = features
+    return results
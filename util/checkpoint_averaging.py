@@ -0,0 +1,100 @@
+from __future__ import absolute_import, division, print_function
+
+import fnmatch
+import numpy as np
+import os
+import tensorflow as tf
+import time
+
+from util.logging import log_info, log_warn
+
+# Suffix of the shadow variables tf.train.ExponentialMovingAverage keeps of the trained ones
+EMA_SUFFIX = '/ExponentialMovingAverage'
+
+
+def checkpoints_matching(checkpoint_dir, pattern):
+    r'''
+    Returns the prefixes of the checkpoints in ``checkpoint_dir`` whose name matches the
+    shell ``pattern`` (e.g. ``model.ckpt-*``), ordered by global step.
+    '''
+    prefixes = [os.path.join(checkpoint_dir, name[:-len('.index')]) for name in os.listdir(checkpoint_dir)
+                if name.endswith('.index') and fnmatch.fnmatch(name[:-len('.index')], pattern)]
+    return sorted(prefixes, key=checkpoint_step)
+
+
+def checkpoint_step(checkpoint_path):
+    try:
+        return int(checkpoint_path.rsplit('-', 1)[1])
+    except (IndexError, ValueError):
+        return -1
+
+
+def average_checkpoints(checkpoint_paths, output_path):
+    r'''
+    Writes the mean of the variables of ``checkpoint_paths`` as the checkpoint ``output_path``.
+    Variables are averaged one at a time, reading each from all checkpoints into a running mean,
+    so only the averaged model and a single variable of one checkpoint are held in memory.
+    Non floating point variables (``global_step``) are taken from the last checkpoint.
+    Variables missing from some of the checkpoints are averaged over the others.
+    Returns ``output_path``.
+    '''
+    if not checkpoint_paths:
+        raise ValueError('No checkpoints to average')
+    start = time.time()
+    readers = [tf.train.load_checkpoint(path) for path in checkpoint_paths]
+    shapes = readers[-1].get_variable_to_shape_map()
+    dtypes = readers[-1].get_variable_to_dtype_map()
+
+    with tf.Graph().as_default():
+        variables = {}
+        assigns = []
+        for name in sorted(shapes):
+            with tf.device('/cpu:0'):
+                variable = tf.get_variable(name, shapes[name], dtypes[name], trainable=False)
+            value = tf.placeholder(dtypes[name], shapes[name])
+            variables[name] = variable
+            assigns.append((name, value, tf.assign(variable, value)))
+        saver = tf.train.Saver(variables, max_to_keep=None)
+
+        total_bytes = 0
+        with tf.Session() as session:
+            for name, value, assign in assigns:
+                if not dtypes[name].is_floating:
+                    mean = readers[-1].get_tensor(name)
+                else:
+                    # Running mean in double precision, loading one checkpoint's tensor at a time
+                    mean = np.zeros(shapes[name], dtype=np.float64)
+                    count = 0
+                    for path, reader in zip(checkpoint_paths, readers):
+                        if not reader.has_tensor(name):
+                            log_warn('Checkpoint {} has no tensor {}'.format(path, name))
+                            continue
+                        count += 1
+                        mean += (reader.get_tensor(name) - mean) / count
+                    mean = mean.astype(dtypes[name].as_numpy_dtype)
+                session.run(assign, feed_dict={value: mean})
+                total_bytes += mean.nbytes
+            # Leaves the checkpoint state of the directory, training resumes from its own checkpoints
+            saver.save(session, output_path, write_state=False)
+
+    log_info('Averaged {} variables ({:.1f} MB) of {} checkpoints into {} in {:.2f}s'.format(
+        len(assigns), total_bytes / 2.**20, len(checkpoint_paths), output_path, time.time() - start))
+    return output_path
+
+
+def ema_mapping(mapping, checkpoint_path):
+    r'''
+    Returns the saver ``mapping`` of checkpoint names to variables with the variables restored from
+    their exponential moving averages, if the checkpoint ``checkpoint_path`` has them (see ``--ema_decay``).
+    '''
+    reader = tf.train.load_checkpoint(checkpoint_path)
+    averaged = {}
+    count = 0
+    for name, variable in mapping.items():
+        if reader.has_tensor(name + EMA_SUFFIX):
+            name += EMA_SUFFIX
+            count += 1
+        averaged[name] = variable
+    if count == 0:
+        log_warn('Checkpoint {} has no moving averages, restoring its plain weights'.format(checkpoint_path))
+    return averaged
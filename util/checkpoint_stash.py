@@ -0,0 +1,122 @@
+from __future__ import absolute_import, division, print_function
+
+import errno
+import fcntl
+import glob
+import os
+import shutil
+import threading
+
+from six.moves import queue
+from util.logging import log_debug, log_info, log_warn
+
+# ioctl cloning a file's extents on filesystems with copy-on-write support (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def _reflink(source, destination):
+    with open(source, 'rb') as fin, open(destination, 'wb') as fout:
+        fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+
+
+def link_or_copy(source, destination):
+    r'''
+    Makes ``destination`` a hard link of ``source``, a reflink if that is not possible
+    (e.g. across filesystems) and a plain copy as last resort.
+    Checkpoint files never get modified in place, so sharing their data is safe.
+    '''
+    try:
+        os.link(source, destination)
+        return 'hardlink'
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    try:
+        _reflink(source, destination)
+        return 'reflink'
+    except (IOError, OSError):
+        if os.path.exists(destination):
+            os.unlink(destination)
+    shutil.copyfile(source, destination)
+    return 'copy'
+
+
+class CheckpointStash(object):
+    r'''
+    Archives checkpoints into ``stash_dir`` on a background thread.
+    Stashed checkpoints are named by ``name_template``, a format string with the fields
+    ``name`` (file name of the checkpoint), ``step`` (global step) and any field passed to
+    :meth:`submit`. Files are linked or copied under temporary names and renamed once complete,
+    the ``.meta`` file last, so a visible ``.meta`` always belongs to a complete checkpoint.
+    Only the ``keep`` most recent checkpoints stashed by this instance are kept (0 keeps all).
+    :meth:`submit` never blocks: requests are dropped with a warning while ``queue_size``
+    others are pending.
+    '''
+    def __init__(self, stash_dir, name_template, keep=0, queue_size=4):
+        self.stash_dir = stash_dir
+        self.name_template = name_template
+        self.keep = keep
+        self._stashed = []
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name='CheckpointStash')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, checkpoint_path, **fields):
+        try:
+            self._queue.put_nowait((checkpoint_path, fields))
+        except queue.Full:
+            log_warn('Checkpoint stash is busy, not stashing {}'.format(checkpoint_path))
+
+    def close(self):
+        r'''
+        Finishes all pending requests and stops the background thread.
+        '''
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            try:
+                self._stash(*request)
+            except Exception as e:
+                log_warn('Stashing checkpoint {} failed: {}'.format(request[0], e))
+
+    def _stash(self, checkpoint_path, fields):
+        base_name = os.path.basename(checkpoint_path)
+        step = base_name.rsplit('-', 1)[-1]
+        name = self.name_template.format(name=base_name, step=int(step) if step.isdigit() else step, **fields)
+
+        # .meta goes last, as its appearance marks the checkpoint as complete
+        files = sorted(glob.glob(checkpoint_path + '.*'), key=lambda path: path.endswith('.meta'))
+        if not any(path.endswith('.index') for path in files):
+            log_warn('Checkpoint {} vanished before it could be stashed'.format(checkpoint_path))
+            return
+
+        if not os.path.isdir(self.stash_dir):
+            os.makedirs(self.stash_dir)
+
+        destinations = []
+        for source in files:
+            destination = os.path.join(self.stash_dir, name + source[len(checkpoint_path):])
+            temp_destination = destination + '.tmp'
+            if os.path.exists(temp_destination):
+                os.unlink(temp_destination)
+            method = link_or_copy(source, temp_destination)
+            os.rename(temp_destination, destination)
+            destinations.append(destination)
+            log_debug('Stashed {} as {} ({})'.format(source, destination, method))
+        log_info('Stashed checkpoint {} as {}'.format(base_name, name))
+
+        self._stashed = [(n, paths) for n, paths in self._stashed if n != name]
+        self._stashed.append((name, destinations))
+        while self.keep > 0 and len(self._stashed) > self.keep:
+            name, paths = self._stashed.pop(0)
+            # Removing .meta first, so the checkpoint stops being visible as a whole
+            for path in reversed(paths):
+                if os.path.exists(path):
+                    os.unlink(path)
+            log_debug('Removed stashed checkpoint {}'.format(name))
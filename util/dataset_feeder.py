@@ -0,0 +1,111 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import tensorflow as tf
+
+from util.text import ctc_label_dense_to_sparse
+
+
+def bucket_boundaries(data_sets, num_buckets):
+    r'''
+    Splits the range of feature lengths of ``data_sets`` into ``num_buckets`` buckets of about equal sample count.
+    '''
+    lengths = np.concatenate([data_set.data['features_len'].values for data_set in data_sets])
+    quantiles = np.percentile(lengths, np.linspace(0, 100, num_buckets + 1)[1:-1])
+    return sorted(set(int(q) + 1 for q in quantiles))
+
+
+class DatasetFeeder(object):
+    r'''
+    ``tf.data`` based alternative to ``util.feeding.ModelFeeder`` with the same interface.
+    Every tower gets one input pipeline per data set. Sample indices are drawn from the data set's
+    ``next_index`` (i.e. from the training coordinator) by a generator, so towers and workers get
+    disjoint shards of the samples. Context windows get created in parallel map calls,
+    samples are optionally bucketed by length before padded batching and batches get prefetched
+    onto the tower's device. No Python threads feed the pipelines.
+    With ``batch_tokens`` (and buckets) the batch size of each bucket is chosen to hold about
+    ``batch_tokens`` time steps instead of the data set's batch size of samples.
+    '''
+    def __init__(self,
+                 train_set,
+                 dev_set,
+                 numcep,
+                 numcontext,
+                 devices,
+                 parallel_calls=4,
+                 prefetch=2,
+                 num_buckets=0,
+                 batch_tokens=0):
+        self.train = train_set
+        self.dev = dev_set
+        self.sets = [train_set, dev_set]
+        self.numcep = numcep
+        self.numcontext = numcontext
+        self.ph_set_index = tf.placeholder(tf.int32, [], name='Set_Selector')
+
+        boundaries = bucket_boundaries(self.sets, num_buckets) if num_buckets > 1 else None
+        self._batch_tokens = batch_tokens
+        self._iterators = []
+        with tf.device('/cpu:0'):
+            for device in devices:
+                self._iterators.append([self._create_dataset(data_set, device, parallel_calls, prefetch, boundaries)
+                                        .make_initializable_iterator()
+                                        for data_set in self.sets])
+        self._initializers = [iterator.initializer for iterators in self._iterators for iterator in iterators]
+
+    def _create_dataset(self, data_set, device, parallel_calls, prefetch, boundaries):
+        def generate():
+            index = -1
+            while True:
+                index = data_set.next_index(index) % len(data_set.data)
+                features, features_len, transcript, transcript_len = data_set.data.iloc[index]
+                yield features, features_len, transcript, transcript_len
+
+        window_size = 2*self.numcontext+1
+        def create_windows(features, features_len, transcript, transcript_len):
+            # Overlapping windows of numcontext (past) + 1 (present) + numcontext (future) steps
+            features = tf.contrib.signal.frame(features, window_size, 1, axis=0)
+            return features, features_len, transcript, transcript_len
+
+        padded_shapes = ([None, window_size, self.numcep], [], [None], [])
+        dataset = tf.data.Dataset.from_generator(generate,
+                                                 (tf.float32, tf.int32, tf.int32, tf.int32),
+                                                 ([None, self.numcep], [], [None], []))
+        dataset = dataset.map(create_windows, num_parallel_calls=parallel_calls)
+        if boundaries:
+            dataset = dataset.apply(tf.contrib.data.bucket_by_sequence_length(
+                lambda features, features_len, transcript, transcript_len: features_len,
+                boundaries,
+                self._bucket_batch_sizes(data_set, boundaries),
+                padded_shapes=padded_shapes))
+        else:
+            dataset = dataset.padded_batch(data_set.batch_size, padded_shapes=padded_shapes)
+
+        if 'gpu' in device.lower():
+            return dataset.apply(tf.contrib.data.prefetch_to_device(device, prefetch))
+        return dataset.prefetch(prefetch)
+
+    def _bucket_batch_sizes(self, data_set, boundaries):
+        if not self._batch_tokens:
+            return [data_set.batch_size] * (len(boundaries) + 1)
+        # A bucket's longest samples are just below its upper boundary, the last one's are the data set's longest
+        upper_bounds = boundaries + [int(data_set.data['features_len'].max()) + 1]
+        return [max(1, self._batch_tokens // upper_bound) for upper_bound in upper_bounds]
+
+    def set_data_set(self, feed_dict, data_set):
+        feed_dict[self.ph_set_index] = self.sets.index(data_set)
+
+    def start_queue_threads(self, session, coord):
+        session.run(self._initializers)
+        return []
+
+    def close_queues(self, session):
+        pass
+
+    def next_batch(self, tower_feeder_index):
+        train_iterator, dev_iterator = self._iterators[tower_feeder_index]
+        source, source_lengths, target, target_lengths = tf.cond(tf.equal(self.ph_set_index, 0),
+                                                                 train_iterator.get_next,
+                                                                 dev_iterator.get_next)
+        sparse_labels = ctc_label_dense_to_sparse(target, target_lengths, tf.shape(source_lengths)[0])
+        return source, source_lengths, sparse_labels
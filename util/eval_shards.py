@@ -0,0 +1,100 @@
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import json
+import os
+import tempfile
+
+from util.logging import log_info, log_warn
+
+# Per-sample columns of a shard's state, concatenated in shard order when merging
+ROW_COLUMNS = ('labels', 'predictions', 'distances', 'losses')
+
+# Accumulators of a shard's state, summed when merging
+SUM_COLUMNS = ('count', 'levenshtein', 'label_length', 'distance', 'loss')
+
+
+def model_version(model_path):
+    r'''
+    Identifies the current content of a checkpoint (by its index file) or exported model, so shards
+    scored with an earlier version of a rewritten file (e.g. an averaged checkpoint) are not reused.
+    '''
+    for path in (model_path + '.index', model_path):
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            return os.path.abspath(model_path), int(stat.st_mtime), stat.st_size
+    return os.path.abspath(model_path), None, None
+
+
+def test_set_fingerprint(test_data, labels, *settings):
+    r'''
+    Returns a digest of the samples of ``test_data``, their :class:`~util.labels.PackedLabels`
+    ``labels`` and the ``settings`` affecting their results,
+    so states of shards of another test set, batch size or decoder configuration never get reused.
+    '''
+    digest = hashlib.sha1()
+    digest.update(str(len(test_data)).encode('utf-8'))
+    digest.update(test_data['features_len'].values.tobytes())
+    digest.update(labels.offsets.tobytes())
+    digest.update(labels.flat.tobytes())
+    for setting in settings:
+        digest.update(repr(setting).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def empty_shard_state():
+    state = {column: [] for column in ROW_COLUMNS}
+    state.update({column: 0 for column in SUM_COLUMNS})
+    state['nbest'] = None
+    return state
+
+
+class ShardStore(object):
+    r'''
+    Persists the states of the shards of one model's evaluation of a test set in
+    ``state_dir/<name>_<fingerprint>/``, one JSON file per shard. Files are written under a
+    temporary name and renamed, so a state is either complete or absent.
+    '''
+    def __init__(self, state_dir, name, fingerprint):
+        self.directory = os.path.join(state_dir, '%s_%s' % (name, fingerprint))
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            # Evaluation processes of the other shards may have created it concurrently
+            if not os.path.isdir(self.directory):
+                raise
+
+    def path(self, shard):
+        return os.path.join(self.directory, 'shard_%05d.json' % shard)
+
+    def load(self, shard):
+        path = self.path(shard)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path) as fin:
+                return json.load(fin)
+        except ValueError as e:
+            log_warn('Ignoring unreadable shard state {}: {}'.format(path, e))
+            return None
+
+    def save(self, shard, state):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fout:
+            # Converting NumPy floats to Python floats
+            json.dump(state, fout, default=lambda x: float(x))
+        os.rename(temp_path, self.path(shard))
+        log_info('Saved state of shard {} ({} samples)'.format(shard, state['count']))
+
+
+def merge_shard_states(states):
+    r'''
+    Merges the states of consecutive shards into the state of the whole test set.
+    '''
+    merged = empty_shard_state()
+    for state in states:
+        for column in ROW_COLUMNS:
+            merged[column].extend(state[column])
+        for column in SUM_COLUMNS:
+            merged[column] += state[column]
+    return merged
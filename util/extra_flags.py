@@ -0,0 +1,164 @@
+from __future__ import absolute_import, division, print_function
+
+import tensorflow as tf
+
+
+def create_extra_flags():
+    r'''
+    Defines the flags of the functionality living in this repository,
+    on top of the upstream ones created by ``util.flags.create_flags()``.
+    '''
+    f = tf.app.flags
+
+    # Preprocessing
+    # =============
+
+    f.DEFINE_string('feature_cache_dir', '', 'directory of the content-addressed per-file feature cache - empty to disable it')
+    f.DEFINE_integer('preprocess_workers', 0, 'number of processes computing features - 0 uses all available CPU cores, 1 computes them in-process')
+    f.DEFINE_integer('preprocess_chunk_size', 1000, 'number of CSV rows read at once when streaming the sample lists')
+    f.DEFINE_integer('preprocess_task_size', 16, 'number of files handed to a preprocessing worker at once')
+    f.DEFINE_boolean('batch_mfcc', False, 'compute the MFCCs of many files at once with the vectorized front-end of util/batch_mfcc.py')
+
+    # Profiling
+    # =========
+
+    f.DEFINE_string('profile_dir', '', 'directory to write per-stage timings of evaluation runs to (profile.json) - empty to disable profiling')
+    f.DEFINE_boolean('profile_chrome_trace', False, 'also write the stage timings as a Chrome trace timeline (trace.json) into --profile_dir')
+    f.DEFINE_string('profile_tf_batches', '', 'comma separated indices of test batches whose TensorFlow RunMetadata gets captured into --profile_dir')
+
+    # Training throughput
+    # ===================
+
+    f.DEFINE_string('throughput_log', '', 'path of a JSON lines file to append the per-step throughput statistics to')
+    f.DEFINE_integer('throughput_trace_steps', 100, 'trace every n-th training step to measure input waiting and gradient averaging time - 0 to disable')
+    f.DEFINE_float('input_bottleneck_threshold', 0.2, 'fraction of a traced step the towers may wait for input before a warning is logged')
+
+    # Input pipeline
+    # ==============
+
+    f.DEFINE_string('feeder', 'queue', 'input pipeline of the towers - "queue" for the queue runner based ModelFeeder, "tfdata" for the tf.data based DatasetFeeder')
+    f.DEFINE_integer('feeder_parallel_calls', 4, 'number of samples the tf.data pipeline prepares in parallel')
+    f.DEFINE_integer('feeder_prefetch', 2, 'number of batches the tf.data pipeline prefetches onto each tower device')
+    f.DEFINE_integer('feeder_buckets', 0, 'number of length buckets the tf.data pipeline batches samples from - 0 or 1 to disable bucketing')
+
+    # Checkpoint stash
+    # ================
+
+    f.DEFINE_string('checkpoint_stash_dir', '', 'directory to archive the latest checkpoint of every epoch into - empty to disable archiving')
+    f.DEFINE_string('checkpoint_stash_template', '{name}_epoch_{epoch}', 'name of archived checkpoints - may use the fields {name} (checkpoint file name), {step} (global step) and {epoch}')
+    f.DEFINE_integer('checkpoint_stash_keep', 0, 'number of most recent checkpoints to keep in --checkpoint_stash_dir - 0 keeps all of them')
+
+    # Dev set evaluation sidecar
+    # ==========================
+
+    f.DEFINE_boolean('dev_sidecar', False, 'score checkpoints on the dev set (loss, WER and CER) in a separate low priority process instead of validating inline')
+    f.DEFINE_string('sidecar_stop_file', '', 'file the sidecar writes to signal early stopping - defaults to early_stop.json in --checkpoint_dir')
+    f.DEFINE_integer('sidecar_poll_secs', 60, 'seconds between the sidecar\'s checks for new checkpoints')
+    f.DEFINE_integer('sidecar_niceness', 19, 'niceness increment of the sidecar process')
+    f.DEFINE_boolean('sidecar_eval', False, 'internal - makes this process the dev set evaluation sidecar')
+
+    # Mixed precision
+    # ===============
+
+    f.DEFINE_string('precision', 'float32', 'precision of the dense layers\' computations during training - "float32", "float16" (with dynamic loss scaling) or "bfloat16", variables and the LSTM stay float32')
+    f.DEFINE_boolean('fused_dense', False, 'build the dense layers as MatMul, BiasAdd and Relu, a pattern the graph optimizer fuses into a single kernel')
+    f.DEFINE_float('loss_scale_initial', 2.**15, 'initial loss scale of float16 training')
+    f.DEFINE_integer('loss_scale_increment_steps', 2000, 'number of steps with finite gradients after which the float16 loss scale gets doubled')
+
+    # Gradient accumulation
+    # =====================
+
+    f.DEFINE_integer('gradient_accumulation_steps', 1, 'number of training steps whose averaged gradients get applied at once - the effective batch size becomes this times --train_batch_size times the number of towers, global_step counts applied updates')
+
+    # Length based sampling
+    # =====================
+
+    f.DEFINE_integer('sortagrad_epochs', 0, 'number of initial epochs that visit the training samples sorted by ascending length (SortaGrad)')
+    f.DEFINE_boolean('bucketed_batches', False, 'after the sorted epochs, visit the training samples in buckets of similar length, holding the batches of one step, in random order')
+    f.DEFINE_integer('feeder_batch_tokens', 0, 'with --feeder=tfdata and --feeder_buckets, size each bucket\'s batches to about this many time steps instead of --train_batch_size samples - epochs then no longer match the coordinator\'s notion of an epoch')
+
+    # Allreduce
+    # =========
+
+    f.DEFINE_integer('allreduce_size', 0, 'number of processes training data parallel by averaging their gradients with ring allreduce instead of parameter servers - see bin/launch_allreduce.py')
+    f.DEFINE_integer('allreduce_rank', 0, 'rank of this process among the --allreduce_size processes, rank 0 provides the initial weights')
+    f.DEFINE_string('allreduce_hosts', '', 'comma separated host:port addresses of all ranks - defaults to consecutive ports from --allreduce_port on localhost')
+    f.DEFINE_integer('allreduce_port', 29500, 'port of rank 0 if --allreduce_hosts is not given')
+    f.DEFINE_integer('allreduce_fusion_bytes', 64 * 2**20, 'gradients get exchanged in fused buffers of up to this many bytes')
+    f.DEFINE_float('allreduce_timeout', 600., 'seconds after which waiting for another rank fails the training')
+
+    # Transfer learning warmstart
+    # ===========================
+
+    f.DEFINE_string('warmstart_name_map', '', 'comma separated variable=checkpoint pairs of name prefixes, mapping variables of the model to tensors of --source_model_checkpoint_dir with other names')
+    f.DEFINE_boolean('warmstart_partial', True, 'initialize variables whose shape differs from their source tensor\'s (e.g. h6 and b6 with a new alphabet) with the overlapping part')
+
+    # Optimized export
+    # ================
+
+    f.DEFINE_boolean('export_optimized', False, 'also export output_graph_optimized.pb, the frozen graph rewritten by --export_transforms and with fused bias additions')
+    f.DEFINE_string('export_transforms', '', 'space separated graph transforms of the optimized export, in the syntax of TensorFlow\'s transform_graph tool - defaults to DEFAULT_TRANSFORMS of util/graph_optimization.py')
+    f.DEFINE_boolean('export_memmapped', False, 'with --export_optimized, also export output_graph.pbmm, the optimized graph with memory mapped weights')
+    f.DEFINE_string('export_memmapped_tool', 'convert_graphdef_memmapped_format', 'path of TensorFlow\'s convert_graphdef_memmapped_format tool')
+
+    # Checkpoint averaging
+    # ====================
+
+    f.DEFINE_string('average_checkpoints', '', 'shell pattern of checkpoint names in --checkpoint_dir (e.g. "model.ckpt-*") whose average the test sweep tests along with them')
+    f.DEFINE_integer('average_best_k', 0, 'average the K checkpoints with the lowest WER of the test sweep and test their average too - 0 means no averaging')
+    f.DEFINE_string('averaged_checkpoint', 'averaged.ckpt', 'name of the averaged checkpoint written to --checkpoint_dir')
+    f.DEFINE_float('ema_decay', 0., 'decay of exponential moving averages of the trained weights kept in the checkpoints - 0 means none are kept')
+    f.DEFINE_boolean('use_ema_weights', False, 'test and export the moving averages of the weights kept by --ema_decay instead of the weights')
+
+    # N-best output
+    # =============
+
+    f.DEFINE_integer('nbest', 1, 'number of hypotheses of the beam search kept per utterance for N-best output')
+    f.DEFINE_string('nbest_output_file', '', 'path of a JSON file to write the N-best hypotheses of the test set (or --one_shot_infer) to, with their decoder, acoustic and language model scores and word timings')
+
+    # Sharded evaluation
+    # ==================
+
+    f.DEFINE_string('eval_state_dir', '', 'directory to save the results of each shard of the test set to, so interrupted evaluations resume with the next shard - empty means no state is kept')
+    f.DEFINE_integer('eval_shard_size', 50, 'number of test batches per shard of a sharded evaluation')
+    f.DEFINE_integer('eval_workers', 1, 'number of processes sharing the shards of --eval_state_dir, see bin/launch_eval_shards.py')
+    f.DEFINE_integer('eval_worker_index', 0, 'index of this process among the --eval_workers, it scores every shard whose number modulo --eval_workers equals it')
+
+    # Loss only evaluation
+    # ====================
+
+    f.DEFINE_boolean('test_loss_only', False, 'rank all checkpoints by their loss on the test set instead of decoding them, the model\'s outputs never leave the graph')
+
+    # Test result groups
+    # ==================
+
+    f.DEFINE_string('test_duration_buckets', '', 'comma separated durations in seconds, test results are also reported for the samples between each of them - empty means no duration groups')
+
+    # Evaluation autotuning
+    # =====================
+
+    f.DEFINE_boolean('autotune', False, 'calibrate the test batch size, thread pool sizes and decoder processes of the highest throughput on a sample of the test set before testing')
+    f.DEFINE_string('autotune_cache', '', 'JSON file caching the autotuned settings per host, model and utterance length - defaults to ~/.deepspeech_autotune.json')
+    f.DEFINE_integer('autotune_samples', 64, 'number of test samples the calibration trials run on')
+    f.DEFINE_string('autotune_trial', '', 'internal - makes this process run the autotune trial described by this file')
+    f.DEFINE_integer('decoder_processes', 0, 'number of threads of the batched beam search decoder - 0 means one per core')
+
+    # Shared weights
+    # ==============
+
+    f.DEFINE_boolean('shared_weights', False, 'test and transcribe with the checkpoint\'s weights memory mapped from --shared_weights_dir instead of restored, so processes on the same host share one copy of them - CPU only, sessions using them hide the GPUs, which would copy the weights with every run')
+    f.DEFINE_string('shared_weights_dir', '/dev/shm', 'directory the weights get published to by the first process using them with --shared_weights, a tmpfs keeps them in memory - each published checkpoint occupies the size of its weights there until removed')
+    f.DEFINE_integer('shared_weights_keep', 1, 'number of most recently published checkpoints kept in --shared_weights_dir with --shared_weights, older ones get removed when a checkpoint is published - 0 keeps all of them')
+
+    # Exported models
+    # ===============
+
+    f.DEFINE_string('test_models', '', 'comma separated models written by --export_dir (frozen .pb graphs or .tflite models) to test instead of the checkpoints of --checkpoint_dir')
+
+    # TF Lite
+    # =======
+
+    f.DEFINE_integer('export_batch_size', 1, 'batch size of the model exported by --export_tflite')
+    f.DEFINE_boolean('export_tflite_fused_lstm', False, 'export the TF Lite model with the fused LSTM op (TensorFlow 1.13 or later) instead of unrolling the LSTM over --n_steps, its number of time steps can then be resized at runtime')
+    f.DEFINE_integer('tflite_threads', 1, 'number of threads of each TF Lite interpreter')
+    f.DEFINE_integer('tflite_interpreters', 1, 'number of TF Lite interpreters computing sub-batches of the model\'s batch size in parallel')
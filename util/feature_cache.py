@@ -0,0 +1,301 @@
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import numpy as np
+import os
+import pandas
+import progressbar
+import tables
+import tempfile
+
+from functools import partial
+from multiprocessing import Pool, cpu_count
+from util.audio import audiofile_to_input_vector
+from util.batch_mfcc import batch_audiofiles_to_input_vectors
+from util.logging import log_info, log_warn
+from util.text import text_to_char_array
+
+COLUMNS = ('features', 'features_len', 'transcript', 'transcript_len')
+
+# Column with the CSV file each sample was listed in, see preprocess()
+SOURCE_COLUMN = 'source'
+
+# Has to be increased whenever the feature computation changes,
+# so that entries computed by an older version are not picked up anymore
+FEATURE_VERSION = 1
+
+
+class FeatureCache(object):
+    r'''
+    On-disk store of the features of single audio files.
+    Entries are addressed by a digest of the audio file's content and of the feature
+    parameters, so moved or copied files still hit the cache and modified files miss it.
+    '''
+    def __init__(self, cache_dir, numcep, numcontext):
+        self.cache_dir = cache_dir
+        self.numcep = numcep
+        self.numcontext = numcontext
+
+    def key(self, wav_filename):
+        digest = hashlib.sha1()
+        digest.update(('%d:%d:%d:' % (FEATURE_VERSION, self.numcep, self.numcontext)).encode('ascii'))
+        with open(wav_filename, 'rb') as fin:
+            for block in iter(lambda: fin.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            return np.load(path)
+        except (IOError, ValueError):
+            # Truncated or otherwise unreadable entry, it just gets recomputed
+            return None
+
+    def put(self, key, features):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another worker created it in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        # Write to a temporary file first, so concurrent readers never see partial entries
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                np.save(fout, features)
+            os.rename(temp_path, path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+
+def _compute_features(wav_filenames, numcep, numcontext, batch_mfcc):
+    r'''
+    Computes the features of ``wav_filenames``, returning a list of features or exceptions.
+    '''
+    if batch_mfcc and len(wav_filenames) > 1:
+        try:
+            return batch_audiofiles_to_input_vectors(wav_filenames, numcep, numcontext)
+        except Exception:
+            # Fall through to the per-file path to find out which files are broken
+            pass
+    results = []
+    for wav_filename in wav_filenames:
+        try:
+            results.append(audiofile_to_input_vector(wav_filename, numcep, numcontext))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def _process_rows(rows, numcep, numcontext, alphabet, cache_dir, batch_mfcc=False):
+    r'''
+    Computes features and labels of a list of ``(wav_filename, transcript, source)`` rows.
+    Returns one ``(sample, error)`` tuple per row, with ``sample`` set to ``None`` if the row failed.
+    '''
+    cache = FeatureCache(cache_dir, numcep, numcontext) if cache_dir else None
+    keys = [None] * len(rows)
+    features = [None] * len(rows)
+    if cache:
+        for i, (wav_filename, _, _) in enumerate(rows):
+            try:
+                keys[i] = cache.key(wav_filename)
+                features[i] = cache.get(keys[i])
+            except Exception as e:
+                features[i] = e
+
+    missing = [i for i, f in enumerate(features) if f is None]
+    computed = _compute_features([rows[i][0] for i in missing], numcep, numcontext, batch_mfcc)
+    for i, f in zip(missing, computed):
+        features[i] = f
+        if cache and not isinstance(f, Exception):
+            try:
+                cache.put(keys[i], f)
+            except (IOError, OSError) as e:
+                # A full or read-only cache only costs the recomputation next time
+                log_warn('Could not cache features of {}: {}'.format(rows[i][0], e))
+
+    results = []
+    for (wav_filename, transcript, source), f in zip(rows, features):
+        try:
+            if isinstance(f, Exception):
+                raise f
+            features_len = len(f) - 2*numcontext
+            transcript = text_to_char_array(transcript, alphabet)
+            if features_len < len(transcript):
+                raise ValueError('Audio file is too short for transcription.')
+            results.append(((f, features_len, transcript, len(transcript), source), None))
+        except Exception as e:
+            results.append((None, '{}: {}'.format(wav_filename, e)))
+    return results
+
+
+def _read_rows(csv_files, chunk_size):
+    r'''
+    Streams ``(wav_filename, transcript, source)`` tuples from the given CSV files,
+    ``source`` being the index of the CSV file, reading at most ``chunk_size`` lines at a time.
+    '''
+    for source, csv in enumerate(csv_files):
+        #FIXME: not cross-platform
+        csv_dir = os.path.dirname(os.path.abspath(csv))
+        for chunk in pandas.read_csv(csv, encoding='utf-8', na_filter=False, chunksize=chunk_size):
+            for wav_filename, transcript in zip(chunk['wav_filename'], chunk['transcript']):
+                yield os.path.join(csv_dir, wav_filename), transcript, source
+
+
+def _group(iterable, size):
+    group = []
+    for item in iterable:
+        group.append(item)
+        if len(group) == size:
+            yield group
+            group = []
+    if group:
+        yield group
+
+
+def _csv_digest(csv_files):
+    digest = hashlib.sha1()
+    for csv in csv_files:
+        digest.update(os.path.abspath(csv).encode('utf-8'))
+        with open(csv, 'rb') as fin:
+            digest.update(fin.read())
+    return digest.hexdigest()
+
+
+def _load_hdf5(hdf5_cache_path, csv_digest, numcep, num_sources):
+    with tables.open_file(hdf5_cache_path, 'r') as file:
+        # Files written by the upstream preprocessing carry no digest, they get rewritten once with it
+        if 'csv_digest' not in file.root._v_attrs:
+            log_info('{} does not know the sample lists it was written from, updating it'.format(hdf5_cache_path))
+            return None
+        if file.root._v_attrs.csv_digest != csv_digest:
+            log_info('Sample lists changed since {} was written, updating it'.format(hdf5_cache_path))
+            return None
+
+        # Files written before sources were kept only know them if there is a single CSV file
+        if 'source' in file.root:
+            source = file.root.source[:]
+        elif num_sources == 1:
+            source = np.zeros(len(file.root.features_len), dtype=np.int32)
+        else:
+            log_info('{} does not know the CSV files of its samples, updating it'.format(hdf5_cache_path))
+            return None
+
+        features = file.root.features[:]
+        features_len = file.root.features_len[:]
+        transcript = file.root.transcript[:]
+        transcript_len = file.root.transcript_len[:]
+
+        # features are stored flattened, so reshape into [n_steps, n_input]
+        for i in range(len(features)):
+            features[i] = np.reshape(features[i], [-1, numcep])
+
+        return list(zip(features, features_len, transcript, transcript_len, source))
+
+
+def _save_hdf5(hdf5_cache_path, csv_digest, out_data):
+    with tables.open_file(hdf5_cache_path, 'w') as file:
+        file.root._v_attrs.csv_digest = csv_digest
+
+        features_dset = file.create_vlarray(file.root,
+                                            'features',
+                                            tables.Float32Atom(),
+                                            filters=tables.Filters(complevel=1))
+        # VLArray atoms need to be 1D, so flatten feature array
+        for features, _, _, _, _ in out_data:
+            features_dset.append(np.reshape(features, -1))
+
+        file.create_array(file.root, 'features_len', np.array([x[1] for x in out_data]))
+
+        transcript_dset = file.create_vlarray(file.root,
+                                              'transcript',
+                                              tables.Int32Atom(),
+                                              filters=tables.Filters(complevel=1))
+        for _, _, transcript, _, _ in out_data:
+            transcript_dset.append(transcript)
+
+        file.create_array(file.root, 'transcript_len', np.array([x[3] for x in out_data]))
+        file.create_array(file.root, 'source', np.array([x[4] for x in out_data], dtype=np.int32))
+
+
+def _to_data_frame(samples, csv_files, with_source):
+    data = pandas.DataFrame(data=samples, columns=COLUMNS + (SOURCE_COLUMN,))
+    if not with_source:
+        return data.drop(SOURCE_COLUMN, axis=1)
+    data[SOURCE_COLUMN] = [csv_files[source] for source in data[SOURCE_COLUMN]]
+    return data
+
+
+def preprocess(csv_files, batch_size, numcep, numcontext, alphabet, hdf5_cache_path=None,
+               cache_dir=None, workers=0, chunk_size=1000, task_size=16, batch_mfcc=False, with_source=False):
+    r'''
+    Loads the samples of the given CSV files and computes their features on a pool of ``workers`` processes.
+    With ``cache_dir`` set, features are looked up in and added to a per-file :class:`FeatureCache`,
+    so only new or changed audio files get processed. Files that cannot be processed are reported and skipped.
+    With ``batch_mfcc`` set, each worker computes the MFCCs of its ``task_size`` files at once.
+    Results of the whole set are additionally stored in/loaded from ``hdf5_cache_path`` if given.
+    With ``with_source`` set, the CSV file of each sample is kept in the ``source`` column.
+    '''
+    print('Preprocessing', csv_files)
+
+    csv_digest = _csv_digest(csv_files)
+    if hdf5_cache_path and os.path.exists(hdf5_cache_path):
+        samples = _load_hdf5(hdf5_cache_path, csv_digest, numcep, len(csv_files))
+        if samples is not None:
+            print('Preprocessing done')
+            return _to_data_frame(samples, csv_files, with_source)
+
+    step_fn = partial(_process_rows,
+                      numcep=numcep,
+                      numcontext=numcontext,
+                      alphabet=alphabet,
+                      cache_dir=cache_dir,
+                      batch_mfcc=batch_mfcc)
+    tasks = _group(_read_rows(csv_files, chunk_size), task_size)
+
+    if workers <= 0:
+        try:
+            workers = cpu_count()
+        except NotImplementedError:
+            workers = 1
+
+    pool = Pool(workers) if workers > 1 else None
+    results = pool.imap(step_fn, tasks) if pool else (step_fn(task) for task in tasks)
+
+    out_data = []
+    errors = 0
+    bar = progressbar.ProgressBar(max_value=progressbar.UnknownLength)
+    try:
+        for task_results in results:
+            for sample, error in task_results:
+                if sample is None:
+                    log_warn('Skipping sample - {}'.format(error))
+                    errors += 1
+                else:
+                    out_data.append(sample)
+            bar.update(len(out_data) + errors)
+    finally:
+        bar.finish()
+        if pool:
+            pool.close()
+            pool.join()
+
+    if errors > 0:
+        log_warn('Skipped {} of {} samples that could not be processed'.format(errors, len(out_data) + errors))
+
+    if hdf5_cache_path:
+        print('Saving to', hdf5_cache_path)
+        _save_hdf5(hdf5_cache_path, csv_digest, out_data)
+
+    print('Preprocessing done')
+    return _to_data_frame(out_data, csv_files, with_source)
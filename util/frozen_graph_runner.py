@@ -0,0 +1,75 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import tensorflow as tf
+
+from six.moves import range
+from util.graph_optimization import load_graph_def
+from util.logging import log_info
+
+
+class FrozenGraphRunner(object):
+    r'''
+    Runs the acoustic model of a frozen graph written by ``--export_dir`` (``output_graph.pb`` or
+    ``output_graph_optimized.pb``) on batches of any size and length, binding to its ``input_node``,
+    ``input_lengths`` and ``logits`` tensors. Batches get split into sub-batches of the graph's batch
+    size (the last one zero padded). Graphs exported with a fixed ``--n_steps`` are fed chunk by chunk,
+    their ``previous_state_*`` variables carrying over the LSTM state like the native client does.
+    '''
+    def __init__(self, graph_path, session_config=None):
+        self.graph_path = graph_path
+        graph_def = load_graph_def(graph_path)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.session = tf.Session(graph=self.graph, config=session_config)
+
+        self.input_node = self.graph.get_tensor_by_name('input_node:0')
+        self.input_lengths = self.graph.get_tensor_by_name('input_lengths:0')
+        self.logits = self.graph.get_tensor_by_name('logits:0')
+        self.initialize_state = self.graph.get_operation_by_name('initialize_state')
+
+        # The state variables fix the batch size, even if the input has none
+        self.batch_size = self.graph.get_tensor_by_name('previous_state_c:0').get_shape().as_list()[0]
+        self.n_steps = self.input_node.get_shape().as_list()[1]
+        log_info('Frozen graph {}: {} nodes, batch size {}, {} time steps'.format(
+            graph_path, len(graph_def.node), self.batch_size, self.n_steps or 'dynamic'))
+
+    def _run_sub_batch(self, features, lengths):
+        self.session.run(self.initialize_state)
+        steps = features.shape[1]
+        chunk_steps = self.n_steps or max(steps, 1)
+
+        probabilities = []
+        for start in range(0, max(steps, 1), chunk_steps):
+            chunk = features[:, start:start + chunk_steps]
+            if chunk.shape[1] < chunk_steps:
+                chunk = np.pad(chunk, [(0, 0), (0, chunk_steps - chunk.shape[1]), (0, 0), (0, 0)], 'constant')
+            # Time major [chunk_steps, batch_size, n_classes]
+            logits = self.session.run(self.logits, feed_dict={
+                self.input_node: chunk,
+                self.input_lengths: np.clip(lengths - start, 0, chunk_steps),
+            })
+            probabilities.append(np.transpose(logits, [1, 0, 2]))
+        return np.concatenate(probabilities, axis=1)[:, :steps]
+
+    def run(self, features, lengths):
+        r'''
+        Returns the batch major softmax outputs of the windowed ``features`` of a padded batch.
+        '''
+        features = np.asarray(features, dtype=np.float32)
+        lengths = np.asarray(lengths, dtype=np.int32)
+        count = len(features)
+        results = []
+        for start in range(0, count, self.batch_size):
+            sub_batch = features[start:start + self.batch_size]
+            sub_lengths = lengths[start:start + self.batch_size]
+            padding = self.batch_size - len(sub_batch)
+            if padding > 0:
+                sub_batch = np.pad(sub_batch, [(0, padding)] + [(0, 0)] * 3, 'constant')
+                sub_lengths = np.pad(sub_lengths, [(0, padding)], 'constant')
+            results.append(self._run_sub_batch(sub_batch, sub_lengths))
+        return np.concatenate(results, axis=0)[:count]
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,52 @@
+from __future__ import absolute_import, division, print_function
+
+import tensorflow as tf
+
+
+class GradientAccumulator(object):
+    r'''
+    Sums gradients over ``steps`` micro-steps and applies their mean once, giving an effective
+    batch of ``steps`` times the batch of a single step without holding more than one batch in memory.
+    Run :attr:`accumulate_op` on the first ``steps - 1`` micro-steps and the op returned by
+    :meth:`apply_gradients` on the last one, which adds its own gradients before applying.
+    Only that op touches the optimizer, so ``global_step`` (and ``SyncReplicasOptimizer``)
+    advance once per effective batch.
+    The sums live in local variables on ``device``, so they are not part of checkpoints: a restored
+    training restarts the accumulation, losing at most ``steps - 1`` micro-batches. In distributed
+    training ``device`` has to be the worker's own device, as each worker accumulates its own
+    micro-batches. Without ``device`` the sums are placed next to their variables.
+    '''
+    def __init__(self, grads_and_vars, steps, device=None):
+        self.steps = steps
+        self._grads_and_accumulators = []
+        with tf.name_scope('gradient_accumulation'):
+            for g, v in grads_and_vars:
+                accumulator = None
+                if g is not None:
+                    # An explicit worker device also keeps replica_device_setter from moving them to a PS
+                    with tf.device(device) if device else tf.colocate_with(v):
+                        accumulator = tf.Variable(tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype),
+                                                  trainable=False,
+                                                  collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                                                  name='accumulator')
+                self._grads_and_accumulators.append((g, accumulator, v))
+
+            self.accumulate_op = tf.group(*[tf.assign_add(accumulator, tf.convert_to_tensor(g))
+                                            for g, accumulator, _ in self._grads_and_accumulators
+                                            if accumulator is not None])
+
+    def apply_gradients(self, apply_fn):
+        r'''
+        Returns the op of the last micro-step: it accumulates the current gradients, passes their
+        mean over all micro-steps to ``apply_fn`` (e.g. ``optimizer.apply_gradients``), which returns
+        the op applying them, and then resets the sums.
+        '''
+        with tf.name_scope('gradient_accumulation'):
+            with tf.control_dependencies([self.accumulate_op]):
+                mean_grads_and_vars = [(accumulator.read_value() / self.steps if accumulator is not None else None, v)
+                                       for _, accumulator, v in self._grads_and_accumulators]
+        apply_op = apply_fn(mean_grads_and_vars)
+        with tf.name_scope('gradient_accumulation'), tf.control_dependencies([apply_op]):
+            return tf.group(*[tf.assign(accumulator, tf.zeros_like(accumulator))
+                              for _, accumulator, _ in self._grads_and_accumulators
+                              if accumulator is not None])
@@ -0,0 +1,87 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import subprocess
+import tensorflow as tf
+
+from tensorflow.tools.graph_transforms import TransformGraph
+from util.logging import log_info, log_warn
+
+# Graph transforms of an optimized export, in the syntax of TensorFlow's transform_graph tool
+DEFAULT_TRANSFORMS = ' '.join([
+    'remove_nodes(op=Identity, op=CheckNumerics, op=StopGradient)',
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+    'merge_duplicate_nodes',
+    'sort_by_execution_order',
+])
+
+
+def fold_matmul_bias(graph_def):
+    r'''
+    Turns the ``Add`` of a ``MatMul`` and a constant vector into a ``BiasAdd``,
+    which TensorFlow executes fused with the ``MatMul`` (and a following ``Relu``).
+    Returns the number of rewritten nodes.
+    '''
+    nodes = {node.name: node for node in graph_def.node}
+
+    def producer(name):
+        return nodes.get(name.lstrip('^').split(':')[0])
+
+    count = 0
+    for node in graph_def.node:
+        if node.op != 'Add' or len(node.input) != 2:
+            continue
+        matmul, bias = producer(node.input[0]), producer(node.input[1])
+        if matmul is None or bias is None or matmul.op != 'MatMul' or bias.op != 'Const':
+            continue
+        if len(bias.attr['value'].tensor.tensor_shape.dim) != 1:
+            continue
+        node.op = 'BiasAdd'
+        node.attr['data_format'].s = b'NHWC'
+        count += 1
+    return count
+
+
+def optimize_graph(graph_def, input_names, output_names, transforms=None):
+    r'''
+    Returns a copy of the frozen ``graph_def`` rewritten by ``transforms`` (see :data:`DEFAULT_TRANSFORMS`)
+    and with its dense layers' bias additions folded into ``BiasAdd``.
+    '''
+    optimized = TransformGraph(graph_def, input_names, output_names, (transforms or DEFAULT_TRANSFORMS).split())
+    folded = fold_matmul_bias(optimized)
+    log_info('Optimized graph has {} nodes instead of {}, folded {} bias additions'.format(
+        len(optimized.node), len(graph_def.node), folded))
+    return optimized
+
+
+def convert_to_memmapped(graph_path, memmapped_path, tool='convert_graphdef_memmapped_format'):
+    r'''
+    Writes the frozen graph ``graph_path`` with memory mapped weights to ``memmapped_path``,
+    using TensorFlow's ``convert_graphdef_memmapped_format`` tool. Clients can map the weights
+    instead of reading and parsing them. Returns whether the conversion succeeded.
+    '''
+    try:
+        subprocess.check_call([tool, '--in_graph=%s' % graph_path, '--out_graph=%s' % memmapped_path])
+    except OSError:
+        log_warn('Not writing a memory mapped model: {} not found - it gets built from '
+                 '//tensorflow/contrib/util:convert_graphdef_memmapped_format'.format(tool))
+        return False
+    except subprocess.CalledProcessError as e:
+        log_warn('Converting {} to a memory mapped model failed: {}'.format(graph_path, e))
+        return False
+    return True
+
+
+def load_graph_def(path):
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, 'rb') as fin:
+        graph_def.ParseFromString(fin.read())
+    return graph_def
+
+
+def write_graph_def(graph_def, path):
+    with tf.gfile.GFile(path, 'wb') as fout:
+        fout.write(graph_def.SerializeToString())
+    log_info('Wrote {} ({:.1f} MB)'.format(path, os.path.getsize(path) / 2.**20))
@@ -0,0 +1,91 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+from six.moves import range
+
+
+class PackedLabels(object):
+    r'''
+    Label sequences (e.g. the transcripts of a test set) stored as one flat array,
+    sequence ``i`` being ``flat[offsets[i]:offsets[i + 1]]``.
+    '''
+    def __init__(self, flat, offsets):
+        self.flat = np.asarray(flat, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        lengths = np.fromiter((len(a) for a in arrays), dtype=np.int64, count=len(arrays))
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat = np.concatenate(arrays).astype(np.int32) if len(arrays) else np.zeros(0, dtype=np.int32)
+        return cls(flat, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def dense(self, start, stop):
+        r'''
+        Returns the sequences ``start`` to ``stop`` as a zero padded ``[count, max_length]`` matrix
+        and their lengths, the labels and label lengths of a batch.
+        '''
+        lengths = self.lengths[start:stop]
+        first, last = self.offsets[start], self.offsets[stop]
+        dense = np.zeros((len(lengths), lengths.max() if len(lengths) else 0), dtype=np.int32)
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        columns = np.arange(last - first) - np.repeat(self.offsets[start:stop] - first, lengths)
+        dense[rows, columns] = self.flat[first:last]
+        return dense, lengths.astype(np.int32)
+
+
+class LabelLookup(object):
+    r'''
+    Converts between labels of ``alphabet`` and strings with lookup tables, a whole
+    :class:`PackedLabels` or list of strings at a time. Labels of a single code point are
+    translated as an UTF-32 buffer, alphabets with longer labels fall back to joining them.
+    '''
+    def __init__(self, alphabet):
+        self.strings = [alphabet.string_from_label(label) for label in range(alphabet.size())]
+        self.single_code_points = all(len(s) == 1 for s in self.strings)
+        if self.single_code_points:
+            self.code_points = np.array([ord(s) for s in self.strings], dtype=np.uint32)
+            self.labels = np.full(self.code_points.max() + 1, -1, dtype=np.int32)
+            self.labels[self.code_points] = np.arange(len(self.strings), dtype=np.int32)
+        else:
+            self.string_array = np.array(self.strings, dtype=object)
+            self.label_of = {s: label for label, s in enumerate(self.strings)}
+
+    def decode(self, packed):
+        r'''
+        Returns the strings of all sequences of ``packed``.
+        '''
+        offsets = packed.offsets
+        if not self.single_code_points:
+            strings = self.string_array[packed.flat]
+            return [''.join(strings[offsets[i]:offsets[i + 1]]) for i in range(len(packed))]
+        text = self.code_points[packed.flat].astype('<u4').tobytes().decode('utf-32-le')
+        return [text[offsets[i]:offsets[i + 1]] for i in range(len(packed))]
+
+    def encode(self, strings):
+        r'''
+        Returns the labels of ``strings`` as :class:`PackedLabels`.
+        Raises ``KeyError`` for characters the alphabet does not have.
+        '''
+        if not self.single_code_points:
+            return PackedLabels.from_arrays([np.array([self.label_of[c] for c in s], dtype=np.int32) for s in strings])
+        lengths = np.fromiter((len(s) for s in strings), dtype=np.int64, count=len(strings))
+        offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        code_points = np.frombuffer(u''.join(strings).encode('utf-32-le'), dtype='<u4')
+        in_table = code_points < len(self.labels)
+        flat = np.full(len(code_points), -1, dtype=np.int32)
+        flat[in_table] = self.labels[code_points[in_table]]
+        if (flat < 0).any():
+            unknown = set(u''.join(strings)) - set(self.strings)
+            raise KeyError('Characters not in the alphabet: {}'.format(', '.join(sorted(unknown))))
+        return PackedLabels(flat, offsets)
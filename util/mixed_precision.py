@@ -0,0 +1,71 @@
+from __future__ import absolute_import, division, print_function
+
+import tensorflow as tf
+
+COMPUTE_DTYPES = {
+    'float32': tf.float32,
+    'float16': tf.float16,
+    'bfloat16': tf.bfloat16,
+}
+
+
+def compute_dtype(precision):
+    try:
+        return COMPUTE_DTYPES[precision]
+    except KeyError:
+        raise ValueError('Unknown precision "{}", expected one of {}'.format(precision, ', '.join(sorted(COMPUTE_DTYPES))))
+
+
+class DynamicLossScale(object):
+    r'''
+    Dynamic loss scaling for reduced precision training.
+    The loss gets multiplied by the current scale before computing gradients, averaged gradients
+    get divided by it before they are applied. Steps with non-finite gradients are skipped and halve
+    the scale, ``increment_steps`` finite steps in a row double it.
+    State lives in local variables, so checkpoints stay compatible with float32 training.
+    '''
+    def __init__(self, initial_scale=2.**15, increment_steps=2000, factor=2.):
+        collections = [tf.GraphKeys.LOCAL_VARIABLES]
+        with tf.variable_scope('loss_scale'):
+            self.scale = tf.get_variable('scale', initializer=tf.constant(initial_scale, tf.float32),
+                                         trainable=False, collections=collections)
+            self._good_steps = tf.get_variable('good_steps', initializer=tf.constant(0, tf.int32),
+                                               trainable=False, collections=collections)
+        self._increment_steps = increment_steps
+        self._factor = factor
+
+    def scale_loss(self, loss):
+        return loss * tf.cast(self.scale, loss.dtype)
+
+    def unscale_gradients(self, grads_and_vars):
+        return [(g / self.scale, v) for g, v in grads_and_vars]
+
+    def apply_gradients(self, optimizer, grads_and_vars, global_step, skip_with_cond=True):
+        r'''
+        Applies unscaled ``grads_and_vars`` if all of them are finite and updates the scale.
+        Optimizers that create queues in ``apply_gradients`` (``SyncReplicasOptimizer``) can't be
+        applied conditionally, with ``skip_with_cond=False`` they get zero gradients on skipped steps.
+        '''
+        all_finite = tf.reduce_all([tf.reduce_all(tf.is_finite(g)) for g, _ in grads_and_vars])
+
+        def update_scale():
+            good_steps = self._good_steps + 1
+            increase = good_steps >= self._increment_steps
+            return tf.group(
+                tf.assign(self.scale, tf.where(increase, self.scale * self._factor, self.scale)),
+                tf.assign(self._good_steps, tf.where(increase, 0, good_steps)))
+
+        def decrease_scale():
+            return tf.group(
+                tf.assign(self.scale, tf.maximum(self.scale / self._factor, 1.)),
+                tf.assign(self._good_steps, 0))
+
+        if skip_with_cond:
+            def apply():
+                with tf.control_dependencies([optimizer.apply_gradients(grads_and_vars, global_step=global_step)]):
+                    return update_scale()
+            return tf.cond(all_finite, apply, decrease_scale)
+
+        grads_and_vars = [(tf.where(tf.fill(tf.shape(g), all_finite), g, tf.zeros_like(g)), v) for g, v in grads_and_vars]
+        with tf.control_dependencies([optimizer.apply_gradients(grads_and_vars, global_step=global_step)]):
+            return tf.cond(all_finite, update_scale, decrease_scale)
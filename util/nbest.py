@@ -0,0 +1,196 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import numpy as np
+
+from collections import OrderedDict
+from six.moves import range
+from util.batch_mfcc import WIN_STEP
+from util.labels import LabelLookup
+
+# Log probability of impossible paths, finite so differences stay defined
+LOG_ZERO = -1e30
+
+# Context of the first words of a sentence, like the decoder's Scorer pads its n-grams
+START_TOKEN = '<s>'
+
+
+def _ctc_states(labels, blank):
+    # Labels interleaved with blanks, the states of the CTC topology
+    states = np.full(2 * len(labels) + 1, blank, dtype=np.int64)
+    states[1::2] = labels
+    # A state can skip the blank before it unless it repeats the previous label
+    skip = np.zeros(len(states), dtype=bool)
+    if len(labels) > 1:
+        skip[3::2] = np.asarray(labels[1:]) != np.asarray(labels[:-1])
+    return states, skip
+
+
+def _shift(values, count):
+    # The values of the states ``count`` states before
+    shifted = np.full(len(values), LOG_ZERO)
+    shifted[count:] = values[:len(values) - count]
+    return shifted
+
+
+def ctc_log_likelihood(log_probabilities, labels, blank):
+    r'''
+    Returns the log likelihood of the label sequence ``labels`` given the
+    ``[steps, classes]`` ``log_probabilities`` by the CTC forward algorithm.
+    '''
+    steps = len(log_probabilities)
+    states, skip = _ctc_states(labels, blank)
+    if steps == 0:
+        return LOG_ZERO if len(labels) else 0.
+    alpha = np.full(len(states), LOG_ZERO)
+    alpha[:2] = log_probabilities[0, states[:2]]
+    for t in range(1, steps):
+        jump = np.where(skip, _shift(alpha, 2), LOG_ZERO)
+        alpha = np.logaddexp(np.logaddexp(alpha, _shift(alpha, 1)), jump) + log_probabilities[t, states]
+    return float(np.logaddexp(alpha[-1], alpha[-2]) if len(states) > 1 else alpha[-1])
+
+
+def ctc_align(log_probabilities, labels, blank):
+    r'''
+    Returns the time steps of the most likely CTC alignment of ``labels`` (Viterbi)
+    at which each label starts, or ``None`` if the labels do not fit into the steps.
+    '''
+    steps = len(log_probabilities)
+    states, skip = _ctc_states(labels, blank)
+    if steps == 0 or len(labels) == 0:
+        return None if len(labels) else []
+    delta = np.full(len(states), LOG_ZERO)
+    delta[:2] = log_probabilities[0, states[:2]]
+    backpointers = np.zeros((steps, len(states)), dtype=np.int8)
+    for t in range(1, steps):
+        candidates = np.stack([delta, _shift(delta, 1), np.where(skip, _shift(delta, 2), LOG_ZERO)])
+        backpointers[t] = np.argmax(candidates, axis=0)
+        delta = candidates[backpointers[t], np.arange(len(states))] + log_probabilities[t, states]
+
+    state = len(states) - 1 if delta[-1] >= delta[-2] else len(states) - 2
+    if delta[state] <= LOG_ZERO / 2:
+        return None
+    starts = [0] * len(labels)
+    for t in range(steps - 1, -1, -1):
+        previous = state - backpointers[t, state] if t > 0 else -1
+        # The label is entered at step t if the path came from another state or this is the first step
+        if state % 2 == 1 and previous != state:
+            starts[state // 2] = t
+        state = previous
+    return starts
+
+
+def language_model_score(scorer, transcript):
+    r'''
+    Returns the language model's share of the beam search score of ``transcript``, the ``alpha``
+    weighted log probability of its words under ``scorer``'s language model plus ``beta`` per word.
+    Like in the decoder, each word is conditioned on up to ``max_order - 1`` preceding words.
+    '''
+    words = list(transcript.replace(' ', '')) if scorer.is_character_based() else transcript.split()
+    order = scorer.get_max_order()
+    context = [START_TOKEN] * (order - 1)
+    log_probability = 0.
+    for word in words:
+        context = context[1:] + [word] if order > 1 else [word]
+        log_probability += scorer.get_log_cond_prob(context)
+    return scorer.alpha * log_probability + scorer.beta * len(words)
+
+
+class NBestResults(object):
+    r'''
+    Columnar N-best results of a decoded set. Each hypothesis is a row of the columns ``utterance``,
+    ``rank``, ``transcript``, ``score`` (the score the decoder returns, its approximation of the
+    hypothesis' CTC log probability without the language model terms it ranked the beams by),
+    ``acoustic_score`` (its exact CTC log likelihood under the acoustic model) and ``lm_score``
+    (the language model terms, see :func:`language_model_score`, zero without ``scorer``).
+    A hypothesis' total beam score is ``acoustic_score + lm_score``.
+    Words are rows of ``word``, ``word_start`` and ``word_end`` (seconds), hypothesis ``i`` owning
+    the rows from ``word_offsets[i]`` to ``word_offsets[i + 1]``.
+    '''
+    def __init__(self, alphabet, scorer=None):
+        self.alphabet = alphabet
+        self.scorer = scorer
+        self.lookup = LabelLookup(alphabet)
+        self.blank = alphabet.size()
+        self.space = alphabet.label_from_string(' ')
+        self.utterance = []
+        self.rank = []
+        self.transcript = []
+        self.score = []
+        self.acoustic_score = []
+        self.lm_score = []
+        self.word = []
+        self.word_start = []
+        self.word_end = []
+        self.word_offsets = [0]
+
+    def __len__(self):
+        return len(self.transcript)
+
+    def add(self, utterance, hypotheses, probabilities):
+        r'''
+        Adds the decoder's ``(score, transcript)`` ``hypotheses`` of an utterance
+        with its ``[steps, classes]`` softmax ``probabilities``.
+        '''
+        log_probabilities = np.log(np.maximum(probabilities, 1e-30))
+        packed = self.lookup.encode([transcript for _, transcript in hypotheses])
+        for rank, (score, transcript) in enumerate(hypotheses):
+            labels = packed.flat[packed.offsets[rank]:packed.offsets[rank + 1]].tolist()
+            self.utterance.append(utterance)
+            self.rank.append(rank)
+            self.transcript.append(transcript)
+            self.score.append(float(score))
+            self.acoustic_score.append(ctc_log_likelihood(log_probabilities, labels, self.blank))
+            self.lm_score.append(language_model_score(self.scorer, transcript) if self.scorer is not None else 0.)
+            self._add_words(labels, ctc_align(log_probabilities, labels, self.blank), len(log_probabilities))
+            self.word_offsets.append(len(self.word))
+
+    def extend(self, columns):
+        r'''
+        Appends the hypotheses of ``columns``, the :meth:`to_dict` of other results.
+        '''
+        for name in ('utterance', 'rank', 'transcript', 'score', 'acoustic_score', 'lm_score', 'word', 'word_start', 'word_end'):
+            getattr(self, name).extend(columns[name])
+        offset = self.word_offsets[-1]
+        self.word_offsets.extend(offset + o for o in columns['word_offsets'][1:])
+
+    def _add_words(self, labels, starts, steps):
+        if starts is None:
+            return
+        # Each word spans from the step its first character starts to the next word's space
+        word_start = None
+        for index, label in enumerate(labels + [self.space]):
+            step = starts[index] if index < len(labels) else steps
+            if label == self.space:
+                if word_start is not None:
+                    self.word.append(self.alphabet.decode(labels[word_start:index]))
+                    self.word_start.append(starts[word_start] * WIN_STEP)
+                    self.word_end.append(step * WIN_STEP)
+                word_start = None
+            elif word_start is None:
+                word_start = index
+
+    def words(self, index):
+        r'''
+        Returns the ``(word, start, end)`` tuples of hypothesis ``index``.
+        '''
+        rows = range(self.word_offsets[index], self.word_offsets[index + 1])
+        return [(self.word[i], self.word_start[i], self.word_end[i]) for i in rows]
+
+    def to_dict(self):
+        return OrderedDict([
+            ('utterance', self.utterance),
+            ('rank', self.rank),
+            ('transcript', self.transcript),
+            ('score', self.score),
+            ('acoustic_score', self.acoustic_score),
+            ('lm_score', self.lm_score),
+            ('word_offsets', self.word_offsets),
+            ('word', self.word),
+            ('word_start', self.word_start),
+            ('word_end', self.word_end),
+        ])
+
+    def write(self, path):
+        with open(path, 'w') as fout:
+            json.dump(self.to_dict(), fout)
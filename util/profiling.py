@@ -0,0 +1,138 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import resource
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from tensorflow.python.client import timeline
+from util.logging import log_info
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _peak_rss_mb():
+    # The peak of the whole process so far, ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class Profiler(object):
+    r'''
+    Records wall time, CPU time and memory of named stages. ``process_peak_rss_mb`` is the peak RSS of
+    the process up to a stage's end, ``peak_rss_growth_mb`` how much the stage raised it, i.e. the memory
+    a stage needed beyond the peaks of all earlier stages.
+    Stages are tagged with the tags of all enclosing :meth:`tags` blocks
+    (e.g. checkpoint and CSV), so results can be broken down along them.
+    A disabled profiler (the default) records nothing.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._origin = time.time()
+        self._tags = [OrderedDict()]
+
+    def enable(self):
+        self.enabled = True
+        self.events = []
+        self._origin = time.time()
+
+    @contextmanager
+    def tags(self, **tags):
+        merged = OrderedDict(self._tags[-1])
+        merged.update(sorted(tags.items()))
+        self._tags.append(merged)
+        try:
+            yield
+        finally:
+            self._tags.pop()
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start, cpu_start, peak_start = time.time(), _cpu_time(), _peak_rss_mb()
+        try:
+            yield
+        finally:
+            self.events.append(OrderedDict([
+                ('stage', name),
+                ('tags', OrderedDict(self._tags[-1])),
+                ('start', start - self._origin),
+                ('wall', time.time() - start),
+                ('cpu', _cpu_time() - cpu_start),
+                ('process_peak_rss_mb', _peak_rss_mb()),
+                ('peak_rss_growth_mb', _peak_rss_mb() - peak_start),
+                ('thread', threading.current_thread().ident),
+            ]))
+
+    def summary(self):
+        r'''
+        Returns the recorded events along with per-stage totals, overall and per tag combination.
+        '''
+        def add(totals, event):
+            total = totals.setdefault(event['stage'], OrderedDict([('count', 0), ('wall', 0.), ('cpu', 0.),
+                                                                   ('process_peak_rss_mb', 0.), ('peak_rss_growth_mb', 0.)]))
+            total['count'] += 1
+            total['wall'] += event['wall']
+            total['cpu'] += event['cpu']
+            for field in ('process_peak_rss_mb', 'peak_rss_growth_mb'):
+                total[field] = max(total[field], event[field])
+
+        totals = OrderedDict()
+        groups = OrderedDict()
+        for event in self.events:
+            add(totals, event)
+            key = ','.join('%s=%s' % item for item in event['tags'].items())
+            add(groups.setdefault(key, OrderedDict()), event)
+
+        return OrderedDict([('totals', totals), ('groups', groups), ('events', self.events)])
+
+    def chrome_trace(self):
+        r'''
+        Returns the recorded events in the Trace Event Format of chrome://tracing.
+        '''
+        pid = os.getpid()
+        return {'traceEvents': [{
+            'name': event['stage'],
+            'ph': 'X',
+            'ts': event['start'] * 1e6,
+            'dur': event['wall'] * 1e6,
+            'pid': pid,
+            'tid': event['thread'],
+            'args': dict(event['tags'], cpu=event['cpu'], process_peak_rss_mb=event['process_peak_rss_mb'],
+                         peak_rss_growth_mb=event['peak_rss_growth_mb']),
+        } for event in self.events]}
+
+    def write(self, directory, chrome_trace=False):
+        if not self.enabled:
+            return
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'profile.json'), 'w') as fout:
+            json.dump(self.summary(), fout, indent=2)
+        if chrome_trace:
+            with open(os.path.join(directory, 'trace.json'), 'w') as fout:
+                json.dump(self.chrome_trace(), fout)
+        log_info('Wrote profile to {}'.format(directory))
+
+
+# Process wide profiler, enabled by --profile_dir
+profiler = Profiler()
+
+
+def write_tf_timeline(run_metadata, directory, name):
+    r'''
+    Writes the step stats of a traced ``session.run`` as a Chrome trace into ``directory``.
+    '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format()
+    with open(os.path.join(directory, 'tf_timeline_%s.json' % name), 'w') as fout:
+        fout.write(trace)
@@ -0,0 +1,77 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import threading
+
+from util.logging import log_info
+
+
+def epoch_of_step(step, total_batches, batches_per_step):
+    r'''
+    The epoch the training coordinator starts in when training resumes at global step ``step``,
+    computed like ``TrainingCoordinator.start_coordination`` does. Workers derive it from the
+    restored step themselves, as only the chief runs the coordination.
+    '''
+    steps_per_epoch = max(1, total_batches // max(1, batches_per_step))
+    return step // steps_per_epoch
+
+
+class LengthSampler(object):
+    r'''
+    Maps the running sample indices of the training coordinator to the samples of a data set,
+    in an order that keeps utterances of similar length together.
+    The first ``sorted_epochs`` epochs walk the samples sorted by ascending length (SortaGrad,
+    short utterances first stabilize early training). Later epochs are, if ``bucketed`` is set, cut
+    into buckets of similar length that get visited in random order, otherwise they keep the data
+    set's order.
+    All towers (and workers) draw from the same running index, so the batches of one step take
+    interleaved indices. A bucket therefore holds the ``batch_size`` samples of each of the
+    ``batches_per_step`` batches of a step, whichever tower ends up with which of them.
+    The order of every epoch is derived from ``seed`` and the epoch only, so all towers and workers
+    agree on it, provided every worker calls :meth:`start` with the same epoch (see
+    :func:`epoch_of_step`).
+    '''
+    def __init__(self, lengths, batch_size, batches_per_step=1, sorted_epochs=0, bucketed=False, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * max(1, batches_per_step)
+        self.sorted_epochs = sorted_epochs
+        self.bucketed = bucketed
+        self.seed = seed
+        self._epoch_offset = 0
+        self._orders = {}
+        self._lock = threading.Lock()
+
+    def start(self, epoch):
+        r'''
+        Sets the epoch the coordinator's index 0 belongs to, e.g. when training got resumed.
+        '''
+        self._epoch_offset = epoch
+
+    def _epoch_order(self, epoch):
+        if epoch < self.sorted_epochs:
+            return np.argsort(self.lengths, kind='mergesort'), 'sorted'
+        if not self.bucketed:
+            return np.arange(len(self.lengths)), 'data set order'
+
+        rng = np.random.RandomState(self.seed + epoch)
+        # Random order among samples of equal length, then buckets of similar lengths in random order
+        permutation = rng.permutation(len(self.lengths))
+        by_length = permutation[np.argsort(self.lengths[permutation], kind='mergesort')]
+        buckets = np.array_split(by_length, range(self.bucket_size, len(by_length), self.bucket_size))
+        # A smaller last bucket stays at the end, it would shift all later buckets against the steps
+        full = len(by_length) // self.bucket_size
+        order = [buckets[i] for i in rng.permutation(full)] + buckets[full:]
+        return np.concatenate(order), 'bucketed'
+
+    def index(self, coordinator_index):
+        epoch, position = divmod(coordinator_index, len(self.lengths))
+        epoch += self._epoch_offset
+        with self._lock:
+            if epoch not in self._orders:
+                order, kind = self._epoch_order(epoch)
+                log_info('Epoch {} sample order: {}'.format(epoch, kind))
+                # Feeder threads may still draw from the previous epoch while others are in the next one
+                self._orders = {e: o for e, o in self._orders.items() if e == epoch - 1}
+                self._orders[epoch] = order
+            return self._orders[epoch][position]
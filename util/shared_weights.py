@@ -0,0 +1,124 @@
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import numpy as np
+import os
+import shutil
+import tempfile
+import tensorflow as tf
+
+from util.logging import log_debug, log_info, log_warn
+
+PREFIX = 'deepspeech_weights_'
+
+
+def _file_name(name):
+    return name.replace('/', '__') + '.npy'
+
+
+def _publication_dir(checkpoint_path, names, shared_dir):
+    # Rewriting a checkpoint changes its index, so its weights get published anew
+    index_path = checkpoint_path + '.index'
+    digest = hashlib.sha1()
+    digest.update(os.path.abspath(checkpoint_path).encode('utf-8'))
+    if os.path.exists(index_path):
+        stat = os.stat(index_path)
+        digest.update(('%d %d' % (stat.st_mtime, stat.st_size)).encode('utf-8'))
+    for name in sorted(names):
+        digest.update(name.encode('utf-8'))
+    return os.path.join(shared_dir, PREFIX + digest.hexdigest()[:16])
+
+
+def remove_publications(shared_dir, keep, current=None):
+    r'''
+    Removes all but the ``keep`` most recently published weights in ``shared_dir``, never ``current``.
+    Processes that mapped removed weights keep them until they exit, as their pages are freed with
+    the last mapping.
+    '''
+    publications = [os.path.join(shared_dir, name) for name in os.listdir(shared_dir) if name.startswith(PREFIX)]
+    publications = [path for path in publications if path != current and os.path.isdir(path)]
+    publications.sort(key=os.path.getmtime, reverse=True)
+    for path in publications[max(keep - (current is not None), 0):]:
+        log_debug('Removing published weights {}'.format(path))
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def publish(checkpoint_path, names, shared_dir):
+    r'''
+    Writes the tensors ``names`` of the checkpoint ``checkpoint_path`` as ``.npy`` files to a directory
+    in ``shared_dir``, unless an earlier process did. The directory is written under a temporary name
+    and renamed, so concurrent processes publish at most one complete copy. Returns its path.
+    '''
+    directory = _publication_dir(checkpoint_path, names, shared_dir)
+    if os.path.isdir(directory):
+        try:
+            # Marks it as recently used for remove_publications()
+            os.utime(directory, None)
+        except OSError:
+            pass
+        return directory
+
+    temp_dir = tempfile.mkdtemp(dir=shared_dir, prefix='.' + PREFIX)
+    total_bytes = 0
+    try:
+        reader = tf.train.load_checkpoint(checkpoint_path)
+        for name in names:
+            tensor = reader.get_tensor(name)
+            np.save(os.path.join(temp_dir, _file_name(name)), tensor)
+            total_bytes += tensor.nbytes
+    except:
+        # E.g. a full tmpfs, the partial copy would hold on to its memory
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    try:
+        os.rename(temp_dir, directory)
+        log_info('Published {} weights ({:.1f} MB) of {} to {}'.format(len(names), total_bytes / 2.**20,
+                                                                        checkpoint_path, directory))
+    except OSError:
+        # Another process published the same weights first
+        shutil.rmtree(temp_dir)
+    return directory
+
+
+def cpu_session_config(config):
+    r'''
+    Copy of the session ``config`` without GPUs, for sessions fed :class:`SharedWeights`. Fed arrays
+    live in host memory, a GPU would get a copy of all the weights with every run.
+    '''
+    cpu_config = tf.ConfigProto()
+    cpu_config.CopyFrom(config)
+    cpu_config.device_count['GPU'] = 0
+    if tf.test.is_built_with_cuda():
+        log_warn('Running on the CPU only, as GPUs would copy the shared weights with every run')
+    return cpu_config
+
+
+class SharedWeights(object):
+    r'''
+    Weights of the checkpoint ``checkpoint_path`` shared by all inference processes of a host.
+    They are published once as ``.npy`` files to ``shared_dir`` (by default the tmpfs ``/dev/shm``)
+    and memory mapped read-only by every process, so their pages exist once in memory.
+    Instead of restoring the variables of ``mapping`` (checkpoint names to variables), sessions feed
+    :attr:`feed_dict`, which binds the variables' read tensors to the mapped arrays. The variables
+    themselves never get initialized and thus allocate no memory. Only sessions on the CPU use the
+    mapped pages in place, see :func:`cpu_session_config`.
+    Publications occupy the memory of a tmpfs until they are removed. With ``keep`` set, only the
+    ``keep`` most recent ones (including this checkpoint's) are kept, see :func:`remove_publications`.
+    '''
+    def __init__(self, checkpoint_path, mapping, shared_dir='/dev/shm', keep=0):
+        names = list(mapping.keys())
+        self.directory = publish(checkpoint_path, names, shared_dir)
+        try:
+            arrays = self._load(names)
+        except IOError:
+            # Removed by another process between publishing and mapping
+            log_warn('Weights in {} vanished, publishing them again'.format(self.directory))
+            self.directory = publish(checkpoint_path, names, shared_dir)
+            arrays = self._load(names)
+        self.feed_dict = {mapping[name].value(): array for name, array in zip(names, arrays)}
+        log_debug('Mapped {} weights from {}'.format(len(self.feed_dict), self.directory))
+        if keep > 0:
+            remove_publications(shared_dir, keep, current=self.directory)
+
+    def _load(self, names):
+        return [np.load(os.path.join(self.directory, _file_name(name)), mmap_mode='r') for name in names]
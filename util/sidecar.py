@@ -0,0 +1,98 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import numpy as np
+import os
+import subprocess
+import sys
+import tempfile
+import tensorflow as tf
+
+from util.flags import FLAGS
+from util.logging import log_info, log_warn
+
+
+def stop_file_path():
+    return FLAGS.sidecar_stop_file or os.path.join(FLAGS.checkpoint_dir, 'early_stop.json')
+
+
+def start_sidecar_evaluator():
+    r'''
+    Starts a low priority copy of this process that evaluates the checkpoints written by
+    the training on the dev set, see :func:`watch_checkpoints`. It gets the same flags,
+    runs on CPU only and scores dev batches of --dev_batch_size samples.
+    '''
+    stop_file = stop_file_path()
+    if os.path.exists(stop_file):
+        os.unlink(stop_file)
+
+    argv = [sys.executable, sys.argv[0]] + sys.argv[1:] + [
+        '--sidecar_eval',
+        '--test_batch_size=%d' % FLAGS.dev_batch_size,
+        '--test_output_file=',
+        '--eval_workers=1',
+        '--eval_worker_index=0',
+    ]
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+    niceness = FLAGS.sidecar_niceness
+    log_info('Starting dev set evaluation sidecar')
+    return subprocess.Popen(argv, env=env, preexec_fn=lambda: os.nice(niceness))
+
+
+def early_stop_requested():
+    return os.path.exists(stop_file_path())
+
+
+def should_stop_early(dev_losses):
+    r'''
+    Early stopping criterion of the training coordinator, applied to the sidecar's dev losses.
+    '''
+    if not FLAGS.early_stop or len(dev_losses) < FLAGS.earlystop_nsteps:
+        return False
+    previous = dev_losses[-FLAGS.earlystop_nsteps:-1]
+    mean_loss = np.mean(previous)
+    std_loss = np.std(previous)
+    dev_loss = dev_losses[-1]
+    return dev_loss > mean_loss or (std_loss < FLAGS.estop_std_thresh and abs(mean_loss - dev_loss) < FLAGS.estop_mean_thresh)
+
+
+def watch_checkpoints(evaluate_fn):
+    r'''
+    Waits for new checkpoints in --checkpoint_dir and scores each one with ``evaluate_fn``,
+    which returns a dict of metrics. Metrics are written as ``dev`` TensorBoard summaries at
+    the checkpoint's global step. If the dev losses meet the early stopping criterion,
+    the stop file the training loop watches gets written.
+    Returns once the training process went away and no new checkpoint showed up.
+    '''
+    parent_pid = os.getppid()
+    writer = tf.summary.FileWriter(os.path.join(FLAGS.summary_dir, 'dev'))
+    dev_losses = []
+
+    for checkpoint_path in tf.contrib.training.checkpoints_iterator(FLAGS.checkpoint_dir,
+                                                                    min_interval_secs=FLAGS.sidecar_poll_secs,
+                                                                    timeout=FLAGS.sidecar_poll_secs,
+                                                                    timeout_fn=lambda: os.getppid() != parent_pid):
+        try:
+            global_step = int(tf.train.load_checkpoint(checkpoint_path).get_tensor('global_step'))
+        except (tf.errors.OpError, ValueError) as e:
+            log_warn('Could not read checkpoint {}: {}'.format(checkpoint_path, e))
+            continue
+
+        with tf.Graph().as_default():
+            metrics = evaluate_fn(checkpoint_path)
+
+        writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag='sidecar_%s' % name, simple_value=value)
+                                             for name, value in sorted(metrics.items())]), global_step)
+        writer.flush()
+        log_info('Dev set of step {} - {}'.format(global_step, ', '.join('%s: %f' % item for item in sorted(metrics.items()))))
+
+        dev_losses.append(metrics['loss'])
+        if should_stop_early(dev_losses):
+            log_info('Early stop triggered as dev loss of step {} stopped improving'.format(global_step))
+            stop_file = stop_file_path()
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(stop_file)))
+            with os.fdopen(fd, 'w') as fout:
+                json.dump({'global_step': global_step, 'checkpoint': checkpoint_path, 'dev_losses': dev_losses}, fout)
+            os.rename(temp_path, stop_file)
+
+    writer.close()
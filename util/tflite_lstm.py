@@ -0,0 +1,30 @@
+from __future__ import absolute_import, division, print_function
+
+import tensorflow as tf
+
+# Gates in the order of the columns of the fused cell's kernel and bias, named like the TF Lite cell's variables
+GATES = ('input', 'cell', 'forget', 'output')
+
+
+def assign_fused_lstm_weights(kernel, bias, cell_variables, forget_bias=1.0):
+    r'''
+    Returns the op assigning the ``kernel`` and ``bias`` of an ``LSTMBlockFusedCell`` (or ``LSTMCell``)
+    to the variables of a ``TFLiteLSTMCell``, ``cell_variables`` being the TF Lite cell's variables.
+    The training cells multiply ``[inputs, previous output]`` by one kernel holding the gates in
+    i, j (cell input), f, o order and add ``forget_bias`` to the forget gate at runtime. The TF Lite
+    cell has an input and a recurrent weight matrix of shape ``[units, input size]`` per gate and
+    one bias per gate, whose forget gate bias has to include ``forget_bias``.
+    '''
+    variables = {v.op.name.rsplit('/', 1)[-1]: v for v in cell_variables}
+    units = int(bias.get_shape()[0]) // len(GATES)
+    input_depth = int(kernel.get_shape()[0]) - units
+    assignments = []
+    for index, gate in enumerate(GATES):
+        gate_kernel = kernel[:, index*units:(index+1)*units]
+        gate_bias = bias[index*units:(index+1)*units]
+        if gate == 'forget':
+            gate_bias += forget_bias
+        assignments += [tf.assign(variables['input_to_%s_w' % gate], tf.transpose(gate_kernel[:input_depth])),
+                        tf.assign(variables['cell_to_%s_w' % gate], tf.transpose(gate_kernel[input_depth:])),
+                        tf.assign(variables['%s_bias' % gate], gate_bias)]
+    return tf.group(*assignments)
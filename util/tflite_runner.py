@@ -0,0 +1,131 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import tensorflow as tf
+
+from multiprocessing.pool import ThreadPool
+from six.moves import queue, range
+from util.logging import log_debug, log_info
+
+
+def _interpreter_class():
+    # The interpreter moved out of contrib with TensorFlow 1.13
+    if hasattr(tf, 'lite') and hasattr(tf.lite, 'Interpreter'):
+        return tf.lite.Interpreter
+    return tf.contrib.lite.Interpreter
+
+
+class _Interpreter(object):
+    r'''
+    A TF Lite interpreter of an exported model with its tensors looked up by name.
+    '''
+    def __init__(self, model_path, num_threads):
+        interpreter_class = _interpreter_class()
+        try:
+            self.interpreter = interpreter_class(model_path=model_path, num_threads=num_threads)
+        except TypeError:
+            # Interpreters of older TensorFlow versions always use one thread
+            self.interpreter = interpreter_class(model_path=model_path)
+        self.interpreter.allocate_tensors()
+        self._update_details()
+
+    def _update_details(self):
+        self.inputs = {d['name']: d for d in self.interpreter.get_input_details()}
+        self.outputs = {d['name']: d for d in self.interpreter.get_output_details()}
+
+    def resize_steps(self, n_steps):
+        shape = list(self.inputs['input_node']['shape'])
+        if shape[1] == n_steps:
+            return
+        shape[1] = n_steps
+        self.interpreter.resize_tensor_input(self.inputs['input_node']['index'], shape)
+        self.interpreter.allocate_tensors()
+        self._update_details()
+
+    def set(self, name, value):
+        self.interpreter.set_tensor(self.inputs[name]['index'], value)
+
+    def get(self, name):
+        return self.interpreter.get_tensor(self.outputs[name]['index'])
+
+
+class TFLiteRunner(object):
+    r'''
+    Runs the acoustic model exported by ``--export_tflite`` on batches of any size and length.
+    Batches get split into sub-batches of the model's batch size (the last one zero padded),
+    which ``num_interpreters`` interpreters of ``num_threads`` threads each compute in parallel.
+    Models with a fused LSTM get their number of time steps resized to the batch's length,
+    models with an unrolled LSTM are fed chunk by chunk, carrying over the LSTM state.
+    '''
+    def __init__(self, model_path, num_threads=1, num_interpreters=1):
+        self.model_path = model_path
+        self._interpreters = queue.Queue()
+        for _ in range(num_interpreters):
+            self._interpreters.put(_Interpreter(model_path, num_threads))
+        self._pool = ThreadPool(num_interpreters)
+
+        interpreter = self._interpreters.get()
+        self.batch_size, self.n_steps, self.window_size, self.n_input = interpreter.inputs['input_node']['shape']
+        self.state_shape = interpreter.inputs['previous_state_c']['shape']
+        self.dynamic_steps = self._supports_resizing(interpreter)
+        self._interpreters.put(interpreter)
+        log_info('TF Lite model {}: batch size {}, {} time steps, {} interpreter(s) of {} thread(s)'.format(
+            model_path, self.batch_size, 'dynamic' if self.dynamic_steps else self.n_steps, num_interpreters, num_threads))
+
+    def _supports_resizing(self, interpreter):
+        # An unrolled LSTM has one op per time step, it can't be resized
+        try:
+            interpreter.resize_steps(self.n_steps + 1)
+            interpreter.resize_steps(self.n_steps)
+            return True
+        except (RuntimeError, ValueError) as e:
+            log_debug('Model does not support resizing its time steps: {}'.format(e))
+            interpreter.resize_steps(self.n_steps)
+            return False
+
+    def _run_sub_batch(self, features):
+        interpreter = self._interpreters.get()
+        try:
+            state_c = np.zeros(self.state_shape, dtype=np.float32)
+            state_h = np.zeros(self.state_shape, dtype=np.float32)
+            steps = features.shape[1]
+            chunk_steps = steps if self.dynamic_steps else self.n_steps
+            if self.dynamic_steps:
+                interpreter.resize_steps(max(chunk_steps, 1))
+
+            probabilities = []
+            for start in range(0, max(steps, 1), max(chunk_steps, 1)):
+                chunk = features[:, start:start + chunk_steps]
+                if chunk.shape[1] < chunk_steps:
+                    chunk = np.pad(chunk, [(0, 0), (0, chunk_steps - chunk.shape[1]), (0, 0), (0, 0)], 'constant')
+                interpreter.set('input_node', chunk)
+                interpreter.set('previous_state_c', state_c)
+                interpreter.set('previous_state_h', state_h)
+                interpreter.interpreter.invoke()
+                # Time major [chunk_steps * batch_size, n_classes]
+                logits = interpreter.get('logits').reshape([chunk_steps, self.batch_size, -1])
+                probabilities.append(np.transpose(logits, [1, 0, 2]))
+                state_c = interpreter.get('new_state_c')
+                state_h = interpreter.get('new_state_h')
+            return np.concatenate(probabilities, axis=1)[:, :steps]
+        finally:
+            self._interpreters.put(interpreter)
+
+    def run(self, features):
+        r'''
+        Returns the batch major softmax outputs of the windowed ``features`` of a padded batch.
+        '''
+        features = np.asarray(features, dtype=np.float32)
+        count = len(features)
+        sub_batches = []
+        for start in range(0, count, self.batch_size):
+            sub_batch = features[start:start + self.batch_size]
+            if len(sub_batch) < self.batch_size:
+                sub_batch = np.pad(sub_batch, [(0, self.batch_size - len(sub_batch))] + [(0, 0)] * 3, 'constant')
+            sub_batches.append(sub_batch)
+        results = self._pool.map(self._run_sub_batch, sub_batches)
+        return np.concatenate(results, axis=0)[:count]
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
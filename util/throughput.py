@@ -0,0 +1,115 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import numpy as np
+import tensorflow as tf
+import time
+
+from collections import OrderedDict
+from util.batch_mfcc import WIN_STEP
+from util.logging import log_info, log_warn
+
+# Labels of the ops that block while a tower waits for input
+INPUT_OPS = ('QueueDequeueMany', 'IteratorGetNext')
+
+# Name scope of the gradient averaging ops, see average_gradients()
+AVERAGE_GRADIENTS_SCOPE = 'average_gradients'
+
+
+def _span_ms(node_stats):
+    if not node_stats:
+        return 0.
+    start = min(n.all_start_micros for n in node_stats)
+    end = max(n.all_start_micros + n.all_end_rel_micros for n in node_stats)
+    return (end - start) / 1000.
+
+
+class ThroughputMonitor(object):
+    r'''
+    Step level instrumentation of the training loop.
+    Measures samples/sec and audio-seconds/sec of every step, the fraction of the padded input
+    time steps that are not padding, the depth of the input queues and the time spent writing
+    step summaries. Every ``trace_steps`` steps the step is traced
+    to also measure the time the towers are blocked on their input and the time spent averaging
+    gradients. Measurements go to TensorBoard through the given summary writers and, if
+    ``log_path`` is set, to a JSON lines file. A warning is logged whenever towers spend more than
+    ``bottleneck_threshold`` of a traced step waiting for input.
+    '''
+    def __init__(self, queue_sizes, log_path='', trace_steps=100, bottleneck_threshold=0.2):
+        self.fetches = {
+            'input_steps': tf.add_n(tf.get_collection('tower_input_steps')),
+            'samples': tf.add_n(tf.get_collection('tower_batch_sizes')),
+            'padded_steps': tf.add_n(tf.get_collection('tower_padded_steps')),
+            'queue_sizes': queue_sizes,
+        }
+        self._log = open(log_path, 'a') if log_path else None
+        self._trace_steps = trace_steps
+        self._threshold = bottleneck_threshold
+        self._steps = 0
+        self._padding = {}
+
+    def run_kwargs(self):
+        r'''
+        Extra ``session.run`` arguments of the next step, tracing it if it is due.
+        '''
+        self._steps += 1
+        if self._trace_steps > 0 and self._steps % self._trace_steps == 0:
+            return {
+                'options': tf.RunOptions(trace_level=tf.RunOptions.SOFTWARE_TRACE),
+                'run_metadata': tf.RunMetadata(),
+            }
+        return {}
+
+    def step(self, set_name, global_step, step_time, summary_time, values, summary_writer, run_metadata=None):
+        stats = OrderedDict([
+            ('set', set_name),
+            ('global_step', int(global_step)),
+            ('time', time.time()),
+            ('step_ms', step_time * 1000.),
+            ('samples_per_sec', values['samples'] / step_time),
+            ('audio_seconds_per_sec', values['input_steps'] * WIN_STEP / step_time),
+            ('padding_efficiency', float(values['input_steps']) / max(values['padded_steps'], 1)),
+            ('summary_ms', summary_time * 1000.),
+        ])
+        input_steps, padded_steps = self._padding.get(set_name, (0, 0))
+        self._padding[set_name] = (input_steps + int(values['input_steps']), padded_steps + int(values['padded_steps']))
+
+        for i, size in enumerate(values['queue_sizes']):
+            stats['queue_depth_tower_%d' % i] = int(size)
+
+        if run_metadata is not None:
+            node_stats = [n for d in run_metadata.step_stats.dev_stats for n in d.node_stats]
+            towers = {}
+            for n in node_stats:
+                if any(op in n.timeline_label for op in INPUT_OPS):
+                    tower = n.node_name.split('/')[0]
+                    towers[tower] = towers.get(tower, 0.) + n.all_end_rel_micros / 1000.
+            # Towers wait concurrently, so the slowest one is what the step waited for
+            stats['input_wait_ms'] = max(towers.values()) if towers else 0.
+            stats['average_gradients_ms'] = _span_ms([n for n in node_stats
+                                                      if n.node_name.startswith(AVERAGE_GRADIENTS_SCOPE + '/')])
+            if stats['input_wait_ms'] > self._threshold * stats['step_ms']:
+                log_warn('Input pipeline is the bottleneck: towers waited {:.0f}ms for input in a {:.0f}ms step. '
+                         'Queue depths: {}'.format(stats['input_wait_ms'], stats['step_ms'], list(values['queue_sizes'])))
+
+        summary = tf.Summary(value=[tf.Summary.Value(tag='throughput/' + key, simple_value=value)
+                                    for key, value in stats.items() if isinstance(value, (float, int, np.number))
+                                    and key not in ('global_step', 'time')])
+        summary_writer.add_summary(summary, global_step)
+
+        if self._log:
+            self._log.write(json.dumps(stats) + '\n')
+
+    def log_padding_efficiency(self, set_name, label):
+        r'''
+        Logs the padding efficiency of the batches of ``set_name`` run since the last call, e.g. of an epoch.
+        '''
+        input_steps, padded_steps = self._padding.pop(set_name, (0, 0))
+        if padded_steps > 0:
+            log_info('{} padding efficiency: {:.1%} of the padded {} time steps are samples'.format(
+                label, float(input_steps) / padded_steps, set_name))
+
+    def close(self):
+        if self._log:
+            self._log.close()
+            self._log = None
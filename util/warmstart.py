@@ -0,0 +1,102 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import os
+import tensorflow as tf
+import time
+
+from tensorflow.python.ops import io_ops
+from util.logging import log_info, log_warn
+
+
+def parse_name_map(name_map):
+    r'''
+    Parses comma separated ``variable=checkpoint`` pairs of name prefixes.
+    '''
+    pairs = []
+    for pair in name_map.split(','):
+        if pair.strip():
+            variable_prefix, checkpoint_prefix = pair.split('=', 1)
+            pairs.append((variable_prefix.strip(), checkpoint_prefix.strip()))
+    return pairs
+
+
+def checkpoint_name(variable_name, name_map):
+    for variable_prefix, checkpoint_prefix in name_map:
+        if variable_name == variable_prefix or variable_name.startswith(variable_prefix + '/'):
+            return checkpoint_prefix + variable_name[len(variable_prefix):]
+    return variable_name
+
+
+class Warmstart(object):
+    r'''
+    Initializes ``variables`` from the checkpoint ``checkpoint_path`` (or the latest one in it,
+    if it is a directory) by a single restore op that reads all tensors in one pass.
+    ``name_map`` pairs (see :func:`parse_name_map`) rename variables to checkpoint tensors by prefix.
+    Variables without a tensor in the checkpoint keep their initial values. If ``partial`` is set,
+    variables whose shape differs from their tensor's (e.g. ``h6``/``b6`` of a model with another
+    alphabet) get the overlapping slice, otherwise they keep their initial values too.
+    Only the variables in :attr:`restored` get completely restored, all others have to be initialized
+    before :meth:`run`, which only writes the overlap of partially restored ones.
+    The op has to be created before the graph gets finalized, :meth:`run` executes it.
+    '''
+    def __init__(self, checkpoint_path, variables, name_map=None, partial=True):
+        if os.path.isdir(checkpoint_path):
+            checkpoint_path = tf.train.latest_checkpoint(checkpoint_path)
+        self.checkpoint_path = checkpoint_path
+        reader = tf.train.load_checkpoint(checkpoint_path)
+        shapes = reader.get_variable_to_shape_map()
+        dtypes = reader.get_variable_to_dtype_map()
+
+        names, slices, targets = [], [], []
+        self.bytes = 0
+        self.missing = []
+        self.partial = []
+        self.restored = []
+        for variable in variables:
+            name = checkpoint_name(variable.op.name, name_map or [])
+            if name not in shapes:
+                self.missing.append(variable.op.name)
+                continue
+
+            shape = variable.get_shape().as_list()
+            source_shape = shapes[name]
+            dtype = dtypes[name]
+            if shape == source_shape:
+                names.append(name)
+                slices.append('')
+                targets.append(variable)
+                self.restored.append(variable)
+            elif partial and len(shape) == len(source_shape) and len(shape) > 0:
+                overlap = [min(d, s) for d, s in zip(shape, source_shape)]
+                # Reads only the overlap from the checkpoint, e.g. "2048 29 0,2048:0,26"
+                names.append(name)
+                slices.append('%s %s' % (' '.join(str(s) for s in source_shape),
+                                         ':'.join('0,%d' % o for o in overlap)))
+                targets.append(variable[tuple(slice(0, o) for o in overlap)])
+                self.partial.append('{} {} <- {}'.format(variable.op.name, overlap, source_shape))
+                shape = overlap
+            else:
+                log_warn('Not warmstarting {}: its shape {} does not match {} of {}'.format(variable.op.name, shape, source_shape, name))
+                self.missing.append(variable.op.name)
+                continue
+            self.bytes += int(np.prod(shape)) * dtype.size
+
+        self.count = len(names)
+        if names:
+            with tf.name_scope('warmstart'), tf.device('/cpu:0'):
+                tensors = io_ops.restore_v2(checkpoint_path, names, slices, [dtypes[n] for n in names])
+            self.op = tf.group(*[target.assign(tensor) for target, tensor in zip(targets, tensors)], name='warmstart')
+        else:
+            self.op = tf.no_op(name='warmstart')
+
+    def run(self, session):
+        start = time.time()
+        session.run(self.op)
+        duration = time.time() - start
+        for description in self.partial:
+            log_info('Partially warmstarted {}'.format(description))
+        if self.missing:
+            log_warn('No tensors for {} in {}, keeping their initial values'.format(', '.join(self.missing), self.checkpoint_path))
+        log_info('Warmstarted {} variables ({:.1f} MB) from {} in {:.2f}s'.format(self.count, self.bytes / 2.**20,
+                                                                                 self.checkpoint_path, duration))